@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import argparse
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid, CTImageStorage, BasicTextSRStorage
+
+MODALITIES = ['CT', 'MR', 'CR', 'US', 'PT']
+BODY_PARTS = ['HEAD', 'CHEST', 'ABDOMEN', 'PELVIS', 'KNEE', 'SPINE']
+MANUFACTURERS = ['SIEMENS', 'GE MEDICAL SYSTEMS', 'Philips', 'TOSHIBA']
+FINDINGS = ['No acute findings.', 'Small nodule in the right upper lobe.', 'Degenerative changes.',
+            'Fracture of the distal radius.']
+
+
+@dataclass
+class CorpusSpec:
+    patients: int = 10
+    studies: int = 2
+    series: int = 3
+    images: int = 20
+    # Private blocks per image and size in bytes of the value stored in each of them
+    private_blocks: int = 2
+    private_size: int = 4096
+    # Pixel data bytes per image, read by parsers that do not stop before the pixels
+    pixel_size: int = 16384
+    sr_reports: bool = True
+    seed: int = 0
+
+    @property
+    def files(self) -> int:
+        return self.patients * self.studies * (self.series * self.images + int(self.sr_reports))
+
+
+def _file_meta(sop_class: str) -> FileMetaDataset:
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    return meta
+
+
+def _study(rng: random.Random, patient: int, study: int) -> Dataset:
+    ds = Dataset()
+    ds.PatientID = f'P{patient:07d}'
+    ds.PatientName = f'Patient^{patient}'
+    ds.PatientBirthDate = f'{rng.randint(1930, 2010)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}'
+    ds.PatientSex = rng.choice('MF')
+    ds.PatientAge = f'{rng.randint(1, 99):03d}Y'
+    ds.StudyInstanceUID = generate_uid()
+    ds.StudyID = str(study)
+    ds.AccessionNumber = f'HOSP1{patient:07d}{study:03d}'
+    ds.StudyDate = f'20{rng.randint(10, 24)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}'
+    ds.StudyTime = f'{rng.randint(0, 23):02d}{rng.randint(0, 59):02d}00'
+    ds.StudyDescription = f'{rng.choice(BODY_PARTS)} study'
+    ds.Manufacturer = rng.choice(MANUFACTURERS)
+    ds.InstitutionName = 'Synthetic hospital'
+    return ds
+
+
+def _image(study: Dataset, series: Dataset, instance: int, spec: CorpusSpec) -> Dataset:
+    ds = Dataset()
+    ds.file_meta = _file_meta(CTImageStorage)
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.update(study)
+    ds.update(series)
+    ds.InstanceNumber = instance
+    ds.SliceLocation = float(instance)
+    for block_number in range(spec.private_blocks):
+        block = ds.private_block(0x0029 + 2 * block_number, f'SYNTHETIC {block_number}', create=True)
+        block.add_new(0x10, 'OB', b'\x5a' * spec.private_size)
+    ds.Rows = 64
+    ds.Columns = spec.pixel_size // 128 or 1
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = b'\0' * (ds.Rows * ds.Columns * 2)
+    return ds
+
+
+def _report(rng: random.Random, study: Dataset) -> Dataset:
+    ds = Dataset()
+    ds.file_meta = _file_meta(BasicTextSRStorage)
+    ds.SOPClassUID = BasicTextSRStorage
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.update(study)
+    ds.Modality = 'SR'
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesDescription = 'Report'
+    ds.ValueType = 'CONTAINER'
+    items = []
+    for finding in rng.sample(FINDINGS, 2):
+        item = Dataset()
+        item.RelationshipType = 'CONTAINS'
+        item.ValueType = 'TEXT'
+        item.TextValue = finding
+        items.append(item)
+    ds.ContentSequence = items
+    return ds
+
+
+def generate_corpus(root: Path, spec: CorpusSpec) -> list[Path]:
+    # patient/study/series/image.dcm, the layout of a PACS export
+    rng = random.Random(spec.seed)
+    paths = []
+    for patient in range(spec.patients):
+        for study_number in range(spec.studies):
+            study = _study(rng, patient, study_number)
+            study_folder = root / study.PatientID / study.AccessionNumber
+            for series_number in range(spec.series):
+                series = Dataset()
+                series.SeriesInstanceUID = generate_uid()
+                series.SeriesNumber = series_number
+                series.Modality = rng.choice(MODALITIES)
+                series.SeriesDescription = f'series {series_number}'
+                series.ProtocolName = f'{rng.choice(BODY_PARTS)} protocol'
+                series.BodyPartExamined = rng.choice(BODY_PARTS)
+                series_folder = study_folder / f'{series_number:03d}'
+                series_folder.mkdir(parents=True, exist_ok=True)
+                for instance in range(spec.images):
+                    path = series_folder / f'{instance:05d}.dcm'
+                    _image(study, series, instance, spec).save_as(path, enforce_file_format=True)
+                    paths.append(path)
+            if spec.sr_reports:
+                path = study_folder / 'report.dcm'
+                _report(rng, study).save_as(path, enforce_file_format=True)
+                paths.append(path)
+    return paths
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = CorpusSpec()
+    parser.add_argument('--patients', type=int, default=defaults.patients)
+    parser.add_argument('--studies', type=int, default=defaults.studies, help='studies per patient')
+    parser.add_argument('--series', type=int, default=defaults.series, help='series per study')
+    parser.add_argument('--images', type=int, default=defaults.images, help='images per series')
+    parser.add_argument('--private-blocks', type=int, default=defaults.private_blocks)
+    parser.add_argument('--private-size', type=int, default=defaults.private_size)
+    parser.add_argument('--pixel-size', type=int, default=defaults.pixel_size)
+    parser.add_argument('--no-sr', dest='sr_reports', action='store_false', help='do not add a SR report per study')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def spec_from_args(args: argparse.Namespace) -> CorpusSpec:
+    return CorpusSpec(patients=args.patients, studies=args.studies, series=args.series, images=args.images,
+                      private_blocks=args.private_blocks, private_size=args.private_size,
+                      pixel_size=args.pixel_size, sr_reports=args.sr_reports, seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic dicom corpus')
+    parser.add_argument('root', type=Path, help='folder the corpus is written to')
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    corpus = generate_corpus(args.root, spec_from_args(args))
+    print(f'{len(corpus)} files written to {args.root}')
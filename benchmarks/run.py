@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import insert
+
+from benchmarks.corpus import CorpusSpec, generate_corpus, add_spec_arguments, spec_from_args
+from dicom2sql.config_file import ConfigFile
+from dicom2sql.consumer import QueueConsumer
+from dicom2sql.filesystem.file_extractor import FileExtractor
+from dicom2sql.filesystem.read_plan import ReadPlan, DEFAULT_DEFER_SIZE
+from dicom2sql.filesystem.walker import walk
+from dicom2sql.pipeline import Pipeline, read_dicom
+from dicom2sql.sql.database import Database, FileRecord
+from dicom2sql.sql.schema import ImageQueue
+
+STAGES = ('walk', 'parse', 'insert', 'crawler', 'server')
+
+# Tag descriptors of the values the synthetic corpus varies
+BENCHMARK_TAGS = [
+    {'tag': '00080080', 'name': 'InstitutionName', 'tag_description': ''},
+    {'tag': '00080070', 'name': 'Manufacturer', 'tag_description': ''},
+    {'tag': '00180015', 'name': 'BodyPartExamined', 'tag_description': ''},
+    {'tag': '00181030', 'name': 'ProtocolName', 'tag_description': ''},
+    {'tag': '00200011', 'name': 'SeriesNumber', 'tag_description': ''},
+]
+
+
+def _result(files: int, seconds: float, **extra) -> dict:
+    return {'files': files, 'seconds': round(seconds, 6),
+            'files_per_second': round(files / seconds, 2) if seconds > 0 else None, **extra}
+
+
+def _database(folder: Path, name: str) -> Database:
+    db = Database(f'sqlite:///{folder / name}')
+    db.set_tags_list(BENCHMARK_TAGS)
+    return db
+
+
+def bench_walk(root: Path) -> dict:
+    start = perf_counter()
+    files = sum(1 for _ in walk(root))
+    return _result(files, perf_counter() - start)
+
+
+def bench_parse(paths: list[Path], plan: ReadPlan | None, threads: int) -> tuple[dict, list]:
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        datasets = list(pool.map(lambda p: read_dicom(str(p), plan), paths))
+    return _result(len(paths), perf_counter() - start, threads=threads, partial_parse=plan is not None), datasets
+
+
+def bench_insert(folder: Path, paths: list[Path], datasets: list, batch_size: int) -> dict:
+    db = _database(folder, 'insert.db')
+    records = [FileRecord(d, 'benchmark', str(p)) for p, d in zip(paths, datasets) if not isinstance(d, int)]
+    failed = 0
+    start = perf_counter()
+    for i in range(0, len(records), batch_size):
+        failed += sum(e is not None for e in db.insert_many(records[i:i + batch_size]))
+    seconds = perf_counter() - start
+    db.dispose()
+    return _result(len(records), seconds, batch_size=batch_size, failed=failed)
+
+
+def bench_crawler(folder: Path, root: Path, plan: ReadPlan | None, workers: int, preload: int) -> dict:
+    # The loop of the dicom2sql module: FileExtractor feeding Database.insert
+    db = _database(folder, 'crawler.db')
+    ConfigFile(root).remove()
+    files = 0
+    failed = 0
+    start = perf_counter()
+    for file in FileExtractor(root, preload_files=preload, workers=workers, read_plan=lambda: plan).files():
+        with file:
+            if file.error:
+                continue
+            files += 1
+            try:
+                db.insert(file.dcm_data, 'benchmark', str(file.path), None, file.size)
+            except Exception:
+                failed += 1
+    seconds = perf_counter() - start
+    db.dispose()
+    return _result(files, seconds, workers=workers, preload=preload, failed=failed)
+
+
+def bench_server(folder: Path, paths: list[Path], threads: int, processes: int, batch_size: int,
+                 partial_parse: bool) -> dict:
+    # The loop of dicom2sql.server: the image queue drained by QueueConsumer through a Pipeline
+    db = _database(folder, 'server.db')
+    queued = datetime.now() - timedelta(days=2)
+    with db.session_factory() as session:
+        session.execute(insert(ImageQueue), [{'path': str(p), 'accession_number': '', 'series_uid': '',
+                                              'insert_date': queued} for p in paths])
+        session.commit()
+
+    start = perf_counter()
+    with Pipeline(db, parse_processes=processes, parse_threads=0 if processes else threads,
+                  batch_size=batch_size, partial_parse=partial_parse) as pipeline:
+        consumer = QueueConsumer(db, pipeline.submit, 'benchmark', max_in_flight=2 * batch_size,
+                                 status_interval=0.5)
+        consumer.run(stop_when_empty=True)
+    seconds = perf_counter() - start
+    db.dispose()
+    return _result(consumer.completed + consumer.failed, seconds, threads=0 if processes else threads,
+                   processes=processes, batch_size=batch_size, failed=consumer.failed)
+
+
+def run(folder: Path, spec: CorpusSpec, stages: list[str], threads: int = 4, processes: int = 0,
+        batch_size: int = 100, partial_parse: bool = True) -> dict:
+    root = folder / 'corpus'
+    start = perf_counter()
+    paths = generate_corpus(root, spec)
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'corpus': {**spec.__dict__, 'files': len(paths), 'bytes': sum(p.stat().st_size for p in paths),
+                   'generate_seconds': round(perf_counter() - start, 6)},
+        'stages': {},
+    }
+
+    plan = None
+    if partial_parse:
+        db = _database(folder, 'tags.db')
+        plan = ReadPlan.for_tags(db.searched_tags, DEFAULT_DEFER_SIZE)
+        db.dispose()
+
+    datasets = None
+    for stage in stages:
+        logging.getLogger("dicom2sql").info(f'Running benchmark stage {stage}')
+        if stage == 'walk':
+            report['stages'][stage] = bench_walk(root)
+        elif stage == 'parse':
+            report['stages'][stage], datasets = bench_parse(paths, plan, threads)
+        elif stage == 'insert':
+            # Inserts the parsed datasets, so the database is measured without the file reads
+            if datasets is None:
+                _, datasets = bench_parse(paths, plan, threads)
+            report['stages'][stage] = bench_insert(folder, paths, datasets, batch_size)
+        elif stage == 'crawler':
+            report['stages'][stage] = bench_crawler(folder, root, plan, workers=threads, preload=4 * threads)
+        elif stage == 'server':
+            report['stages'][stage] = bench_server(folder, paths, threads, processes, batch_size, partial_parse)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput of dicom2sql on a synthetic corpus')
+    add_spec_arguments(parser)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--threads', type=int, default=4, help='parse threads, crawler workers')
+    parser.add_argument('--processes', type=int, default=0, help='parse processes of the server, 0 uses threads')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--full-parse', dest='partial_parse', action='store_false',
+                        help='read the whole header instead of the searched tags')
+    parser.add_argument('--workdir', type=Path, help='folder the temporary corpus and databases are created in')
+    parser.add_argument('--output', type=Path, help='write the json report to this file instead of stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as folder:
+        report = run(Path(folder), spec_from_args(args), args.stages, args.threads, args.processes,
+                     args.batch_size, args.partial_parse)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + '\n')
+    else:
+        print(text)
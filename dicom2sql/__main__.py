@@ -2,13 +2,15 @@ import csv
 import logging
 import os
 from pathlib import Path
-from time import strftime, gmtime, perf_counter_ns
+from time import strftime, gmtime
 
 import sqlalchemy
 
 from dicom2sql.filesystem.file_extractor import FileExtractor
-from dicom2sql.shared import parse_args, parse_config
-from sql.database import Database
+from dicom2sql.metrics import start_exporter
+from dicom2sql.profiling import start_profiler
+from dicom2sql.shared import parse_args, parse_config, get_read_plan
+from dicom2sql.sql.database import Database
 
 
 def upload_tags_description(csv_path: str, db: Database):
@@ -32,7 +34,7 @@ if __name__ == '__main__':
     args = parse_args()
     config = parse_config()
 
-    db = Database(config["out_db_uri"])
+    db = Database.from_config(config['database.out'])
 
     if args.init_db != '':
         upload_tags_description(args.init_db, db)
@@ -42,45 +44,45 @@ if __name__ == '__main__':
         project = db.get_or_create_project(args.project)
 
     inputs = list(map(lambda p: Path(p), args.paths))
+    exporter = start_exporter(config)
+    profiler = start_profiler(args, (db.engine, db.read_engine))
 
     for path in inputs:
-        file_extractor = FileExtractor(path)
+        if profiler and profiler.done.is_set():
+            break
+        file_extractor = FileExtractor(path,
+                                       preload_files=config['extractor'].getint('preload', 30),
+                                       workers=config['extractor'].getint('workers', 10),
+                                       read_plan=get_read_plan(config, db),
+                                       list_prefetch=config['extractor'].getint('list_prefetch', 0),
+                                       checkpoint_every=config['extractor'].getint('checkpoint_every', 100),
+                                       checkpoint_interval=config['extractor'].getfloat('checkpoint_interval', 5),
+                                       incremental=args.incremental)
 
         count = 0
-        avg_dicom = 0
-        avg_db = 0
         for file in file_extractor.files():
+            if profiler and profiler.done.is_set():
+                break
             with file:
-                time_a = perf_counter_ns()
                 if file.error:
                     continue
-                print(file)
-                time_b = perf_counter_ns()
-                delta_dicom = time_b - time_a
-                print(f"Time of getting next dicom: {delta_dicom}ns")
-
-                community = path
-                time_a = perf_counter_ns()
+                count += 1
                 try:
-                    db.insert(file.dcm_data, str(community), str(file.path), project)
+                    db.insert(file.dcm_data, str(path), str(file.path), project, file.size)
                 except KeyError as e:
+                    file.failed = True
                     logger.error(f'missing tag {e.args[0]} in file {file}')
-                except sqlalchemy.exc.ProgrammingError as e:
+                except sqlalchemy.exc.SQLAlchemyError as e:
+                    file.failed = True
                     logger.error(f'exception occurred while inserting file {file}: {e}')
-                time_b = perf_counter_ns()
-                delta_db = time_b - time_a
-                print(f"Time of updating db: {delta_db}ns")
-
-                if count == 0:
-                    count = 1
-                    avg_dicom = delta_dicom
-                    avg_db = delta_db
-                else:
-                    count += 1
-                    avg_dicom = avg_dicom + (delta_dicom - avg_dicom) / count
-                    avg_db = avg_db + (delta_db - avg_db) / count
-            print(f"Average time of getting next DICOM: {avg_dicom}ns over {count} DICOMs")
-            print(f"Average time of updating db: {avg_db}ns over {count} DICOMs")
-
-
-
+                except (ValueError, TypeError, OSError) as e:
+                    # Malformed values and files that vanished are reported by insert_many per file
+                    file.failed = True
+                    logger.error(f'could not insert file {file}: {e}')
+        logger.info(f'Processed {count} files of {path}')
+
+    if profiler:
+        profiler.close()
+        profiler.write(args.profile_output)
+    if exporter:
+        exporter.close()
@@ -1,51 +1,98 @@
 from __future__ import annotations
 
+import logging
+import os
+import threading
 from pathlib import Path
+from time import monotonic
 from types import TracebackType
 
 from platformdirs import user_config_dir
 
+# Byte offsets in a file list are written with a prefix, older versions wrote bare line numbers
+OFFSET_PREFIX = 'offset:'
+
+
+def get_state_file(root: Path) -> Path:
+    config_path = Path(user_config_dir(appname='dicom2sql', appauthor=False))
+    config_path.mkdir(exist_ok=True)
+    assert str(config_path) != '', 'Error getting user folder'
+    root = root.resolve()
+    return config_path / '_'.join(['root' + root.parts[0].replace('/', '_')
+                                  .replace('\\', '_')
+                                  .replace(':', '_'), *root.parts[1:]])
+
 
 class ConfigFile:
-    def __init__(self, root: Path) -> None:
-        config_path = Path(user_config_dir(appname='dicom2sql', appauthor=False))
-        config_path.mkdir(exist_ok=True)
-        assert str(config_path) != '', 'Error getting user folder'
-        root = root.resolve()
-        self.config_file = config_path / '_'.join(['root' + root.parts[0].replace('/', '_')
-                                                  .replace('\\', '_')
-                                                  .replace(':', '_'), *root.parts[1:]])
+    def __init__(self, root: Path, flush_every: int = 100, flush_interval: float = 5.0) -> None:
+        self.config_file = get_state_file(root)
+        # The position is kept in memory and written every flush_every files or flush_interval seconds.
+        # After a crash the files processed since the last write are processed again.
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._position: Path | int | None = None
+        self._unsaved = 0
+        self._last_flush = monotonic()
+        self._lock = threading.Lock()
 
     def __enter__(self) -> None:
-        self.file = self.config_file.open('a+')
+        self._position = None
+        self._unsaved = 0
+        self._last_flush = monotonic()
 
     def __exit__(self, exc_type: type[BaseException] | None,
                  exc_val: BaseException | None,
                  exc_tb: TracebackType | None
                  ) -> None:
-        self.file.close()
+        self.flush()
 
     def get_last_file(self) -> Path | int | None:
+        if self._position is not None:
+            return self._position
+
         if not self.config_file.exists():
             return None
 
-        self.file.seek(0)
-        value = self.file.read().strip()
+        value = self.config_file.read_text().strip()
 
         if value == "":
             return None
 
-        try:
-            return int(value)
-        except ValueError:
-            return Path(value)
+        if value.startswith(OFFSET_PREFIX):
+            return int(value[len(OFFSET_PREFIX):])
+        if value.isdigit():
+            # Seeking to a line number would resume in the middle of a line
+            logging.getLogger("dicom2sql").warning(f'Ignoring checkpoint {value} of {self.config_file}, '
+                                                   f'it is a line number written by an older version')
+            return None
+        return Path(value)
 
     def set_last_file(self, file: Path | int) -> None:
-        self.file.seek(0)
-        self.file.truncate()
-        self.file.write(str(file) + "\n")
-        # Force a write to disk to keep the file up-to-date in case of a crash
-        self.file.flush()
+        with self._lock:
+            self._position = file
+            self._unsaved += 1
+            if self._unsaved >= self.flush_every or monotonic() - self._last_flush >= self.flush_interval:
+                self._write()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._unsaved:
+                self._write()
+
+    def _write(self) -> None:
+        # Write to a temporary file and rename it, so a crash never leaves a truncated checkpoint behind
+        tmp_file = self.config_file.with_name(self.config_file.name + '.tmp')
+        with tmp_file.open('w') as f:
+            position = self._position
+            f.write((f'{OFFSET_PREFIX}{position}' if isinstance(position, int) else str(position)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.config_file)
+        self._unsaved = 0
+        self._last_flush = monotonic()
 
     def remove(self) -> None:
-        self.config_file.unlink(missing_ok=True)
+        with self._lock:
+            self._position = None
+            self._unsaved = 0
+            self.config_file.unlink(missing_ok=True)
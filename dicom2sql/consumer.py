@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from time import monotonic
+from typing import Callable
+
+import sqlalchemy
+
+from dicom2sql.metrics import metrics
+from dicom2sql.poller import AdaptivePoller
+from dicom2sql.sql.database import Database
+
+
+class QueueConsumer:
+    # Streams the image queue through submit. The next page is claimed while the current one is processed,
+    # up to max_in_flight files are processed at once and their status is written every status_batch files
+    # or status_interval seconds, so one slow file never holds back the rest of its page. The lease of the
+    # claimed images is renewed every third of lease while they wait for their status.
+    def __init__(self, db: Database, submit: Callable[[str], Future], owner: str, page_size: int = 1000,
+                 max_in_flight: int = 100, lease: float = 1800, poller: AdaptivePoller | None = None,
+                 retry_interval: float = 600, status_batch: int = 100, status_interval: float = 5.0):
+        self.db = db
+        self.submit = submit
+        self.owner = owner
+        self.page_size = page_size
+        self.max_in_flight = max_in_flight
+        self.lease = lease
+        self.poller = poller or AdaptivePoller()
+        # The images whose file was missing are looked for at most every retry_interval seconds
+        self.retry_interval = retry_interval
+        self._last_retry: float | None = None
+        self.status_batch = status_batch
+        self.status_interval = status_interval
+        self.completed = 0
+        self.failed = 0
+        self._pages: queue.Queue[tuple[str, list] | None] = queue.Queue(maxsize=1)
+        self._statuses: queue.Queue[tuple[str, int, int] | None] = queue.Queue()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        # Images of each claim token whose status is not written yet
+        self._leases: dict[str, int] = {}
+        self._leases_lock = threading.Lock()
+        self._renewed = monotonic()
+        self._stop = threading.Event()
+
+    def run(self, stop_when_empty: bool = False) -> None:
+        self._stop.clear()
+        fetcher = threading.Thread(target=self._fetch, args=(stop_when_empty,), daemon=True)
+        flusher = threading.Thread(target=self._flush, daemon=True)
+        metrics.set_gauge('dicom2sql_queue_depth', self._statuses.qsize, queue='statuses')
+        fetcher.start()
+        flusher.start()
+        try:
+            while True:
+                page = self._pages.get()
+                if page is None:
+                    break
+                token, rows = page
+                for image_id, path in rows:
+                    self._in_flight.acquire()
+                    self._submit(token, image_id, path)
+        finally:
+            self._stop.set()
+            for _ in range(self.max_in_flight):
+                self._in_flight.acquire()
+            for _ in range(self.max_in_flight):
+                self._in_flight.release()
+            self._statuses.put(None)
+            flusher.join()
+            metrics.remove_gauge('dicom2sql_queue_depth', queue='statuses')
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.poller.wake()
+
+    def _claim(self) -> tuple[str, list]:
+        try:
+            with metrics.timer(stage='queue_claim'):
+                token, rows = self.db.claim_new_images(self.owner, limit=self.page_size, lease=self.lease)
+            if not rows and (self._last_retry is None or monotonic() - self._last_retry >= self.retry_interval):
+                self._last_retry = monotonic()
+                with metrics.timer(stage='queue_claim'):
+                    token, rows = self.db.claim_new_images(self.owner, limit=self.page_size, filter_error=3,
+                                                           lease=self.lease)
+            return token, list(rows)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logging.getLogger("dicom2sql").error(f'Could not claim new images: {e}')
+            return '', []
+
+    def _fetch(self, stop_when_empty: bool) -> None:
+        while not self._stop.is_set():
+            token, rows = self._claim()
+            if rows:
+                with self._leases_lock:
+                    self._leases[token] = len(rows)
+                self.poller.busy()
+                self._put((token, rows))
+            elif stop_when_empty:
+                break
+            else:
+                self.poller.wait()
+        self._put(None)
+
+    def _put(self, page: tuple[str, list] | None) -> None:
+        # Blocks while a page is waiting, that is what keeps just one page prefetched
+        while True:
+            try:
+                self._pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                if page is not None and self._stop.is_set():
+                    return
+
+    def _submit(self, token: str, image_id: int, path: str) -> None:
+        try:
+            future = self.submit(path)
+        except Exception as e:
+            logging.getLogger("dicom2sql").error(f'Could not process {path}: {e}')
+            self._statuses.put((token, image_id, 5))
+            self._in_flight.release()
+            return
+        future.add_done_callback(lambda f: self._done(token, image_id, path, f))
+
+    def _done(self, token: str, image_id: int, path: str, future: Future) -> None:
+        if future.exception() is not None:
+            logging.getLogger("dicom2sql").error(f'Could not process {path}: {future.exception()}')
+            code = 5
+        else:
+            code = future.result()
+        self._statuses.put((token, image_id, code))
+        self._in_flight.release()
+
+    def _flush(self) -> None:
+        running = True
+        while running:
+            statuses = defaultdict(list)
+            count = 0
+            deadline = monotonic() + self.status_interval
+            while count < self.status_batch:
+                try:
+                    item = self._statuses.get(timeout=max(0.0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                token, image_id, code = item
+                statuses[token].append((image_id, code))
+                count += 1
+
+            for token, status in statuses.items():
+                with self._leases_lock:
+                    self._leases[token] -= len(status)
+                    if not self._leases[token]:
+                        del self._leases[token]
+                # On failure the rows stay leased and are processed again once the lease expires
+                try:
+                    with metrics.timer(stage='queue_update'):
+                        ok, fail = self.db.update_new_images(status, token)
+                except sqlalchemy.exc.SQLAlchemyError as e:
+                    logging.getLogger("dicom2sql").error(f'Could not update the status of {len(status)} images: {e}')
+                    continue
+                self.completed += ok
+                self.failed += fail
+                metrics.inc('dicom2sql_queue_images_total', ok, result='ok')
+                metrics.inc('dicom2sql_queue_images_total', fail, result='error')
+                logging.getLogger("dicom2sql").info(f'Completed {ok+fail} images. Failed {fail}. Correct {ok}')
+            if running:
+                self._renew()
+
+    def _renew(self) -> None:
+        # The prefetched page and the tail of the current one wait for their turn, their lease must not run out
+        if monotonic() - self._renewed < self.lease / 3:
+            return
+        self._renewed = monotonic()
+        with self._leases_lock:
+            tokens = list(self._leases)
+        for token in tokens:
+            try:
+                self.db.renew_lease(token, self.lease)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                logging.getLogger("dicom2sql").error(f'Could not renew the lease of claim {token}: {e}')
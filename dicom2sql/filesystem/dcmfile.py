@@ -2,28 +2,47 @@
 from __future__ import annotations
 
 import logging
+import os
 from pathlib import Path
+from typing import Callable
 
 import pydicom
 from pydicom.errors import InvalidDicomError
 
 from dicom2sql.config_file import ConfigFile
+from dicom2sql.metrics import metrics
+from .read_plan import ReadPlan
 
 
 class DcmFile:
-    def __init__(self, config:ConfigFile, path:Path, line_num: int | None=None):
+    def __init__(self, config:ConfigFile, path:Path, offset: int | None=None, entry: os.DirEntry | None=None):
         self.path = path
+        self.entry = entry
+        self.stat: os.stat_result | None = None
         self.config = config
         self.loaded = False
         self.loading = False
         self.error = False
+        # Set by the consumer when the file could not be stored, so it is retried by the next crawl
+        self.failed = False
         self.dcm_data = None
-        self.line_num=line_num
+        # Byte offset of the next line of the file list this file was read from
+        self.offset = offset
+        # Set by FileExtractor, which tracks the files processed to checkpoint them in order
+        self.seq: int | None = None
+        self.on_done: Callable[[DcmFile, bool], None] | None = None
 
-    def load(self):
+    def load(self, read_plan: ReadPlan | None = None):
         self.loading = True
         try:
-            self.dcm_data = pydicom.dcmread(self.path, stop_before_pixels=True)
+            # The directory entry caches its stat, so the size recorded later needs no extra system call
+            if self.stat is None and self.entry is not None:
+                self.stat = self.entry.stat()
+            with metrics.timer(stage='read'):
+                if read_plan:
+                    self.dcm_data = read_plan.read(self.path)
+                else:
+                    self.dcm_data = pydicom.dcmread(self.path, stop_before_pixels=True)
         except InvalidDicomError:
             logging.getLogger("dicom2sql").error(f'{self.path} contains error or is not a dicom')
             self.error = True
@@ -42,12 +61,19 @@ class DcmFile:
     def __enter__(self):
         pass
 
+    @property
+    def size(self) -> int | None:
+        return self.stat.st_size if self.stat else None
+
+    @property
+    def checkpoint(self) -> Path | int:
+        return self.offset if self.offset is not None else self.path
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not exc_type:
-            if self.line_num:
-                self.config.set_last_file(self.line_num)
-            else:
-                self.config.set_last_file(self.path)
+        if self.on_done:
+            self.on_done(self, not exc_type)
+        elif not exc_type:
+            self.config.set_last_file(self.checkpoint)
 
     def __repr__(self):
         return self.path.__repr__()
\ No newline at end of file
@@ -3,112 +3,146 @@ from __future__ import annotations
 import logging
 import queue
 import threading
+from contextlib import nullcontext
 from pathlib import Path
-from time import sleep
-from typing import Generator
+from typing import Generator, Callable
 
 from dicom2sql.config_file import ConfigFile
+from dicom2sql.metrics import metrics
 from .dcmfile import DcmFile
+from .file_lister import read_file_list, get_last_offset
+from .manifest import Manifest
+from .read_plan import ReadPlan
+from .walker import walk
 
 
 class FileExtractor:
-    def __init__(self, files_path: Path, preload_files: int=30, workers: int=10):
-        self.config_file = ConfigFile(files_path)
+    def __init__(self, files_path: Path, preload_files: int=30, workers: int=10,
+                 read_plan: Callable[[], ReadPlan | None] | None=None, list_prefetch: int=0,
+                 checkpoint_every: int=100, checkpoint_interval: float=5.0, incremental: bool=False):
+        self.config_file = ConfigFile(files_path, checkpoint_every, checkpoint_interval)
+        self.manifest = Manifest(files_path) if incremental else None
+        self.read_plan = read_plan
+        self.list_prefetch = list_prefetch
         self.file_generator = self._get_files_from_list(files_path) if files_path.is_file() else self._get_files_from_path(files_path)
         self.max_buffer_size = preload_files
-        self.file_buffer:queue.Queue[tuple[DcmFile,threading.Event]] = queue.Queue(maxsize=preload_files)
         self.max_workers = workers
-        self.pipeline:queue.Queue[tuple[DcmFile,threading.Event]] = queue.Queue(maxsize=preload_files)
+        # Files handed to the workers but not yet processed by the consumer, bounds how far loading can run ahead
+        self.window = threading.Semaphore(preload_files)
+        self.pending: queue.Queue[DcmFile | None] = queue.Queue()
+        self.loaded: queue.Queue[DcmFile | None] = queue.Queue()
         self.quit_event = threading.Event()
-        self.files_prepared = threading.Event()
-        self.workers = [threading.Thread(target=self._files_provider, daemon=True)]+[threading.Thread(target=self._load_file, daemon=True) for _ in range(1,self.max_workers)]
+        self._checkpoint_lock = threading.Lock()
+        self._next_seq = 0
+        self._completed: dict[int, DcmFile] = {}
+        self.workers = [threading.Thread(target=self._files_provider, daemon=True)]+[threading.Thread(target=self._load_file, daemon=True) for _ in range(self.max_workers)]
 
 
     def files(self) -> Generator[DcmFile, None, None]:
-        with self.config_file:
+        with self.config_file, self.manifest or nullcontext():
+            metrics.set_gauge('dicom2sql_queue_depth', self.pending.qsize, queue='pending')
+            metrics.set_gauge('dicom2sql_queue_depth', self.loaded.qsize, queue='loaded')
             for w in self.workers:
                 w.start()
 
-            while not self.file_buffer.empty() or not self.files_prepared.is_set():
-                try:
-                    f, loaded_event = self.file_buffer.get(block=False)
-                except queue.Empty:
-                    sleep(0.001)
-                    continue
+            finished_workers = 0
+            try:
+                while finished_workers < self.max_workers:
+                    f = self.loaded.get()
+                    if f is None:
+                        finished_workers += 1
+                        continue
+                    yield f
+            finally:
+                self.close()
 
-                loaded_event.wait()
-                logging.getLogger("dicom2sql").info(f'Provided new DICOM. File queue:{self.file_buffer.qsize()}, paths queue: {self.pipeline.qsize()}')
-
-                yield f
-
-            self.quit_event.set()
             self.config_file.remove()
 
+    def close(self) -> None:
+        if self.quit_event.is_set():
+            return
+        self.quit_event.set()
+        metrics.remove_gauge('dicom2sql_queue_depth', queue='pending')
+        metrics.remove_gauge('dicom2sql_queue_depth', queue='loaded')
+        # Wake the provider if it waits for room in the window, then stop the workers
+        for _ in range(self.max_buffer_size + 1):
+            self.window.release()
+        for _ in range(self.max_workers):
+            self.pending.put(None)
+        for w in self.workers[1:]:
+            if w.is_alive():
+                w.join()
+
 
     def _files_provider(self):
         logging.getLogger("dicom2sql").debug(f'Starting provider thread')
-        for f in self.file_generator:
+        for seq, f in enumerate(self.file_generator):
+            self.window.acquire()
+            if self.quit_event.is_set():
+                break
             logging.getLogger("dicom2sql").debug(f'getting file {f} in provider')
-            event = threading.Event()
-            self.file_buffer.put((f, event))
-            self.pipeline.put((f, event))
+            f.seq = seq
+            f.on_done = self._file_done
+            self.pending.put(f)
         logging.getLogger("dicom2sql").debug(f'File exploration done in provider')
-        self.files_prepared.set()
+        for _ in range(self.max_workers):
+            self.pending.put(None)
 
 
     def _load_file(self):
         logging.getLogger("dicom2sql").debug(f'Starting consumer thread')
-        while not self.quit_event.is_set() or not self.pipeline.empty():
-            job, event = self.pipeline.get()
+        while True:
+            job = self.pending.get()
+            if job is None or self.quit_event.is_set():
+                break
             logging.getLogger("dicom2sql").debug(f'Loading file {job} in consumer')
-            job.load()
-            event.set()
+            try:
+                job.load(self.read_plan() if self.read_plan else None)
+            except Exception as e:
+                logging.getLogger("dicom2sql").error(f'{job} could not be loaded: {e}')
+                job.error = True
+            self.loaded.put(job)
+        self.loaded.put(None)
         logging.getLogger("dicom2sql").debug(f'Consumer done')
 
+    def _file_done(self, file: DcmFile, processed: bool) -> None:
+        # Files can be processed out of order, only checkpoint the end of the contiguous processed prefix
+        if processed and self.manifest and not file.failed and file.stat:
+            self.manifest.record(file.path, file.stat)
+        if processed:
+            with self._checkpoint_lock:
+                self._completed[file.seq] = file
+                last = None
+                while self._next_seq in self._completed:
+                    last = self._completed.pop(self._next_seq)
+                    self._next_seq += 1
+                if last is not None:
+                    self.config_file.set_last_file(last.checkpoint)
+        self.window.release()
 
-    def _get_files_from_list(self, save_file: Path) -> Generator[DcmFile, None, None]:
-        with open(save_file) as file_list:
-            last_line = self.config_file.get_last_file()
-            if not last_line:
-                last_line = 0
-
-            for i in range(last_line):
-                file_list.readline()
-
-            for line in file_list:
-                path = Path(line.strip())
-                context = DcmFile(self.config_file, path, last_line)
-                yield context
 
-                last_line += 1
+    def _get_files_from_list(self, save_file: Path) -> Generator[DcmFile, None, None]:
+        for path, offset in read_file_list(save_file, get_last_offset(self.config_file)):
+            f = DcmFile(self.config_file, path, offset)
+            if not self._is_unchanged(f):
+                yield f
 
 
     def _get_files_from_path(self, root: Path) -> Generator[DcmFile, None, None]:
-
         last_file = self.config_file.get_last_file()
-        if last_file:
-            searched_files = _generate_directory_list(last_file, root)
-        else:
-            searched_files = [root]
-
-        while len(searched_files) > 0:
-            current_file = searched_files.pop(0)
-
-            if current_file.is_file():
-                context = DcmFile(self.config_file, current_file)
-                yield context
-                continue
-
-            next_files = sorted(list(current_file.iterdir()), key=str, reverse=True)
-            searched_files = next_files + searched_files
-
-
-def _generate_directory_list(last_file: Path, root: Path):
-    files = [last_file]
-    while last_file != root:
-        parent = last_file.parent
-        next_files = sorted(list(parent.iterdir()), key=str, reverse=True)
-        index = next_files.index(last_file)
-        files += next_files[index + 1:]
-        last_file = parent
-    return files
+        for entry in walk(root, last_file, self.list_prefetch):
+            f = DcmFile(self.config_file, Path(entry.path), entry=entry)
+            if not self._is_unchanged(f):
+                yield f
+
+    def _is_unchanged(self, file: DcmFile) -> bool:
+        if not self.manifest:
+            return False
+        try:
+            file.stat = file.entry.stat() if file.entry else file.path.stat()
+        except OSError:
+            return False
+        if self.manifest.is_unchanged(file.path, file.stat):
+            logging.getLogger("dicom2sql").debug(f'Skipping {file}, it did not change since it was stored')
+            return True
+        return False
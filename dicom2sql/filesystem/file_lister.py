@@ -1,26 +1,42 @@
+import logging
+import os
 from pathlib import Path
 from typing import Generator
 
 from dicom2sql.config_file import ConfigFile
 from .dcmfile import DcmFile
 
+# Manifests with millions of lines are read in big buffered chunks
+READ_BUFFER_SIZE = 1 << 20
 
-def get_files_from_list(save_file: Path) -> Generator[DcmFile, None, None]:
-    config_file = ConfigFile(save_file)
 
-    with open(save_file) as file_list, config_file:
-        last_line = config_file.get_last_file()
-        if not last_line:
-            last_line = 0
+def read_file_list(save_file: Path, offset: int = 0) -> Generator[tuple[Path, int], None, None]:
+    # Yields each listed path with the byte offset of the line after it, so resuming is a single seek
+    with open(save_file, 'rb', buffering=READ_BUFFER_SIZE) as file_list:
+        file_list.seek(offset)
+        for line in file_list:
+            offset += len(line)
+            line = line.strip()
+            if line:
+                yield Path(os.fsdecode(line)), offset
 
-        for i in range(last_line):
-            file_list.readline()
 
-        for line in file_list:
-            path = Path(line.strip())
-            context = DcmFile(config_file,path)
-            yield context
+def get_last_offset(config_file: ConfigFile) -> int:
+    last_offset = config_file.get_last_file()
+    if last_offset is None:
+        return 0
+    if not isinstance(last_offset, int):
+        logging.getLogger("dicom2sql").warning(f'Ignoring checkpoint {last_offset}, it is not a byte offset')
+        return 0
+    return last_offset
 
-            last_line += 1
 
-        config_file.remove()
\ No newline at end of file
+def get_files_from_list(save_file: Path) -> Generator[DcmFile, None, None]:
+    config_file = ConfigFile(save_file)
+
+    with config_file:
+        for path, offset in read_file_list(save_file, get_last_offset(config_file)):
+            context = DcmFile(config_file, path, offset)
+            yield context
+
+    config_file.remove()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from types import TracebackType
+
+from dicom2sql.config_file import get_state_file
+
+
+class Manifest:
+    # Size, mtime and inode of every file already stored, kept next to the resume checkpoint of the
+    # same root. Files whose stat did not change since they were stored are skipped on the next crawl.
+    def __init__(self, root: Path, commit_every: int = 1000) -> None:
+        state_file = get_state_file(root)
+        self.manifest_file = state_file.with_name(state_file.name + '.manifest.db')
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+
+    def __enter__(self) -> Manifest:
+        self._connection = sqlite3.connect(self.manifest_file, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                 'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER'
+                                 ') WITHOUT ROWID')
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None,
+                 exc_val: BaseException | None,
+                 exc_tb: TracebackType | None
+                 ) -> None:
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+    def is_unchanged(self, path: Path | str, stat: os.stat_result) -> bool:
+        with self._lock:
+            row = self._connection.execute('SELECT size, mtime_ns, inode FROM files WHERE path = ?',
+                                           (os.path.abspath(path),)).fetchone()
+        return row == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def record(self, path: Path | str, stat: os.stat_result) -> None:
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)',
+                                     (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._connection.commit()
+                self._uncommitted = 0
+
+    def remove(self) -> None:
+        for suffix in ('', '-wal', '-shm'):
+            Path(str(self.manifest_file) + suffix).unlink(missing_ok=True)
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Callable
+
+import pydicom
+from pydicom.dataset import Dataset
+
+from dicom2sql.sql.schema import tags_id
+
+# Values bigger than this are only read from disk if they are accessed
+DEFAULT_DEFER_SIZE = '4 KB'
+
+
+def wanted_tags(searched_tags: Iterable[str]) -> frozenset[int]:
+    tags = set()
+    for tag in [*tags_id.values(), *searched_tags]:
+        try:
+            tags.add(int(tag, 16))
+        except ValueError:
+            logging.getLogger("dicom2sql").warning(f'Ignoring tag {tag}, it is not an hexadecimal dicom tag')
+    return frozenset(tags)
+
+
+class ReadPlan:
+    def __init__(self, tags: frozenset[int], defer_size: int | str | None = DEFAULT_DEFER_SIZE) -> None:
+        self.tags = tags
+        self.defer_size = defer_size
+        self._specific_tags = sorted(tags)
+
+    @staticmethod
+    @lru_cache(maxsize=4)
+    def _for_tags(searched_tags: frozenset[str], defer_size: int | str | None) -> ReadPlan:
+        logging.getLogger("dicom2sql").info(f'Building read plan for {len(searched_tags)} searched tags')
+        return ReadPlan(wanted_tags(searched_tags), defer_size)
+
+    @staticmethod
+    def for_tags(searched_tags: Iterable[str], defer_size: int | str | None = DEFAULT_DEFER_SIZE) -> ReadPlan:
+        # The plan is only rebuilt when the tag descriptors change
+        return ReadPlan._for_tags(frozenset(searched_tags), defer_size)
+
+    def read(self, path: Path | str) -> Dataset:
+        return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=self._specific_tags,
+                               defer_size=self.defer_size)
+
+
+class ReadPlanSource:
+    # Returns the read plan of the current searched tags. Database.searched_tags keeps returning the same set until
+    # the descriptors change, so the plan is only looked up again when another set comes back.
+    def __init__(self, searched_tags: Callable[[], Iterable[str]],
+                 defer_size: int | str | None = DEFAULT_DEFER_SIZE) -> None:
+        self.searched_tags = searched_tags
+        self.defer_size = defer_size
+        self._tags = None
+        self._plan = None
+
+    def __call__(self) -> ReadPlan:
+        tags = self.searched_tags()
+        if tags is not self._tags:
+            self._plan = ReadPlan.for_tags(tags, self.defer_size)
+            self._tags = tags
+        return self._plan
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import Generator
+
+from dicom2sql.metrics import metrics
+
+
+def list_directory(path: Path | str) -> list[os.DirEntry]:
+    with os.scandir(path) as entries:
+        return sorted(entries, key=lambda e: e.name)
+
+
+class DirectoryWalker:
+    # Depth first walk that yields the files of each directory in reverse name order, the order
+    # the resume checkpoints rely on. prefetch > 0 lists that many pending directories in parallel,
+    # which hides the latency of network storage.
+    def __init__(self, root: Path, prefetch: int = 0) -> None:
+        self.root = root
+        self.prefetch = prefetch
+        self._pool = ThreadPoolExecutor(max_workers=prefetch) if prefetch > 0 else None
+        self._listings: dict[str, Future] = {}
+
+    def walk(self, last_file: Path | None = None) -> Generator[os.DirEntry, None, None]:
+        try:
+            stack = self._resume_stack(last_file) if last_file else list(self._list(self.root))
+            while stack:
+                entry = stack.pop()
+                if entry.is_file():
+                    yield entry
+                elif entry.is_dir():
+                    stack.extend(self._list(entry.path))
+                    self._prefetch(stack)
+        finally:
+            if self._pool:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._listings.clear()
+
+    def _list(self, path: Path | str) -> list[os.DirEntry]:
+        listing = self._listings.pop(str(path), None)
+        try:
+            with metrics.timer(stage='walk'):
+                return listing.result() if listing else list_directory(path)
+        except OSError as e:
+            logging.getLogger("dicom2sql").error(f'Could not list {path}: {e}')
+            return []
+
+    def _prefetch(self, stack: list[os.DirEntry]) -> None:
+        if not self._pool:
+            return
+        for entry in stack[:-self.prefetch - 1:-1]:
+            if entry.path not in self._listings and entry.is_dir():
+                self._listings[entry.path] = self._pool.submit(list_directory, entry.path)
+
+    def _resume_stack(self, last_file: Path) -> list[os.DirEntry]:
+        # Rebuild the pending work as it was when last_file was yielded, last_file itself included
+        try:
+            parts = last_file.relative_to(self.root).parts
+        except ValueError:
+            logging.getLogger("dicom2sql").warning(f'{last_file} is not inside {self.root}, starting from scratch')
+            return list(self._list(self.root))
+
+        stack = []
+        directory = self.root
+        for depth, name in enumerate(parts):
+            entries = self._list(directory)
+            stack.extend(e for e in entries if e.name < name)
+            if depth == len(parts) - 1:
+                stack.extend(e for e in entries if e.name == name)
+            directory = directory / name
+        return stack
+
+
+def walk(root: Path, last_file: Path | None = None, prefetch: int = 0) -> Generator[os.DirEntry, None, None]:
+    return DirectoryWalker(root, prefetch).walk(last_file)
@@ -5,8 +5,14 @@ import os
 from pathlib import Path
 from time import strftime, gmtime
 
+from pydicom.datadict import DicomDictionary
+
 from dicom2sql.shared import parse_config
-from dicom2sql.sql.database import Database
+from dicom2sql.sql.database import Database, DicomTagDict
+
+# Binary and sequence values have no useful text, command, file meta and delimiter groups are not in the dataset
+SKIPPED_VRS = {'SQ', 'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN', 'OB or OW', 'US or OW', 'US or SS or OW'}
+SKIPPED_GROUPS = {0x0000, 0x0002, 0xFFFE}
 
 
 def upload_tags_description(csv_path: str, db: Database):
@@ -19,6 +25,22 @@ def upload_tags_description(csv_path: str, db: Database):
 
     db.set_tags_list(rows)
 
+
+def standard_tags(vrs: set[str] | None = None, groups: set[int] | None = None,
+                  retired: bool = False) -> list[DicomTagDict]:
+    # The tags of the pydicom data dictionary, only those of the given VRs and groups when set
+    tags = []
+    for tag, (vr, vm, name, is_retired, keyword) in DicomDictionary.items():
+        group = tag >> 16
+        if vrs is not None and vr not in vrs or vrs is None and vr in SKIPPED_VRS:
+            continue
+        if groups is not None and group not in groups or groups is None and group in SKIPPED_GROUPS:
+            continue
+        if is_retired and not retired:
+            continue
+        tags.append({'tag': f'{tag:08X}', 'name': keyword, 'tag_description': name})
+    return tags
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.WARNING,
                         filename=Path(os.getcwd()) / f'{strftime("%Y-%m-%d_%H-%M-%S", gmtime())}.log', filemode='a')
@@ -29,12 +51,30 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser \
         (description='Init tag list',
          prog='dcm2sql')
-    parser.add_argument('tag_list', default='', help='path to csv file containing the tags to upload')
+    parser.add_argument('tag_list', nargs='?', default='', help='path to csv file containing the tags to upload')
+    parser.add_argument('--standard-tags', action='store_true',
+                        help='add every tag of the DICOM data dictionary, see --vr, --group and --retired')
+    parser.add_argument('--vr', action='append', help='only add the standard tags of this VR, can be repeated')
+    parser.add_argument('--group', action='append', type=lambda g: int(g, 16),
+                        help='only add the standard tags of this hexadecimal group, can be repeated')
+    parser.add_argument('--retired', action='store_true', help='add the retired standard tags too')
+    parser.add_argument('--intern-tag-values', action='store_true',
+                        help='move the values stored in the tag table to tag_value, see intern_tag_values')
+    parser.add_argument('--refresh-wide', action='store_true',
+                        help='copy the tags stored since the last refresh to series_wide, see wide_refresh_interval')
 
     args = parser.parse_args()
 
     config = parse_config()
 
-    db_out = Database(config['database.out']['out_db_uri'])
+    db_out = Database.from_config(config['database.out'])
 
-    upload_tags_description(args.tag_list, db_out)
\ No newline at end of file
+    if args.tag_list:
+        upload_tags_description(args.tag_list, db_out)
+    if args.standard_tags:
+        db_out.set_tags_list(standard_tags(set(args.vr) if args.vr else None,
+                                           set(args.group) if args.group else None, args.retired))
+    if args.intern_tag_values:
+        logger.info(f'Moved the values of {db_out.move_tag_values()} tags to tag_value')
+    if args.refresh_wide:
+        logger.info(f'Refreshed {db_out.refresh_series_wide()} cells of series_wide')
\ No newline at end of file
@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import configparser
+import logging
+import os
+import threading
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'dicom2sql_stage_seconds': 'Time spent in each processing stage',
+    'dicom2sql_files_total': 'Files processed, by result',
+    'dicom2sql_batches_total': 'Batches of files written to the database',
+    'dicom2sql_queue_images_total': 'Queued images whose status was written, by result',
+    'dicom2sql_queue_depth': 'Items waiting in the internal queues',
+}
+
+_null_timer = nullcontext()
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple, extra: str = '') -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class _Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start', 'outer')
+
+    def __init__(self, registry: Registry, name: str, labels: dict) -> None:
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> _Timer:
+        stage = self.labels.get('stage')
+        if stage:
+            self.outer = self.registry.stages.get(threading.get_ident())
+            self.registry.stages[threading.get_ident()] = stage
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.registry.observe(self.name, perf_counter() - self.start, **self.labels)
+        if self.labels.get('stage'):
+            if self.outer:
+                self.registry.stages[threading.get_ident()] = self.outer
+            else:
+                self.registry.stages.pop(threading.get_ident(), None)
+
+
+class Registry:
+    # Counters, latency histograms and gauges read when exported. Every call returns right away while the
+    # registry is disabled, so the instrumented code pays for one attribute check.
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._histograms: dict[tuple[str, tuple], _Histogram] = {}
+        self._gauges: dict[tuple[str, tuple], Callable[[], float]] = {}
+        self._listeners: list[Callable[[str, float, dict], None]] = []
+        # Stage each thread is timing, read by the profiler to attribute its samples
+        self.stages: dict[int, str] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        for listener in self._listeners:
+            listener(name, value, labels)
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name: str = 'dicom2sql_stage_seconds', **labels):
+        return _Timer(self, name, labels) if self.enabled else _null_timer
+
+    def add_listener(self, listener: Callable[[str, float, dict], None]) -> None:
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[str, float, dict], None]) -> None:
+        self._listeners.remove(listener)
+
+    def set_gauge(self, name: str, read: Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._gauges[(name, _labels(labels))] = read
+
+    def remove_gauge(self, name: str, **labels) -> None:
+        with self._lock:
+            self._gauges.pop((name, _labels(labels)), None)
+
+    def totals(self, name: str) -> dict[tuple, tuple[float, int]]:
+        # Sum and count of the histograms of name, by labels
+        with self._lock:
+            return {labels: (h.sum, h.count) for (n, labels), h in self._histograms.items() if n == name}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._gauges.clear()
+        self.stages.clear()
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(h.counts), h.sum, h.count)) for k, h in self._histograms.items())
+            gauges = sorted(self._gauges.items())
+
+        lines = []
+        described = set()
+
+        def describe(name: str, kind: str) -> None:
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, bucket in zip([*BUCKETS, '+Inf'], counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_format_labels(labels, f'le="{bound}"')} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        for (name, labels), read in gauges:
+            describe(name, 'gauge')
+            try:
+                lines.append(f'{name}{_format_labels(labels)} {read()}')
+            except Exception as e:
+                logging.getLogger("dicom2sql").debug(f'Could not read gauge {name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by the whole process, enabled by start_exporter
+metrics = Registry()
+
+
+class Exporter:
+    # Writes a snapshot to path every interval seconds and/or serves it on http://host:port/metrics
+    def __init__(self, registry: Registry, path: Path | None = None, port: int = 0, host: str = '127.0.0.1',
+                 interval: float = 15.0) -> None:
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+        if path:
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+        if port:
+            self._server = ThreadingHTTPServer((host, port), self._handler())
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return Handler
+
+    def write(self) -> None:
+        tmp_file = self.path.with_name(self.path.name + '.tmp')
+        tmp_file.write_text(self.registry.render())
+        os.replace(tmp_file, self.path)
+
+    def _write_loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.getLogger("dicom2sql").error(f'Could not write the metrics to {self.path}: {e}')
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._writer:
+            self._writer.join()
+            self.write()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self) -> Exporter:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+def start_exporter(config: configparser.ConfigParser) -> Exporter | None:
+    if 'metrics' not in config or not config['metrics'].getboolean('enabled', False):
+        return None
+    section = config['metrics']
+    metrics.enabled = True
+    path = section.get('file', '')
+    return Exporter(metrics, path=Path(path) if path else None, port=section.getint('port', 0),
+                    host=section.get('host', '127.0.0.1'), interval=section.getfloat('interval', 15))
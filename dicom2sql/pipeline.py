@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from time import monotonic, perf_counter
+
+import pydicom
+import pydicom.config
+import sqlalchemy
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+
+from dicom2sql.filesystem.read_plan import ReadPlan, ReadPlanSource, wanted_tags, DEFAULT_DEFER_SIZE
+from dicom2sql.metrics import metrics
+from dicom2sql.sql.database import Database, FileRecord
+
+# Tags kept by parse_file in the worker processes, set by init_parser
+_wanted_tags: frozenset[int] = frozenset()
+_read_plan: ReadPlan | None = None
+
+
+def init_parser(tags: frozenset[int], partial_parse: bool = False,
+                defer_size: int | str | None = DEFAULT_DEFER_SIZE, log_file: str | None = None,
+                log_level: int = logging.WARNING) -> None:
+    global _wanted_tags, _read_plan
+    _wanted_tags = tags
+    _read_plan = ReadPlan(tags, defer_size) if partial_parse and tags else None
+    pydicom.config.convert_wrong_length_to_UN = True
+    # Spawned workers start without the logging of the server, they append to its log file
+    if log_file:
+        logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=log_level,
+                            filename=log_file, filemode='a')
+        logging.getLogger("dicom2sql").setLevel(log_level)
+
+
+def read_dicom(path: str, read_plan: ReadPlan | None = None) -> Dataset | int:
+    logging.getLogger("dicom2sql").debug(f'Opening {path}')
+    try:
+        with metrics.timer(stage='read'):
+            if read_plan:
+                return read_plan.read(path)
+            return pydicom.dcmread(path, stop_before_pixels=True)
+    except (InvalidDicomError,):
+        logging.getLogger("dicom2sql").error(f'{path} contains error or is not a dicom')
+        return 1
+
+    except TypeError:
+        logging.getLogger("dicom2sql").warning(f'{path} is not dicom')
+        return 2
+
+    except (FileNotFoundError, OSError):
+        logging.getLogger("dicom2sql").warning(f'{path} does not exist')
+        return 3
+
+
+def compact_dataset(data: Dataset, tags: frozenset[int]) -> Dataset:
+    compact = Dataset()
+    for tag in tags:
+        if tag in data:
+            compact.add(data[tag])
+    return compact
+
+
+def parse_file(path: str) -> Dataset | int:
+    data = read_dicom(path, _read_plan)
+    if isinstance(data, int) or not _wanted_tags:
+        return data
+    # Also resolves the deferred values, the main process should not read the file again
+    return compact_dataset(data, _wanted_tags)
+
+
+def timed_parse_file(path: str) -> tuple[Dataset | int, float]:
+    # The registry of a worker process is never exported, the parent records the read time it sends back
+    start = perf_counter()
+    data = parse_file(path)
+    return data, perf_counter() - start
+
+
+def error_code(path: str, e: Exception | None) -> int:
+    logger = logging.getLogger("dicom2sql")
+    if e is None:
+        logger.debug(f'uploading {path} completed')
+        return 0
+    if isinstance(e, KeyError):
+        logger.error(f'missing tag {e.args[0]} in file {path}')
+        return 4
+    if isinstance(e, sqlalchemy.exc.NoResultFound):
+        logger.error(f'Something was not found, probably because a collision happened')
+        return 6
+    if isinstance(e, (FileNotFoundError, OSError)):
+        logger.warning(f'{path} does not exist')
+        return 3
+    logger.error(f'exception occurred while inserting file {path}: {e}')
+    return 5
+
+
+class Pipeline:
+    # Files are parsed in parse_processes processes, or in parse_threads threads of this process when it is
+    # set, and written to the database in batches by the writer threads. The processes log to log_file at the
+    # level of the dicom2sql logger.
+    def __init__(self, db: Database, parse_processes: int = 4, writer_threads: int = 1, batch_size: int = 100,
+                 flush_interval: float = 1.0, partial_parse: bool = False,
+                 defer_size: int | str | None = DEFAULT_DEFER_SIZE, parse_threads: int = 0,
+                 log_file: str | None = None):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.parse_processes = parse_processes
+        self.parse_threads = parse_threads
+        self.partial_parse = partial_parse
+        self.defer_size = defer_size
+        self.log_file = log_file
+        self._parse_pool: Executor | None = None
+        self._pool_tags = None
+        self._pool_lock = threading.RLock()
+        self._closed = False
+        self._read_plan = ReadPlanSource(lambda: db.searched_tags, defer_size) if partial_parse else None
+        self.records: queue.Queue[tuple[str, Dataset, Future] | None] = queue.Queue()
+        metrics.set_gauge('dicom2sql_queue_depth', self.records.qsize, queue='records')
+        self.writers = [threading.Thread(target=self._write, daemon=True) for _ in range(writer_threads)]
+        for w in self.writers:
+            w.start()
+
+    @property
+    def parse_pool(self) -> Executor:
+        with self._pool_lock:
+            if self.parse_threads:
+                if self._parse_pool is None:
+                    self._parse_pool = ThreadPoolExecutor(max_workers=self.parse_threads)
+                return self._parse_pool
+
+            # The workers keep the read plan they were started with, replace them when the tag descriptors change
+            searched_tags = self.db.searched_tags
+            if self._parse_pool is None or searched_tags is not self._pool_tags:
+                if self._parse_pool is not None:
+                    self._parse_pool.shutdown(wait=False)
+                # Forking a process that already runs writer threads and holds database connections is unsafe
+                self._parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes,
+                                                       mp_context=multiprocessing.get_context('spawn'),
+                                                       initializer=init_parser,
+                                                       initargs=(wanted_tags(searched_tags), self.partial_parse,
+                                                                 self.defer_size, self.log_file,
+                                                                 logging.getLogger("dicom2sql").getEffectiveLevel()))
+                self._pool_tags = searched_tags
+            return self._parse_pool
+
+    def submit(self, path: str) -> Future:
+        result = Future()
+        self._parse(path, result, retries=1)
+        return result
+
+    def process(self, paths: list[str]) -> list[int]:
+        return [f.result() for f in [self.submit(p) for p in paths]]
+
+    def close(self) -> None:
+        metrics.remove_gauge('dicom2sql_queue_depth', queue='records')
+        self._closed = True
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
+        for _ in self.writers:
+            self.records.put(None)
+        for w in self.writers:
+            w.join()
+
+    def __enter__(self) -> Pipeline:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _parse(self, path: str, result: Future, retries: int) -> None:
+        pool = self.parse_pool
+        try:
+            parsed = pool.submit(self._read if self.parse_threads else timed_parse_file, path)
+        except BrokenProcessPool:
+            # A worker died before this submit, every submit to its pool fails from then on
+            self._replace_pool(pool)
+            pool = self.parse_pool
+            parsed = pool.submit(timed_parse_file, path)
+        parsed.add_done_callback(lambda f: self._parsed(path, f, result, pool, retries))
+
+    def _replace_pool(self, broken: Executor) -> None:
+        with self._pool_lock:
+            if self._parse_pool is broken:
+                broken.shutdown(wait=False)
+                self._parse_pool = None
+
+    def _read(self, path: str) -> Dataset | int:
+        return read_dicom(path, self._read_plan() if self._read_plan else None)
+
+    def _parsed(self, path: str, parsed: Future, result: Future, pool: Executor, retries: int) -> None:
+        if isinstance(parsed.exception(), BrokenProcessPool):
+            # The file was being parsed when a worker died, maybe because of this very file. It is parsed once
+            # more in a new pool, then left for the retries of the missing files
+            self._replace_pool(pool)
+            if retries and not self._closed:
+                try:
+                    self._parse(path, result, retries - 1)
+                    return
+                except Exception as e:
+                    logging.getLogger("dicom2sql").error(f'{path} could not be submitted again: {e}')
+            else:
+                logging.getLogger("dicom2sql").error(f'{path} could not be parsed, the parse worker died')
+            result.set_result(3)
+            return
+        if parsed.exception() is not None:
+            logging.getLogger("dicom2sql").error(f'{path} could not be parsed: {parsed.exception()}')
+            result.set_result(1)
+            return
+        data = parsed.result()
+        if not self.parse_threads:
+            data, seconds = data
+            metrics.observe('dicom2sql_stage_seconds', seconds, stage='read')
+        if isinstance(data, int):
+            result.set_result(data)
+        else:
+            self.records.put((path, data, result))
+
+    def _write(self) -> None:
+        running = True
+        while running:
+            item = self.records.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.records.get(timeout=max(0.0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            logging.getLogger("dicom2sql").debug(f'uploading {len(batch)} files')
+            try:
+                failures = self.db.insert_many([FileRecord(data, path, path) for path, data, _ in batch])
+            except Exception as e:
+                failures = [e] * len(batch)
+            for (path, _, result), e in zip(batch, failures):
+                result.set_result(error_code(path, e))
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+from time import monotonic
+
+
+class AdaptivePoller:
+    # Polls again after min_wait while there is work and backs off exponentially up to max_wait while the
+    # queue stays empty. min_wait bounds the latency of new images, max_wait the load an idle server puts
+    # on the database. Touching wake_file, or calling wake, ends the current wait.
+    def __init__(self, min_wait: float = 1.0, max_wait: float = 600.0, backoff: float = 2.0,
+                 wake_file: Path | None = None, wake_check: float = 1.0):
+        self.min_wait = min_wait
+        self.max_wait = max(min_wait, max_wait)
+        self.backoff = backoff
+        self.wake_file = wake_file
+        self.wake_check = wake_check
+        self.delay = min_wait
+        self._wake = threading.Event()
+        self._wake_mtime = self._mtime()
+
+    def busy(self) -> None:
+        self.delay = self.min_wait
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def wait(self) -> bool:
+        # Returns True when the wait was ended by a wake up
+        deadline = monotonic() + self.delay
+        self.delay = min(self.delay * self.backoff, self.max_wait)
+        while (remaining := deadline - monotonic()) > 0:
+            if self._wake.wait(min(remaining, self.wake_check) if self.wake_file else remaining) or self._touched():
+                self._wake.clear()
+                self.busy()
+                return True
+        return False
+
+    def _mtime(self) -> int | None:
+        if self.wake_file is None:
+            return None
+        try:
+            return os.stat(self.wake_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _touched(self) -> bool:
+        mtime = self._mtime()
+        if mtime == self._wake_mtime:
+            return False
+        self._wake_mtime = mtime
+        return mtime is not None
+
+
+def notify(wake_file: Path | str) -> None:
+    # Called by the enqueuers after adding images, wakes the servers polling that file
+    Path(wake_file).touch()
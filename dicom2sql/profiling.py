@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from pathlib import Path
+from time import perf_counter, strftime, gmtime
+from typing import Callable, Iterable
+
+from sqlalchemy import Engine, event
+
+from dicom2sql.metrics import metrics
+
+# Frames of threads waiting for work, their samples do not count as busy time
+IDLE_MODULES = ('threading.py', 'queue.py', 'selectors.py', 'multiprocessing/connection.py',
+                'concurrent/futures/thread.py')
+OTHER_STAGE = 'other'
+
+
+def _location(code) -> str:
+    path = Path(code.co_filename)
+    return f'{path.parent.name}/{path.name}:{code.co_firstlineno}({code.co_qualname})'
+
+
+def _is_idle(code) -> bool:
+    return code.co_filename.replace('\\', '/').endswith(IDLE_MODULES)
+
+
+def _thread_cpu(ident: int) -> float | None:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class Profiler:
+    # Samples the stack of every thread, the SQL statements of engines and the memory allocated per batch until
+    # max_files files were written or max_seconds elapsed, then calls on_done. The samples are attributed to the
+    # stage the thread was timing with the metrics registry, which is enabled while profiling.
+    def __init__(self, engines: Iterable[Engine] = (), max_files: int = 1000, max_seconds: float = 60,
+                 interval: float = 0.005, snapshot_interval: float = 1.0, top: int = 15,
+                 on_done: Callable[[], None] | None = None) -> None:
+        # The writer and the reader of Database are the same engine unless the SQLite single writer is on
+        self.engines = list(dict.fromkeys(engines))
+        self.max_files = max_files
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+        self.top = top
+        self.on_done = on_done
+        self.done = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        self.files = 0
+        self.batches = 0
+        self.samples = 0
+        self.stage_samples: Counter[str] = Counter()
+        self.self_samples: Counter[tuple[str, str]] = Counter()
+        self.total_samples: Counter[tuple[str, str]] = Counter()
+        self.thread_samples: dict[str, list[int]] = defaultdict(lambda: [0, 0])
+        self.thread_cpu: dict[int, list] = {}
+        self.statements: dict[tuple[str, str], list] = defaultdict(lambda: [0, 0.0, 0])
+        self.memory: list[tuple[int, int, int, int]] = []
+        self._snapshots: list[tracemalloc.Snapshot] = []
+        self._last_snapshot = 0.0
+        self._sampler = threading.Thread(target=self._sample, daemon=True, name='dicom2sql-profiler')
+
+    def start(self) -> Profiler:
+        self._metrics_enabled = metrics.enabled
+        metrics.enabled = True
+        self._stage_totals = metrics.totals('dicom2sql_stage_seconds')
+        metrics.add_listener(self._on_metric)
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._before_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_execute)
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        self._take_snapshot()
+        for thread in threading.enumerate():
+            cpu = _thread_cpu(thread.ident)
+            if cpu is not None:
+                self.thread_cpu[thread.ident] = [thread.name, cpu, cpu]
+        self.start_time = perf_counter()
+        self._sampler.start()
+        return self
+
+    def close(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.seconds = perf_counter() - self.start_time
+        self._sampler.join()
+        metrics.remove_listener(self._on_metric)
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._before_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_execute)
+        self._take_snapshot(force=True)
+        if self._started_tracing:
+            tracemalloc.stop()
+        end_totals = metrics.totals('dicom2sql_stage_seconds')
+        metrics.enabled = self._metrics_enabled
+        self.stage_seconds = {}
+        for labels, (total, count) in end_totals.items():
+            start_total, start_count = self._stage_totals.get(labels, (0.0, 0))
+            self.stage_seconds[dict(labels).get('stage', OTHER_STAGE)] = (total - start_total, count - start_count)
+
+    def __enter__(self) -> Profiler:
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _finish(self) -> None:
+        if not self.done.is_set():
+            self.done.set()
+            logging.getLogger("dicom2sql").warning(f'Profiling done after {self.files} files')
+            if self.on_done:
+                self.on_done()
+
+    def _on_metric(self, name: str, value: float, labels: dict) -> None:
+        if name == 'dicom2sql_files_total':
+            with self._lock:
+                self.files += int(value)
+        elif name == 'dicom2sql_batches_total':
+            with self._lock:
+                self.batches += int(value)
+                self.memory.append((self.batches, self.files, *tracemalloc.get_traced_memory()))
+            self._take_snapshot()
+            if self.files >= self.max_files:
+                self._finish()
+
+    def _take_snapshot(self, force: bool = False) -> None:
+        # A snapshot walks every traced block, at most one per snapshot_interval keeps small batches cheap
+        now = perf_counter()
+        if not tracemalloc.is_tracing() or (not force and now - self._last_snapshot < self.snapshot_interval):
+            return
+        self._last_snapshot = now
+        snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            # Keep the first one as baseline and the latest
+            self._snapshots[1:] = [snapshot]
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault('dicom2sql_profile', []).append(perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = perf_counter() - conn.info['dicom2sql_profile'].pop()
+        stage = metrics.stages.get(threading.get_ident(), OTHER_STAGE)
+        key = (stage, re.sub(r'\s+', ' ', statement).strip()[:300])
+        with self._lock:
+            stats = self.statements[key]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += len(parameters) if executemany else 1
+
+    def _sample(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            threads = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or ident not in threads:
+                    continue
+                name = threads[ident]
+                cpu = _thread_cpu(ident)
+                if cpu is not None:
+                    self.thread_cpu.setdefault(ident, [name, 0.0, 0.0])[2] = cpu
+                thread = self.thread_samples[name]
+                thread[0] += 1
+                if _is_idle(frame.f_code):
+                    continue
+                thread[1] += 1
+                stage = metrics.stages.get(ident, OTHER_STAGE)
+                self.samples += 1
+                self.stage_samples[stage] += 1
+                self.self_samples[(stage, _location(frame.f_code))] += 1
+                seen = set()
+                while frame is not None:
+                    seen.add(_location(frame.f_code))
+                    frame = frame.f_back
+                for location in seen:
+                    self.total_samples[(stage, location)] += 1
+            if perf_counter() - self.start_time >= self.max_seconds:
+                self._finish()
+
+    def report(self) -> str:
+        lines = [f'dicom2sql profile, {strftime("%Y-%m-%d %H:%M:%S", gmtime())} UTC',
+                 f'{self.files} files in {self.batches} batches, {self.seconds:.2f} s, '
+                 f'{self.files / self.seconds if self.seconds else 0:.1f} files/s',
+                 f'{self.samples} busy samples every {self.interval * 1000:g} ms', '']
+
+        sql_by_stage: dict[str, list] = defaultdict(lambda: [0, 0.0])
+        for (stage, _), (count, seconds, _) in self.statements.items():
+            sql_by_stage[stage][0] += count
+            sql_by_stage[stage][1] += seconds
+        stages = sorted(set(self.stage_samples) | set(self.stage_seconds) | set(sql_by_stage),
+                        key=lambda s: (-self.stage_samples[s], -self.stage_seconds.get(s, (0, 0))[0]))
+
+        lines.append('== Stages, ranked by busy samples')
+        lines.append(f'{"stage":<14}{"busy %":>8}{"timed s":>10}{"calls":>9}{"sql":>9}{"sql s":>9}')
+        for stage in stages:
+            share = 100 * self.stage_samples[stage] / self.samples if self.samples else 0
+            seconds, calls = self.stage_seconds.get(stage, (0.0, 0))
+            statements, sql_seconds = sql_by_stage.get(stage, (0, 0.0))
+            lines.append(f'{stage:<14}{share:>8.1f}{seconds:>10.3f}{calls:>9}{statements:>9}{sql_seconds:>9.3f}')
+
+        lines.append('')
+        lines.append('== Hot spots by stage, % of the busy samples of the stage (self / total)')
+        for stage in stages:
+            stage_samples = self.stage_samples[stage]
+            if not stage_samples:
+                continue
+            lines.append(f'-- {stage}')
+            hot = sorted(((n, location) for (s, location), n in self.self_samples.items() if s == stage),
+                         reverse=True)[:self.top]
+            for n, location in hot:
+                total = self.total_samples[(stage, location)]
+                lines.append(f'{100 * n / stage_samples:6.1f} {100 * total / stage_samples:6.1f}  {location}')
+
+        lines.append('')
+        lines.append('== Threads')
+        lines.append(f'{"thread":<40}{"cpu s":>9}{"busy %":>8}')
+        cpu_of = {name: end - start for name, start, end in self.thread_cpu.values()}
+        for name, (samples, busy) in sorted(self.thread_samples.items(), key=lambda t: -t[1][1]):
+            cpu = cpu_of.get(name)
+            lines.append(f'{name[:39]:<40}{"" if cpu is None else f"{cpu:.3f}":>9}{100 * busy / samples:>8.1f}')
+
+        lines.append('')
+        lines.append('== SQL statements, ranked by time')
+        lines.append(f'{"seconds":>9}{"calls":>8}{"rows":>9}  stage / statement')
+        for (stage, statement), (count, seconds, rows) in sorted(self.statements.items(),
+                                                                 key=lambda s: -s[1][1])[:self.top]:
+            lines.append(f'{seconds:>9.3f}{count:>8}{rows:>9}  {stage}: {statement}')
+
+        lines.append('')
+        lines.append('== Memory')
+        if self.memory:
+            step = max(1, len(self.memory) // 20)
+            lines.append(f'{"batch":>7}{"files":>8}{"traced MiB":>12}{"peak MiB":>10}')
+            rows = self.memory[::step]
+            if rows[-1] is not self.memory[-1]:
+                rows.append(self.memory[-1])
+            for batch, files, current, peak in rows:
+                lines.append(f'{batch:>7}{files:>8}{current / 2 ** 20:>12.2f}{peak / 2 ** 20:>10.2f}')
+        if len(self._snapshots) == 2:
+            lines.append('Largest growth since the start:')
+            growth = [stat for stat in self._snapshots[1].compare_to(self._snapshots[0], 'lineno')
+                      if not stat.traceback[0].filename.endswith(('tracemalloc.py', 'profiling.py'))]
+            for stat in growth[:self.top]:
+                lines.append(f'{stat.size_diff / 2 ** 10:>10.1f} KiB {stat.count_diff:>+8}  {stat.traceback}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: Path) -> None:
+        path.write_text(self.report())
+        logging.getLogger("dicom2sql").warning(f'Profile written to {path}')
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--profile', action='store_true',
+                        help='profile a sample of the run and write a report of the hot spots of each stage')
+    parser.add_argument('--profile-files', type=int, default=1000, help='files profiled before stopping')
+    parser.add_argument('--profile-seconds', type=float, default=60, help='seconds profiled before stopping')
+    parser.add_argument('--profile-output', type=Path,
+                        default=Path(f'profile_{strftime("%Y-%m-%d_%H-%M-%S", gmtime())}.txt'))
+
+
+def start_profiler(args: argparse.Namespace, engines: Iterable[Engine],
+                   on_done: Callable[[], None] | None = None) -> Profiler | None:
+    if not args.profile:
+        return None
+    return Profiler(engines, max_files=args.profile_files, max_seconds=args.profile_seconds, on_done=on_done).start()
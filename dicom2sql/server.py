@@ -2,19 +2,21 @@ import csv
 import logging
 import os
 import smtplib
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import socket
 from datetime import date
 from email.message import EmailMessage
 from pathlib import Path
-from time import strftime, gmtime, perf_counter_ns
+from time import strftime, gmtime
 
 import pydicom
 import pydicom.config
-import sqlalchemy
-from pydicom.errors import InvalidDicomError
 
-from dicom2sql.shared import parse_config
+from dicom2sql.consumer import QueueConsumer
+from dicom2sql.metrics import start_exporter
+from dicom2sql.pipeline import Pipeline
+from dicom2sql.poller import AdaptivePoller
+from dicom2sql.profiling import start_profiler
+from dicom2sql.shared import parse_config, get_defer_size, parse_server_args
 from dicom2sql.sql.database import Database
 
 
@@ -45,85 +47,56 @@ def upload_tags_description(csv_path: str, db: Database):
 
 
 if __name__ == '__main__':
+    log_file = Path(os.getcwd()) / f'{strftime("%Y-%m-%d_%H-%M-%S", gmtime())}.log'
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.WARNING,
-                        filename=Path(os.getcwd()) / f'{strftime("%Y-%m-%d_%H-%M-%S", gmtime())}.log', filemode='a')
+                        filename=log_file, filemode='a')
     logger = logging.getLogger("dicom2sql")
     logger.setLevel(logging.WARNING)
     logging.getLogger('sqlalchemy').setLevel(logging.ERROR)
 
     pydicom.config.convert_wrong_length_to_UN = True
 
-#    args = parse_args()
+    args = parse_server_args()
     config = parse_config()
-    print(config['database.out']['out_db_uri'])
-    db_out = Database(config['database.out']['out_db_uri'], pool_size=int(config["server"]["threads"])+1)
-    def process_file(path:str) -> int:
-        logging.getLogger("dicom2sql").debug(f'Opening {path}')
-        error=0
-        try:
-            dcm_data = pydicom.dcmread(path, stop_before_pixels=True)
-        except (InvalidDicomError,):
-            logging.getLogger("dicom2sql").error(f'{path} contains error or is not a dicom')
-            return 1
-
-        except TypeError:
-            logging.getLogger("dicom2sql").warning(f'{path} is not dicom')
-            return 2
-
-        except (FileNotFoundError , OSError):
-            logging.getLogger("dicom2sql").warning(f'{path} does not exist')
-            return 3
-
-        logging.getLogger("dicom2sql").debug(f'uploading {path}')
-
-        community = path
-        try:
-            db_out.insert(dcm_data, str(community), str(path))
-        except KeyError as e:
-            logger.error(f'missing tag {e.args[0]} in file {path}')
-            return 4
-        except (sqlalchemy.exc.ProgrammingError, sqlalchemy.exc.IntegrityError) as e:
-            logger.error(f'exception occurred while inserting file {path}: {e}')
-            return 5
-        except sqlalchemy.exc.NoResultFound as e:
-            logger.error(f'Something was not found, probably because a collision happened')
-            return 6
-        logging.getLogger("dicom2sql").debug(f'uploading {path} completed')
-
-        return 0
+    exporter = start_exporter(config)
+    server_config = config["server"]
+    # The writer threads, the page fetcher and the status flusher each hold a connection
+    db_out = Database.from_config(config['database.out'],
+                                  pool_size=server_config.getint("writer_threads", 1) + 2)
+
+    # Without the pipeline option the files are parsed in threads of this process
+    use_processes = server_config.getboolean("pipeline", False)
+    pipeline = Pipeline(db_out,
+                        parse_processes=server_config.getint("parse_processes", os.cpu_count()),
+                        parse_threads=0 if use_processes else int(server_config["threads"]),
+                        writer_threads=server_config.getint("writer_threads", 1),
+                        batch_size=server_config.getint("batch_size", 100),
+                        partial_parse=config["Global"].getboolean("partial_parse", False),
+                        defer_size=get_defer_size(config),
+                        log_file=str(log_file))
 
 #    if args.init_db != '':
 #        upload_tags_description(args.init_db, db_out)
 
-
-    current_day = date.today()
-    processed_today = 0
-
-    while True:
-        time_a = perf_counter_ns()
-        data = db_out.get_new_images()
-        if not data:
-            data = db_out.get_new_images(filter_error=3)
-        print(data)
-
-        # daily rollover check
-        if date.today() != current_day:
-            #send_daily_email(processed_today)
-            processed_today = 0
-            current_day = date.today()
-
-        if not data:
-            time.sleep(int(config["server"]["wait"])*60)
-            continue
-
-        with ThreadPoolExecutor(max_workers=int(config["server"]["threads"])) as pool:
-            results = pool.map(process_file, [d[1] for d in data])
-
-        mapped_results = [(d[0],c) for d,c in zip(data,results)]
-        ok, fail = db_out.update_new_images(mapped_results)
-        logging.getLogger("dicom2sql").info(f'Completed {ok+fail} images. Failed {fail}. Correct {ok}')
-
-        print(f"Completed {ok+fail} images. Failed {fail}. Correct {ok}")
-        time_b = perf_counter_ns()
-        delta_db = time_b - time_a
-        print(f"Time of updating db: {delta_db}ns")
+    wake_file = server_config.get("wake_file", "")
+    consumer = QueueConsumer(db_out, pipeline.submit,
+                             owner=f'{socket.gethostname()}:{os.getpid()}',
+                             page_size=server_config.getint("page_size", 1000),
+                             max_in_flight=server_config.getint("max_in_flight", 200),
+                             lease=server_config.getfloat("lease", 30) * 60,
+                             poller=AdaptivePoller(min_wait=server_config.getfloat("min_wait", 1),
+                                                   max_wait=server_config.getfloat("max_wait",
+                                                                            server_config.getfloat("wait", 10) * 60),
+                                                   backoff=server_config.getfloat("backoff", 2),
+                                                   wake_file=Path(wake_file) if wake_file else None),
+                             retry_interval=server_config.getfloat("retry_interval", 10) * 60,
+                             status_batch=server_config.getint("status_batch", 100),
+                             status_interval=server_config.getfloat("status_interval", 5))
+    profiler = start_profiler(args, (db_out.engine, db_out.read_engine), on_done=consumer.stop)
+    with pipeline:
+        consumer.run()
+    if profiler:
+        profiler.close()
+        profiler.write(args.profile_output)
+    if exporter:
+        exporter.close()
@@ -2,6 +2,11 @@ import argparse
 import configparser
 import os
 import urllib.parse
+from typing import Callable
+
+from dicom2sql.filesystem.read_plan import ReadPlan, ReadPlanSource, DEFAULT_DEFER_SIZE
+from dicom2sql.profiling import add_profile_arguments
+from dicom2sql.sql.database import Database
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser \
@@ -9,9 +14,18 @@ def parse_args() -> argparse.Namespace:
                                      prog='dicom2mongo')
     parser.add_argument('--init_db', default='', help='path to csv file containing the tags to upload')
     parser.add_argument('--project', default='', help='project to be assigned to the series')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip the files whose size, mtime and inode did not change since the last crawl')
     parser.add_argument('db_url', help='Database name')
     parser.add_argument('paths', help='Paths to folders containing the dicom files', nargs='*')
+    add_profile_arguments(parser)
+
+    return parser.parse_args()
+
 
+def parse_server_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Upload the tags of the images of the queue to the database')
+    add_profile_arguments(parser)
     return parser.parse_args()
 
 
@@ -38,4 +52,14 @@ def parse_config() -> dict:
         'out_db_uri': get_db_uri(config['database.out'], os.environ.get('OUT_PASSWORD',''))
     }
     config['database.out']['out_db_uri'] = get_db_uri(config['database.out'], os.environ.get('OUT_PASSWORD',''))
-    return config
\ No newline at end of file
+    return config
+
+
+def get_defer_size(config: configparser.ConfigParser) -> str | None:
+    return config['Global'].get('defer_size', DEFAULT_DEFER_SIZE) or None
+
+
+def get_read_plan(config: configparser.ConfigParser, db: Database) -> Callable[[], ReadPlan | None] | None:
+    if not config['Global'].getboolean('partial_parse', False):
+        return None
+    return ReadPlanSource(lambda: db.searched_tags, get_defer_size(config))
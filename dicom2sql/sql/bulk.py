@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import logging
+import uuid
+from typing import TYPE_CHECKING
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, String, Boolean, select, insert, update, delete, and_, \
+    func, exists, literal, event, case, Connection
+
+from dicom2sql.metrics import metrics
+from .schema import Patient, Study, Series, Tag, TagValue, Report, FileInfo, series_project, tag_value_hash, tags_id
+
+if TYPE_CHECKING:
+    from .database import Database
+
+_sr_tag = int(tags_id["dicom_sr"], 16)
+
+PATIENT_COLUMNS = ["patient_dicom_id", "patient_name", "birth_date", "sex", "age", "weight"]
+STUDY_COLUMNS = ["study_instance_uid", "study_id", "accession_number", "study_datetime", "modality",
+                 "study_description", "community", "hospital"]
+SERIES_COLUMNS = ["series_instance_uid", "series_description"]
+FILE_COLUMNS = ["filename", "filepath", "size"]
+
+
+def _columns(table: Table, names: list[str]) -> list[Column]:
+    return [Column(name, table.c[name].type) for name in names]
+
+
+# Unindexed tables the extracted records are appended to before being merged with set based statements. They are
+# not part of the schema, the loader creates them on first use. Rows of a chunk share a load_id and are deleted in
+# the transaction that merges them.
+staging_metadata = MetaData()
+
+staging_file = Table(
+    "staging_file", staging_metadata,
+    Column("load_id", String(32)),
+    # Position of the record in the batch given to Database.insert_many
+    Column("seq", Integer),
+    *_columns(Patient.__table__, PATIENT_COLUMNS),
+    *_columns(Study.__table__, STUDY_COLUMNS),
+    *_columns(Series.__table__, SERIES_COLUMNS),
+    *_columns(FileInfo.__table__, FILE_COLUMNS),
+    Column("project_id", Integer),
+    Column("resolved_study_id", Integer),
+    Column("resolved_series_id", Integer),
+    # First copy of a file that is not stored yet, only those bring their tags and reports
+    Column("is_new", Boolean),
+)
+
+staging_tag = Table(
+    "staging_tag", staging_metadata,
+    Column("load_id", String(32)),
+    Column("seq", Integer),
+    Column("tag_id", Tag.__table__.c.tag_id.type),
+    Column("value_hash", Tag.__table__.c.value_hash.type),
+    Column("value", Tag.__table__.c.value.type),
+)
+
+staging_report = Table(
+    "staging_report", staging_metadata,
+    Column("load_id", String(32)),
+    Column("seq", Integer),
+    Column("content_hash", Report.__table__.c.content_hash.type),
+    Column("content", Report.__table__.c.content.type),
+)
+
+
+class BulkLoader:
+    # Writes the records Database.insert_many extracted in chunks of chunk_size files: the rows are appended to the
+    # staging tables with one executemany per table, then merged into patient, study, series, tag, report and
+    # file_info with a fixed number of INSERT ... SELECT statements, whatever the size of the chunk.
+    def __init__(self, db: Database, chunk_size: int = 5000) -> None:
+        self.db = db
+        self.chunk_size = chunk_size
+        with db.engine.begin() as connection:
+            staging_metadata.create_all(connection)
+        if db.engine.dialect.driver == 'pyodbc':
+            event.listen(db.engine, 'before_cursor_execute', _fast_executemany)
+
+    def load(self, pending: list, results: list[Exception | None]) -> None:
+        for start in range(0, len(pending), self.chunk_size):
+            chunk = pending[start:start + self.chunk_size]
+            try:
+                self._load_chunk(chunk, results)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                # A row written concurrently by another process breaks the set based merge, the regular path copes
+                logging.getLogger(__name__).warning(f'Bulk load of {len(chunk)} files failed ({e}), '
+                                                    f'inserting them batch by batch')
+                self.db._write_pending(chunk, results)
+
+    def _load_chunk(self, pending: list, results: list[Exception | None]) -> None:
+        load_id = uuid.uuid4().hex
+        uris = {i: record.uri for i, record, *_ in pending}
+        files, tags, reports = [], [], []
+        for i, record, patient, study, series, file, file_tags in pending:
+            files.append({"load_id": load_id, "seq": i, **patient, **study, **series, **file,
+                          "project_id": record.project_id})
+            tags.extend({"load_id": load_id, "seq": i, "tag_id": tag_id, "value_hash": tag_value_hash(value),
+                         "value": value} for tag_id, value in file_tags)
+            if _sr_tag in record.data:
+                report = Report(record.data)
+                reports.append({"load_id": load_id, "seq": i, "content_hash": report.content_hash,
+                                "content": report.content})
+
+        with self.db.engine.begin() as connection:
+            with metrics.timer(stage='staging'):
+                for table, rows in ((staging_file, files), (staging_tag, tags), (staging_report, reports)):
+                    if rows:
+                        connection.execute(insert(table), rows)
+            with metrics.timer(stage='merge'):
+                self._merge(connection, load_id)
+            for seq in connection.execute(select(staging_file.c.seq).where(
+                    staging_file.c.load_id == load_id, staging_file.c.resolved_series_id.is_(None))).scalars():
+                results[seq] = sqlalchemy.exc.NoResultFound(f'No series found for {uris[seq]}')
+            for table in (staging_file, staging_tag, staging_report):
+                connection.execute(delete(table).where(table.c.load_id == load_id))
+
+    def _merge(self, connection: Connection, load_id: str) -> None:
+        s = staging_file
+        patient, study, series = Patient.__table__, Study.__table__, Series.__table__
+        this_load = s.c.load_id == load_id
+
+        def first(*keys) -> sqlalchemy.ColumnElement:
+            # The first staged file of each distinct key, like the first record of a batch wins in insert_many
+            other = s.alias()
+            return s.c.seq.in_(select(func.min(other.c.seq)).where(other.c.load_id == load_id)
+                               .group_by(*(other.c[k.key] for k in keys)))
+
+        connection.execute(insert(patient).from_select(
+            PATIENT_COLUMNS,
+            select(*(s.c[c] for c in PATIENT_COLUMNS))
+            .where(this_load, first(s.c.patient_dicom_id),
+                   ~exists().where(patient.c.patient_dicom_id == s.c.patient_dicom_id))))
+
+        connection.execute(insert(study).from_select(
+            [*STUDY_COLUMNS, "patient_id"],
+            select(*(s.c[c] for c in STUDY_COLUMNS), patient.c.id)
+            .select_from(s.join(patient, patient.c.patient_dicom_id == s.c.patient_dicom_id))
+            .where(this_load, first(s.c.accession_number),
+                   ~exists().where(study.c.accession_number == s.c.accession_number))))
+
+        # A study stored for another patient leaves resolved_study_id empty, the file fails like in insert_many
+        connection.execute(update(s).where(this_load).values(resolved_study_id=(
+            select(study.c.id)
+            .select_from(study.join(patient, study.c.patient_id == patient.c.id))
+            .where(study.c.accession_number == s.c.accession_number,
+                   patient.c.patient_dicom_id == s.c.patient_dicom_id)
+            .scalar_subquery())))
+
+        connection.execute(insert(series).from_select(
+            [*SERIES_COLUMNS, "study_id"],
+            select(*(s.c[c] for c in SERIES_COLUMNS), s.c.resolved_study_id)
+            .where(this_load, s.c.resolved_study_id.is_not(None),
+                   first(s.c.resolved_study_id, s.c.series_instance_uid),
+                   ~exists().where(series.c.study_id == s.c.resolved_study_id,
+                                   series.c.series_instance_uid == s.c.series_instance_uid))))
+
+        connection.execute(update(s).where(this_load, s.c.resolved_study_id.is_not(None)).values(
+            resolved_series_id=select(series.c.id)
+            .where(series.c.study_id == s.c.resolved_study_id,
+                   series.c.series_instance_uid == s.c.series_instance_uid)
+            .scalar_subquery()))
+
+        connection.execute(insert(series_project).from_select(
+            ["project_id", "series_id"],
+            select(s.c.project_id, s.c.resolved_series_id).distinct()
+            .where(this_load, s.c.project_id.is_not(None), s.c.resolved_series_id.is_not(None),
+                   ~exists().where(series_project.c.project_id == s.c.project_id,
+                                   series_project.c.series_id == s.c.resolved_series_id))))
+
+        # Files replayed after resuming from a checkpoint are already stored with their tags and reports
+        file_info = FileInfo.__table__
+        connection.execute(update(s).where(this_load).values(is_new=case((and_(
+            s.c.resolved_series_id.is_not(None),
+            first(s.c.resolved_series_id, s.c.filepath, s.c.filename),
+            ~exists().where(file_info.c.series_id == s.c.resolved_series_id,
+                            file_info.c.filepath == s.c.filepath,
+                            file_info.c.filename == s.c.filename)), True), else_=False)))
+        new_file = and_(this_load, s.c.is_new)
+
+        self._merge_tags(connection, load_id, new_file)
+
+        r = staging_report
+        other_r, other_s = r.alias(), s.alias()
+        first_report = r.c.seq.in_(
+            select(func.min(other_r.c.seq))
+            .select_from(other_r.join(other_s, and_(other_s.c.load_id == other_r.c.load_id,
+                                                    other_s.c.seq == other_r.c.seq)))
+            .where(other_r.c.load_id == load_id, other_s.c.is_new)
+            .group_by(other_s.c.resolved_study_id, other_r.c.content_hash))
+        report = Report.__table__
+        connection.execute(insert(report).from_select(
+            ["text", "study_id", "content_hash", "content"],
+            select(literal(""), s.c.resolved_study_id, r.c.content_hash, r.c.content)
+            .select_from(r.join(s, and_(s.c.load_id == r.c.load_id, s.c.seq == r.c.seq)))
+            .where(r.c.load_id == load_id, new_file, first_report,
+                   ~exists().where(report.c.study_id == s.c.resolved_study_id,
+                                   report.c.content_hash == r.c.content_hash))))
+
+        connection.execute(insert(file_info).from_select(
+            [*FILE_COLUMNS, "series_id"],
+            select(*(s.c[c] for c in FILE_COLUMNS), s.c.resolved_series_id).where(new_file).order_by(s.c.seq)))
+
+    def _merge_tags(self, connection: Connection, load_id: str, new_file) -> None:
+        s, t = staging_file, staging_tag
+        tag = Tag.__table__
+        staged_tags = t.join(s, and_(s.c.load_id == t.c.load_id, s.c.seq == t.c.seq))
+        missing_tag = ~exists().where(tag.c.series_id == s.c.resolved_series_id, tag.c.tag_id == t.c.tag_id,
+                                      tag.c.value_hash == t.c.value_hash)
+        keys = (s.c.resolved_series_id, t.c.tag_id, t.c.value_hash)
+
+        if not self.db.intern_tag_values:
+            connection.execute(insert(tag).from_select(
+                ["series_id", "tag_id", "value_hash", "value"],
+                select(*keys, func.min(t.c.value)).select_from(staged_tags)
+                .where(t.c.load_id == load_id, new_file, missing_tag).group_by(*keys)))
+            return
+
+        tag_value = TagValue.__table__
+        connection.execute(insert(tag_value).from_select(
+            ["value", "value_hash"],
+            select(func.min(t.c.value), t.c.value_hash).select_from(staged_tags)
+            .where(t.c.load_id == load_id, new_file, missing_tag,
+                   ~exists().where(tag_value.c.value_hash == t.c.value_hash))
+            .group_by(t.c.value_hash)))
+        connection.execute(insert(tag).from_select(
+            ["series_id", "tag_id", "value_hash", "value", "value_id"],
+            select(*keys, literal(""), tag_value.c.id)
+            .select_from(staged_tags.join(tag_value, tag_value.c.value_hash == t.c.value_hash))
+            .where(t.c.load_id == load_id, new_file, missing_tag)
+            .group_by(*keys, tag_value.c.id)))
+
+
+def _fast_executemany(conn, cursor, statement, parameters, context, executemany) -> None:
+    # pyodbc sends the rows of an executemany one round trip each unless asked to pack them
+    if executemany and statement.startswith('INSERT INTO staging_'):
+        cursor.fast_executemany = True
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Hashable, Any
+
+EVICTION_POLICIES = ('lru', 'fifo')
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 10000, eviction: str = 'lru') -> None:
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f'Unknown eviction policy {eviction}, expected one of {EVICTION_POLICIES}')
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        if self.maxsize <= 0:
+            return None
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None and self.eviction == 'lru':
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if key in self._items:
+                self._items[key] = value
+                if self.eviction == 'lru':
+                    self._items.move_to_end(key)
+                return
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SeenTags(LRUCache):
+    # series.id -> set of (tag_id, value_hash) stored for the series, put adds to the set already cached
+    def put(self, key: Hashable, value: set) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            seen = self._items.get(key)
+            if seen is not None:
+                seen.update(value)
+                return
+        super().put(key, set(value))
+
+
+class KeyCache:
+    def __init__(self, maxsize: int = 10000, eviction: str = 'lru', seen_tags_size: int = 1000) -> None:
+        # patient_dicom_id -> patient.id
+        self.patients = LRUCache(maxsize, eviction)
+        # (patient_id, accession_number) -> study.id
+        self.studies = LRUCache(maxsize, eviction)
+        # (study_id, series_instance_uid) -> series.id
+        self.series = LRUCache(maxsize, eviction)
+        # value_hash -> tag_value.id
+        self.values = LRUCache(maxsize, eviction)
+        # series.id -> {(tag_id, value_hash)}, sized in series
+        self.tags = SeenTags(seen_tags_size, eviction)
+
+    def clear(self) -> None:
+        self.patients.clear()
+        self.studies.clear()
+        self.series.clear()
+        self.values.clear()
+        self.tags.clear()
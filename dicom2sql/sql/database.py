@@ -1,35 +1,107 @@
-import json
+import configparser
 import logging
+import uuid
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from time import perf_counter_ns
-from typing import TypedDict, List, NotRequired, Tuple, Sequence
+from time import monotonic
+from typing import TypedDict, List, NotRequired, Tuple, Sequence, NamedTuple
 
 import sqlalchemy
 from pydicom.dataset import Dataset
 from sqlalchemy import create_engine, text, insert, bindparam, delete, update, Row
-from sqlalchemy import select
+from sqlalchemy import select, or_
 from sqlalchemy.orm import sessionmaker
 
-from .schema import TagDescriptor, Patient, Study, Series, tags_id, FileInfo, Base, Tag, Report, Project, ImageQueue
+from dicom2sql.metrics import metrics
+from .bulk import BulkLoader
+from .cache import KeyCache, LRUCache
+from .extract import ExtractionPlan
+from .migrate import upgrade, intern_tag_values
+from .sqlite import SqliteProfile, is_sqlite_file
+from .schema import TagDescriptor, Patient, Study, Series, tags_id, FileInfo, Base, Tag, Report, Project, ImageQueue, \
+    series_project, tag_value_hash, TagValue, WIDE_TABLE
+from .upsert import insert_missing
+from .wide import refresh_wide
+
+
+_sr_tag = int(tags_id["dicom_sr"], 16)
 
 
 class DicomTagDict(TypedDict):
     tag: str
     tag_description: str
     name: str
+    # bool, or the text of a csv column: 1, true or yes
+    pivoted: NotRequired[bool | str]
     tag_object: NotRequired[TagDescriptor]
 
 
+class FileRecord(NamedTuple):
+    data: Dataset
+    community: str
+    uri: str
+    project_id: int | None = None
+    size: int | None = None
+
+
+def queue_error_is(error: int | None):
+    # IS only compares with NULL outside of SQLite
+    return ImageQueue.error.is_(None) if error is None else ImageQueue.error == error
+
+
 class Database:
-    def __init__(self, url: str, pool_size: int=5):
+    def __init__(self, url: str, pool_size: int=5, cache_size: int=10000, cache_eviction: str='lru',
+                 tags_refresh_interval: float=300, seen_tags_size: int=1000, intern_tag_values: bool=False,
+                 sqlite: SqliteProfile | None=None, bulk_load: bool=False, bulk_chunk_size: int=5000,
+                 wide_refresh_interval: float=0):
         self.engine = create_engine(url, pool_size=pool_size)
+        self.read_engine = self.engine
+        if is_sqlite_file(url):
+            sqlite = sqlite or SqliteProfile()
+            if sqlite.single_writer:
+                # Writes queue for the only connection of engine, reads use their own pool
+                self.engine = create_engine(url, pool_size=1, max_overflow=0, pool_timeout=sqlite.busy_timeout)
+                sqlite.configure(self.read_engine, writer=False)
+            sqlite.configure(self.engine, writer=True)
         self.session_factory = sessionmaker(bind=self.engine)
+        self.read_session_factory = sessionmaker(bind=self.read_engine)
+        self.key_cache = KeyCache(cache_size, cache_eviction, seen_tags_size)
+        # Store each distinct tag value once in tag_value, the tag rows refer to it by id
+        self.intern_tag_values = intern_tag_values
         self._is_tags_dirty = True
         self._searched_tags = None
+        # Tag descriptors can be changed by another process, reload them every tags_refresh_interval seconds
+        self.tags_refresh_interval = tags_refresh_interval
+        self._tags_loaded_at = 0.0
+        self._extraction_plan: ExtractionPlan | None = None
+        self._plan_tags = None
+        # Seconds between refreshes of series_wide by insert_many, 0 leaves it to refresh_series_wide
+        self.wide_refresh_interval = wide_refresh_interval
+        self._wide_refreshed_at = monotonic()
         with self.engine.begin() as connection:
             Base.metadata.create_all(connection)
+            upgrade(connection)
+        # Merge the batches through staging tables with set based statements instead of row by row
+        self.bulk_loader = BulkLoader(self, bulk_chunk_size) if bulk_load else None
+
+    @classmethod
+    def from_config(cls, db_config: configparser.SectionProxy, **kwargs) -> "Database":
+        return cls(db_config['out_db_uri'],
+                   cache_size=db_config.getint('cache_size', 10000),
+                   cache_eviction=db_config.get('cache_eviction', 'lru'),
+                   tags_refresh_interval=db_config.getfloat('tags_refresh_interval', 300),
+                   seen_tags_size=db_config.getint('seen_tags_size', 1000),
+                   intern_tag_values=db_config.getboolean('intern_tag_values', False),
+                   sqlite=SqliteProfile.from_config(db_config),
+                   bulk_load=db_config.getboolean('bulk_load', False),
+                   bulk_chunk_size=db_config.getint('bulk_chunk_size', 5000),
+                   wide_refresh_interval=db_config.getfloat('wide_refresh_interval', 0),
+                   **kwargs)
+
+    def dispose(self) -> None:
+        self.engine.dispose()
+        self.read_engine.dispose()
 
     @staticmethod
     def check_identifiers(data: Dataset) -> bool:
@@ -53,127 +125,325 @@ class Database:
 
             return project.id
 
-    def insert(self, data: Dataset, community: str, uri: str, project_id:int=None) -> None:
-        community = community[:25]
-        logger = logging.getLogger(__name__)
-        if self.check_identifiers(data):
-            logger.warning(f'File {uri} could not be processed. Accession number or patient id is null')
-            return
+    def insert(self, data: Dataset, community: str, uri: str, project_id:int=None, size: int | None=None) -> None:
+        error = self.insert_many([FileRecord(data, community, uri, project_id, size)])[0]
+        if error is not None:
+            raise error
 
-        time_a = perf_counter_ns()
-        with self.session_factory() as session:
-            try:
-                patient = Patient(data)
-                session.add(patient)
-                session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                session.rollback()
-                patient = session.execute(
-                    select(Patient).where(Patient.patient_dicom_id == data[tags_id["patient_dicom_id"]].value)
-                ).scalar_one()
-
-            try:
-                study = Study(data, community)
-                study.patient = patient
-                session.add(study)
-                session.commit()
-            except sqlalchemy.exc.IntegrityError :
-                session.rollback()
-                study = session.execute(
-                    select(Study).where(
-                        Study.patient_id == patient.id,
-                        Study.accession_number == data[tags_id["accession_number"]].value
-                    )
-                ).scalar_one()
-
-            try:
-                series = Series(data)
-                series.study = study
-                session.add(series)
-                session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                session.rollback()
-                series = session.execute(
-                    select(Series).where(
-                        Series.study_id == study.id,
-                        Series.series_instance_uid == data[tags_id["series_instance_uid"]].value
-                    )
-                ).scalar_one()
-
-            if project_id:
-                select_statement = select(Project).where(Project.id == project_id)
-                project = session.execute(select_statement).scalars().first()
-                if project not in series.projects:
-                    series.projects.append(project)
-
-
-            existing_tags = defaultdict(list)
-            for t in series.tags:
-                existing_tags[t.tag_id].append(t.value)
-
-            tags = []
-            for element in data:
-                tag_id = f"{int(element.tag):08X}"
-                if not element.value:
-                    continue
-                if tag_id not in self.searched_tags:
-                    logger.info(f'Tag {tag_id} not found in searched tags')
-                    continue
-                if tag_id in existing_tags and element.value in existing_tags[tag_id]:
+    def insert_many(self, records: Sequence[FileRecord]) -> list[Exception | None]:
+        logger = logging.getLogger(__name__)
+        results: list[Exception | None] = [None] * len(records)
+
+        plan = self.extraction_plan
+        pending = []
+        with metrics.timer(stage='extract'):
+            for i, record in enumerate(records):
+                if self.check_identifiers(record.data):
+                    logger.warning(f'File {record.uri} could not be processed. Accession number or patient id is null')
                     continue
-
-                tag = {"value": str(element.value)[:Tag.value.type.length],
-                       "tag_id": tag_id,
-                       "series_id": series.id}
-                tags.append(tag)
+                try:
+                    file_uri = Path(record.uri)
+                    pending.append((i, record,
+                                    plan.patient(record.data),
+                                    plan.study(record.data, record.community[:25]),
+                                    plan.series(record.data),
+                                    {"filename": file_uri.name, "filepath": str(file_uri.parent),
+                                     "size": record.size if record.size is not None else file_uri.stat().st_size},
+                                    plan.tags(record.data)))
+                except (KeyError, ValueError, TypeError, OSError) as e:
+                    results[i] = e
+
+        if pending:
+            if self.bulk_loader:
+                self.bulk_loader.load(pending, results)
+            else:
+                self._write_pending(pending, results)
+        if self.wide_refresh_interval and monotonic() - self._wide_refreshed_at > self.wide_refresh_interval:
+            try:
+                self.refresh_series_wide()
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                logger.error(f'Refreshing {WIDE_TABLE} failed: {e}')
+        if metrics.enabled:
+            failed = sum(e is not None for e in results)
+            metrics.inc('dicom2sql_files_total', len(results) - failed, result='ok')
+            metrics.inc('dicom2sql_files_total', failed, result='error')
+            metrics.inc('dicom2sql_batches_total')
+        return results
+
+    def _write_pending(self, pending: list, results: list[Exception | None]) -> None:
+        logger = logging.getLogger(__name__)
+        try:
+            self._write_batch(pending, results)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            if len(pending) == 1:
+                results[pending[0][0]] = e
+                return
+            logger.warning(f'Batch insert of {len(pending)} files failed ({e}), retrying one by one')
+            for p in pending:
+                try:
+                    self._write_batch([p], results)
+                except sqlalchemy.exc.SQLAlchemyError as e:
+                    results[p[0]] = e
+
+    def _write_batch(self, pending: list, results: list[Exception | None]) -> None:
+        staged = []
+        try:
+            with self.session_factory() as session:
+                self._insert_batch(session, pending, results, staged)
+                with metrics.timer(stage='commit'):
+                    session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # A cached key may point to a row that was deleted behind our back
+            self.key_cache.clear()
+            raise
+        # Only cache the keys once the transaction that created them is committed
+        for cache, key, value in staged:
+            cache.put(key, value)
+
+    def _insert_batch(self, session, pending: list, results: list[Exception | None], staged: list) -> None:
+        with metrics.timer(stage='hierarchy'):
+            pending = self._resolve_hierarchy(session, pending, results, staged)
+        series_ids = {file["series_id"] for *_, file, _ in pending}
+
+        project_links = {(r.project_id, file["series_id"]) for _, r, *_, file, _ in pending if r.project_id}
+        if project_links:
+            project_links -= {tuple(r) for r in session.execute(
+                select(series_project.c.project_id, series_project.c.series_id)
+                .where(series_project.c.series_id.in_(series_ids))
+            )}
+        if project_links:
+            session.execute(insert(series_project),
+                            [{"project_id": p, "series_id": s} for p, s in project_links])
+
+        # Files replayed after resuming from a checkpoint are already stored with their tags and reports
+        seen_files = {tuple(r) for r in session.execute(
+            select(FileInfo.series_id, FileInfo.filepath, FileInfo.filename)
+            .where(FileInfo.series_id.in_(series_ids),
+                   FileInfo.filename.in_({file["filename"] for *_, file, _ in pending}))
+        )}
+        tags = {}
+        reports = {}
+        files = []
+        for _, record, _, _, series, file, file_tags in pending:
+            series_id = file["series_id"]
+            if (series_id, file["filepath"], file["filename"]) in seen_files:
+                continue
+            seen_files.add((series_id, file["filepath"], file["filename"]))
+
+            # The unique index skips the values the series already has, the cache only saves sending them
+            seen_tags = self.key_cache.tags.get(series_id) or ()
+            for tag_id, value in file_tags:
+                key = (tag_id, tag_value_hash(value))
+                if key not in seen_tags:
+                    tags.setdefault((series_id, *key), value)
+
+            if _sr_tag in record.data:
+                report = Report(record.data)
+                reports.setdefault((series["study_id"], report.content_hash), report.content)
+
+            files.append(file)
+
+        with metrics.timer(stage='tags'):
             if tags:
-                session.execute(insert(Tag),tags)
-
-            if tags_id["dicom_sr"] in data:
-                json_data = data.to_json_dict()[tags_id["dicom_sr"]]
-                report = Report(text=json.dumps(json_data))
-                report.study = study
-                session.add(report)
-
-            file_uri = Path(uri)
-            file = FileInfo(filename=file_uri.name, filepath=str(file_uri.parent), size=file_uri.stat().st_size)
-            file.series = series
-
-            session.add(file)
+                rows = [{"series_id": s, "tag_id": t, "value_hash": h, "value": v, "value_id": None}
+                        for (s, t, h), v in tags.items()]
+                if self.intern_tag_values:
+                    values = {h: {"value": v, "value_hash": h} for (_, _, h), v in tags.items()}
+                    value_ids = self._resolve_ids(
+                        session, TagValue.__table__, values, self.key_cache.values, ["value_hash"], ["value_hash"],
+                        lambda keys: select(TagValue.id, TagValue.value_hash).where(TagValue.value_hash.in_(keys)),
+                        staged)
+                    for row in rows:
+                        # A value that could not be interned is kept in the tag row, tag_full reads both
+                        if row["value_hash"] in value_ids:
+                            row.update(value_id=value_ids[row["value_hash"]], value='')
+                insert_missing(session, Tag.__table__, rows, ["series_id", "tag_id", "value_hash"])
+                stored = defaultdict(set)
+                for series_id, tag_id, value_hash in tags:
+                    stored[series_id].add((tag_id, value_hash))
+                staged.extend((self.key_cache.tags, series_id, keys) for series_id, keys in stored.items())
+        insert_missing(session, Report.__table__,
+                       [{"text": "", "study_id": s, "content_hash": h, "content": c} for (s, h), c in reports.items()],
+                       ["study_id", "content_hash"])
+        if files:
+            session.execute(insert(FileInfo.__table__), files)
+
+    def _resolve_hierarchy(self, session, pending: list, results: list[Exception | None], staged: list) -> list:
+        patients = {}
+        for _, _, patient, *_ in pending:
+            patients.setdefault(patient["patient_dicom_id"], patient)
+        patients = self._resolve_ids(
+            session, Patient.__table__, patients, self.key_cache.patients, ["patient_dicom_id"],
+            ["patient_dicom_id"],
+            lambda keys: select(Patient.id, Patient.patient_dicom_id).where(Patient.patient_dicom_id.in_(keys)),
+            staged)
+        pending = self._drop_failed(pending, results, lambda p: patients[p[2]["patient_dicom_id"]])
+
+        studies = {}
+        for _, _, patient, study, *_ in pending:
+            study["patient_id"] = patients[patient["patient_dicom_id"]]
+            studies.setdefault((study["patient_id"], study["accession_number"]), study)
+        studies = self._resolve_ids(
+            session, Study.__table__, studies, self.key_cache.studies, ["accession_number"],
+            ["patient_id", "accession_number"],
+            lambda keys: select(Study.id, Study.patient_id, Study.accession_number)
+            .where(Study.accession_number.in_([k[1] for k in keys])),
+            staged)
+        pending = self._drop_failed(pending, results,
+                                    lambda p: studies[(p[3]["patient_id"], p[3]["accession_number"])])
+
+        series_rows = {}
+        for _, _, _, study, series, *_ in pending:
+            series["study_id"] = studies[(study["patient_id"], study["accession_number"])]
+            series_rows.setdefault((series["study_id"], series["series_instance_uid"]), series)
+        series_rows = self._resolve_ids(
+            session, Series.__table__, series_rows, self.key_cache.series, ["study_id", "series_instance_uid"],
+            ["study_id", "series_instance_uid"],
+            lambda keys: select(Series.id, Series.study_id, Series.series_instance_uid)
+            .where(Series.study_id.in_({k[0] for k in keys}),
+                   Series.series_instance_uid.in_({k[1] for k in keys})),
+            staged)
+        pending = self._drop_failed(pending, results,
+                                    lambda p: series_rows[(p[4]["study_id"], p[4]["series_instance_uid"])])
+
+        for _, _, _, _, series, file, _ in pending:
+            file["series_id"] = series_rows[(series["study_id"], series["series_instance_uid"])]
+        return pending
+
+    def refresh_series_wide(self) -> int:
+        self._wide_refreshed_at = monotonic()
+        with metrics.timer(stage='wide'), self.engine.begin() as connection:
+            return refresh_wide(connection)
+
+    def move_tag_values(self) -> int:
+        # One transaction per chunk, so a big table is not locked until the end
+        moved = 0
+        while True:
+            with self.engine.begin() as connection:
+                chunk = intern_tag_values(connection)
+            if not chunk:
+                return moved
+            moved += chunk
+            logging.getLogger(__name__).info(f'Interned the values of {moved} tags')
 
-            try:
-                session.commit()
-            except sqlalchemy.exc.IntegrityError as e:
-                session.rollback()
-                raise e
+    @staticmethod
+    def _resolve_ids(session, table, rows: dict, cache: LRUCache, conflict_columns: list[str],
+                     key_columns: list[str], select_existing, staged: list) -> dict:
+        resolved = {}
+        for k in rows:
+            cached = cache.get(k)
+            if cached is not None:
+                resolved[k] = cached
+        lookup = [k for k in rows if k not in resolved]
+        if not lookup:
+            return resolved
+
+        def select_ids(keys: list) -> dict:
+            found = {}
+            for row in session.execute(select_existing(keys)):
+                key = row[1] if len(row) == 2 else tuple(row[1:])
+                if key in rows:
+                    found[key] = row[0]
+            return found
+
+        found = select_ids(lookup)
+        missing = [k for k in lookup if k not in found]
+        if missing:
+            # The ids of the inserted rows come back with RETURNING (OUTPUT on mssql), only the rows another
+            # worker inserted meanwhile or that collided are selected again
+            inserted = insert_missing(session, table,
+                                      [{c.key: rows[k].get(c.key) for c in table.columns if not c.primary_key}
+                                       for k in missing],
+                                      conflict_columns, [table.c.id, *(table.c[c] for c in key_columns)])
+            for row in inserted:
+                key = row[1] if len(row) == 2 else tuple(row[1:])
+                if key in rows:
+                    found[key] = row[0]
+            missing = [k for k in missing if k not in found]
+            if missing:
+                found.update(select_ids(missing))
+
+        for k in lookup:
+            if k in found:
+                resolved[k] = found[k]
+                staged.append((cache, k, found[k]))
+            else:
+                # The row collided with an existing row on a column outside the key
+                resolved[k] = sqlalchemy.exc.NoResultFound(f'No {table.name} found for {k}')
+        return resolved
 
+    @staticmethod
+    def _drop_failed(pending: list, results: list[Exception | None], resolved_of) -> list:
+        remaining = []
+        for p in pending:
+            resolved = resolved_of(p)
+            if isinstance(resolved, Exception):
+                results[p[0]] = resolved
+            else:
+                remaining.append(p)
+        return remaining
 
     def get_tags_list(self) -> set:
-        with self.session_factory() as session:
-
-            return { t.id.upper()
-                    for t in session.execute(select(TagDescriptor)).scalars().all()}
+        with self.read_session_factory() as session:
+            return {tag_id.upper() for tag_id in session.execute(select(TagDescriptor.id)).scalars()}
 
     def set_tags_list(self, tag_list: List[DicomTagDict]) -> None:
-        tag_list = [t for t in tag_list if not t['tag'] in set(tags_id.items())]
+        # Tags stored in the columns of patient, study and series are not extracted again
+        excluded = set(tags_id.values())
+        descriptors = {}
+        for t in tag_list:
+            tag_id = t['tag'].upper()
+            if tag_id not in excluded:
+                descriptors[tag_id] = t
+        name_length = TagDescriptor.name.type.length
+        description_length = TagDescriptor.description.type.length
+
         with self.session_factory() as sess:
-            for t in tag_list:
-
-                select_statement = select(TagDescriptor).where(TagDescriptor.id == t['tag'] )
-                tag = sess.execute(select_statement).scalars().first()
-                if not tag:
-                    tag = TagDescriptor(id=t['tag'], name=t['name'], description=t['tag_description'])
-                else:
-                    tag.name= t['name']
-                    tag.description = t['tag_description']
-                sess.add(tag)
+            existing = {row.id.upper(): row for row in sess.execute(
+                select(TagDescriptor.id, TagDescriptor.name, TagDescriptor.description, TagDescriptor.pivoted))}
+            new_rows, changed_rows = [], []
+            for tag_id, t in descriptors.items():
+                row = {"id": tag_id, "name": t['name'][:name_length],
+                       "description": t['tag_description'][:description_length]}
+                pivoted = t.get('pivoted')
+                if isinstance(pivoted, str):
+                    pivoted = pivoted.strip().lower() in ('1', 'true', 'yes')
+                if tag_id not in existing:
+                    new_rows.append({**row, "pivoted": bool(pivoted)})
+                    continue
+                old = existing[tag_id]
+                if pivoted is None:
+                    pivoted = old.pivoted
+                if (old.name, old.description, old.pivoted) != (row["name"], row["description"], pivoted):
+                    changed_rows.append({**row, "pivoted": pivoted, "b_id": old.id})
+            insert_missing(sess, TagDescriptor.__table__, new_rows, ["id"])
+            if changed_rows:
+                table = TagDescriptor.__table__
+                sess.execute(update(table).where(table.c.id == bindparam("b_id"))
+                             .values(name=bindparam("name"), description=bindparam("description"),
+                                     pivoted=bindparam("pivoted")),
+                             changed_rows)
             sess.commit()
+        logging.getLogger(__name__).info(f'Added {len(new_rows)} and updated {len(changed_rows)} tag descriptors')
         self._is_tags_dirty = True
 
+    @property
+    def extraction_plan(self) -> ExtractionPlan:
+        searched_tags = self.searched_tags
+        if self._extraction_plan is None or self._plan_tags is not searched_tags:
+            self._extraction_plan = ExtractionPlan(searched_tags, Tag.value.type.length)
+            self._plan_tags = searched_tags
+        return self._extraction_plan
+
     @property
     def searched_tags(self) -> set:
-        if self._searched_tags is None or self._is_tags_dirty:
-            self._searched_tags = self.get_tags_list()
+        if (self._searched_tags is None or self._is_tags_dirty
+                or monotonic() - self._tags_loaded_at > self.tags_refresh_interval):
+            tags = self.get_tags_list()
+            # Keep the same object while nothing changes so callers can cheaply detect a new tag list
+            if tags != self._searched_tags:
+                self._searched_tags = tags
+            self._tags_loaded_at = monotonic()
             self._is_tags_dirty = False
         return self._searched_tags
 
@@ -181,10 +451,10 @@ class Database:
     def get_new_images(self,limit:int=1000, wait:int=1, filter_error=None) -> Sequence[Row[tuple[int, str]]]:
         cutoff = datetime.now() - timedelta(days=wait)
 
-        with self.session_factory() as sess:
+        with self.read_session_factory() as sess:
             stmt = (
                 select(ImageQueue.id, ImageQueue.path)
-                .where(ImageQueue.error.is_(filter_error),
+                .where(queue_error_is(filter_error),
                         ImageQueue.insert_date < cutoff)
                 .order_by(ImageQueue.insert_date)
                 .limit(limit)
@@ -192,21 +462,76 @@ class Database:
 
             return sess.execute(stmt).all()
 
-    def update_new_images(self, status: list) -> tuple[int,int]:
+    def claim_new_images(self, owner: str, limit: int=1000, wait: int=1, filter_error=None,
+                         lease: float=1800) -> tuple[str, Sequence[Row[tuple[int, str]]]]:
+        # Leases the rows to this claim so several servers can drain the same queue. The update only
+        # takes rows that are still free, so on databases without row locks a concurrent claim just
+        # gets fewer rows. Rows of a crashed server are claimed again once their lease expires.
+        token = f'{owner[:67]}:{uuid.uuid4().hex}'
+        now = datetime.now()
+        cutoff = now - timedelta(days=wait)
+        free = or_(ImageQueue.lease_expires.is_(None), ImageQueue.lease_expires < now)
+
+        with self.session_factory() as sess:
+            candidates = sess.execute(
+                select(ImageQueue.id)
+                .where(queue_error_is(filter_error),
+                       ImageQueue.insert_date < cutoff,
+                       free)
+                .order_by(ImageQueue.insert_date)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            if not candidates:
+                sess.rollback()
+                return token, []
+
+            sess.execute(
+                update(ImageQueue)
+                .where(ImageQueue.id.in_(candidates), free)
+                .values(lease_owner=token, lease_expires=now + timedelta(seconds=lease))
+                .execution_options(synchronize_session=False)
+            )
+            sess.commit()
+
+            # Only the candidates can carry the token, their ids keep the read back on the primary key
+            return token, sess.execute(
+                select(ImageQueue.id, ImageQueue.path)
+                .where(ImageQueue.id.in_(candidates), ImageQueue.lease_owner == token)
+                .order_by(ImageQueue.insert_date)
+            ).all()
+
+    def renew_lease(self, token: str, lease: float=1800) -> int:
+        # Pushes back the expiry of the rows of a claim that are still waiting for their status
+        with self.session_factory() as sess:
+            result = sess.execute(
+                update(ImageQueue)
+                .where(ImageQueue.lease_owner == token)
+                .values(lease_expires=datetime.now() + timedelta(seconds=lease))
+                .execution_options(synchronize_session=False)
+            )
+            sess.commit()
+            return result.rowcount
+
+    def update_new_images(self, status: list, token: str | None = None) -> tuple[int,int]:
+        # With the token of the claim, rows whose lease was taken over by another server are left alone
+        queue = ImageQueue.__table__
+        owned = queue.c.lease_owner == token if token is not None else sqlalchemy.true()
         with self.session_factory() as sess:
             delete_ids = [i for i, code in status if code == 0]
-            update_map = [{"id": i, "error": code, "insert_date":datetime.now()} for i, code in status if code != 0]
-            print(f'update_map = {update_map}')
-            print(f'delete_ids = {delete_ids}')
+            update_map = [{"b_id": i, "error": code, "insert_date": datetime.now()} for i, code in status if code != 0]
+            logging.getLogger("dicom2sql").debug(f'Deleting {len(delete_ids)} and updating {len(update_map)} queued images')
             if delete_ids:
                 sess.execute(
-                    delete(ImageQueue)
-                    .where(ImageQueue.id.in_(delete_ids))
+                    delete(queue)
+                    .where(queue.c.id.in_(delete_ids), owned)
                 )
 
             if update_map:
                 sess.execute(
-                    update(ImageQueue),
+                    update(queue)
+                    .where(queue.c.id == bindparam("b_id"), owned)
+                    .values(lease_owner=None, lease_expires=None),
                     update_map
                 )
             sess.commit()
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import datetime
+import logging
+from functools import lru_cache
+from typing import Iterable, Any
+
+from pydicom.dataset import Dataset
+
+from .schema import tags_id, convert_datetime
+
+# Integer keys of the tags the hierarchy tables are built from
+_tags = {name: int(tag, 16) for name, tag in tags_id.items()}
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value: str) -> datetime.datetime | datetime.date:
+    try:
+        return datetime.datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        date = datetime.datetime.fromtimestamp(0).date()
+        logging.getLogger(__name__).error(f"date {value} is in incorrect format, inserting {date} instead")
+        return date
+
+
+# Most files of a batch share the study date and time
+parse_datetime = lru_cache(maxsize=4096)(convert_datetime)
+
+
+def _value(data: Dataset, name: str) -> Any:
+    # Raises KeyError like Dataset.__getitem__ when a required tag is missing
+    element = data.get(_tags[name])
+    if element is None:
+        raise KeyError(tags_id[name])
+    return element.value
+
+
+def _optional(data: Dataset, name: str) -> Any | None:
+    element = data.get(_tags[name])
+    return element.value if element is not None else None
+
+
+class ExtractionPlan:
+    # Turns a dataset into the column values of the patient, study, series and tag tables. The searched
+    # tags are resolved to integer keys once, and each dataset is matched against them from the smaller side.
+    def __init__(self, searched_tags: Iterable[str], value_length: int) -> None:
+        self.value_length = value_length
+        searched = []
+        for tag_id in searched_tags:
+            try:
+                searched.append((int(tag_id, 16), tag_id))
+            except ValueError:
+                logging.getLogger(__name__).warning(f'Ignoring tag {tag_id}, it is not an hexadecimal dicom tag')
+        self.searched = sorted(searched)
+        self.tag_ids = dict(searched)
+
+    @staticmethod
+    def patient(data: Dataset) -> dict:
+        birth_date = _optional(data, "birth_date")
+        sex = _optional(data, "sex")
+        return {
+            "patient_dicom_id": str(_value(data, "patient_dicom_id")),
+            "patient_name": str(_value(data, "patient_name")),
+            "birth_date": parse_date(birth_date) if birth_date is not None else None,
+            "sex": str(sex[:1]) if sex is not None else None,
+            "age": _optional(data, "age"),
+            "weight": _optional(data, "weight"),
+        }
+
+    @staticmethod
+    def study(data: Dataset, community: str) -> dict:
+        accession_number = str(_value(data, "accession_number"))
+        study_id = _optional(data, "study_id")
+        modality = _optional(data, "modality")
+        description = _optional(data, "study_description")
+        study_date = _optional(data, "study_date")
+        return {
+            "study_instance_uid": str(_value(data, "study_instance_uid")),
+            "study_id": str(study_id) if study_id is not None else None,
+            "accession_number": accession_number,
+            "study_datetime": parse_datetime(study_date, _value(data, "study_time")) if study_date is not None else None,
+            "modality": str(modality) if modality is not None else None,
+            "study_description": str(description) if description is not None else None,
+            "community": community,
+            "hospital": accession_number[0:5],
+        }
+
+    @staticmethod
+    def series(data: Dataset) -> dict:
+        description = _optional(data, "series_description")
+        return {
+            "series_instance_uid": str(_value(data, "series_instance_uid")),
+            "series_description": str(description) if description is not None else None,
+        }
+
+    def tags(self, data: Dataset) -> list[tuple[str, str]]:
+        tag_ids = self.tag_ids
+        if len(data) < len(tag_ids):
+            # Thousands of descriptors are searched when the whole dictionary is loaded, a file has a few hundred
+            searched = sorted((tag, tag_ids[tag]) for tag in data.keys() if tag in tag_ids)
+        else:
+            searched = self.searched
+        values = []
+        for tag, tag_id in searched:
+            element = data.get(tag)
+            if element is None or not element.value:
+                continue
+            values.append((tag_id, str(element.value)[:self.value_length]))
+        return values
@@ -0,0 +1,179 @@
+import logging
+
+from sqlalchemy import Connection, inspect, select, func, update, delete, insert, text, bindparam
+from sqlalchemy.schema import CreateColumn
+
+from sqlalchemy.orm import Session
+
+from .schema import Base, Series, Tag, TagValue, Report, FileInfo, series_project, tag_value_hash, TAG_VIEW, tag_view_select
+from .upsert import insert_missing
+
+# Rows read at once while backfilling a new column
+BACKFILL_CHUNK = 10000
+
+
+def upgrade(connection: Connection) -> None:
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {c['name']: c for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                add_column(connection, table.name, column)
+            elif _is_shorter(existing_columns[column.name]['type'], column.type):
+                widen_column(connection, table.name, column)
+
+        existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if index.name == "ix_series_study_id_series_instance_uid":
+                merge_duplicate_series(connection)
+            if index.name == "ix_tag_series_id_tag_id_value_hash":
+                backfill_tag_hashes(connection)
+                delete_duplicates(connection, Tag.__table__, ['series_id', 'tag_id', 'value_hash'])
+            if index.name == "ix_report_study_id_content_hash":
+                compress_reports(connection)
+                delete_duplicates(connection, Report.__table__, ['study_id', 'content_hash'])
+            logging.getLogger(__name__).warning(f'Creating missing index {index.name} on {table.name}')
+            index.create(connection)
+
+    if TAG_VIEW not in inspector.get_view_names():
+        create_tag_view(connection)
+
+
+def create_tag_view(connection: Connection) -> None:
+    # tag with the interned values resolved, so queries do not depend on the storage mode
+    view = tag_view_select().compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    connection.execute(text(f'CREATE VIEW {connection.dialect.identifier_preparer.quote(TAG_VIEW)} AS {view}'))
+
+
+def add_column(connection: Connection, table_name: str, column) -> None:
+    logging.getLogger(__name__).warning(f'Adding missing column {column.name} to {table_name}')
+    column_ddl = CreateColumn(column).compile(dialect=connection.dialect)
+    add = 'ADD' if connection.dialect.name == 'mssql' else 'ADD COLUMN'
+    connection.execute(text(f'ALTER TABLE {connection.dialect.identifier_preparer.quote(table_name)} {add} {column_ddl}'))
+
+
+def _is_shorter(existing, wanted) -> bool:
+    length = getattr(existing, 'length', None)
+    return length is not None and getattr(wanted, 'length', None) is not None and length < wanted.length
+
+
+def widen_column(connection: Connection, table_name: str, column) -> None:
+    # SQLite does not enforce the length of a VARCHAR
+    if connection.dialect.name == 'sqlite':
+        return
+    logging.getLogger(__name__).warning(f'Widening column {column.name} of {table_name} to {column.type}')
+    quote = connection.dialect.identifier_preparer.quote
+    column_type = column.type.compile(dialect=connection.dialect)
+    if connection.dialect.name == 'mssql':
+        # ALTER COLUMN resets the nullability on SQL Server
+        alter = f'ALTER COLUMN {quote(column.name)} {column_type}{"" if column.nullable else " NOT NULL"}'
+    else:
+        alter = f'ALTER COLUMN {quote(column.name)} TYPE {column_type}'
+    connection.execute(text(f'ALTER TABLE {quote(table_name)} {alter}'))
+
+
+def merge_duplicate_series(connection: Connection) -> None:
+    # Older versions created a new series row for every file, fold them into the oldest row of each series
+    duplicates = connection.execute(
+        select(func.min(Series.id), Series.study_id, Series.series_instance_uid)
+        .group_by(Series.study_id, Series.series_instance_uid)
+        .having(func.count() > 1)
+    ).all()
+
+    for keep_id, study_id, series_instance_uid in duplicates:
+        merged_ids = connection.execute(
+            select(Series.id).where(Series.study_id == study_id,
+                                    Series.series_instance_uid == series_instance_uid,
+                                    Series.id != keep_id)
+        ).scalars().all()
+        logging.getLogger(__name__).warning(f'Merging {len(merged_ids)} duplicated rows of series {series_instance_uid}')
+
+        for table in (Tag.__table__, FileInfo.__table__):
+            connection.execute(update(table).where(table.c.series_id.in_(merged_ids)).values(series_id=keep_id))
+
+        kept_projects = set(connection.execute(
+            select(series_project.c.project_id).where(series_project.c.series_id == keep_id)
+        ).scalars())
+        merged_projects = set(connection.execute(
+            select(series_project.c.project_id).where(series_project.c.series_id.in_(merged_ids))
+        ).scalars())
+        connection.execute(delete(series_project).where(series_project.c.series_id.in_(merged_ids)))
+        if merged_projects - kept_projects:
+            connection.execute(insert(series_project),
+                               [{"project_id": p, "series_id": keep_id} for p in merged_projects - kept_projects])
+
+        connection.execute(delete(Series.__table__).where(Series.id.in_(merged_ids)))
+
+
+def backfill_tag_hashes(connection: Connection) -> None:
+    tag = Tag.__table__
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(tag.c.id, tag.c.value)
+            .where(tag.c.value_hash.is_(None), tag.c.id > last_id)
+            .order_by(tag.c.id)
+            .limit(BACKFILL_CHUNK)
+        ).all()
+        if not rows:
+            return
+        logging.getLogger(__name__).warning(f'Hashing the values of {len(rows)} tags')
+        connection.execute(update(tag).where(tag.c.id == bindparam('b_id')),
+                           [{'b_id': i, 'value_hash': tag_value_hash(value)} for i, value in rows])
+        last_id = rows[-1][0]
+
+
+def compress_reports(connection: Connection) -> None:
+    report = Report.__table__
+    while True:
+        rows = connection.execute(
+            select(report.c.id, report.c.text)
+            .where(report.c.content_hash.is_(None))
+            .order_by(report.c.id)
+            .limit(BACKFILL_CHUNK // 10)
+        ).all()
+        if not rows:
+            return
+        logging.getLogger(__name__).warning(f'Compressing {len(rows)} reports')
+        values = []
+        for i, text in rows:
+            content, content_hash = Report.compress(text)
+            values.append({'b_id': i, 'text': '', 'content': content, 'content_hash': content_hash})
+        connection.execute(update(report).where(report.c.id == bindparam('b_id')), values)
+
+
+def delete_duplicates(connection: Connection, table, columns: list[str]) -> None:
+    # Older versions could store the same row several times, keep the oldest one
+    keep = select(func.min(table.c.id)).group_by(*[table.c[c] for c in columns])
+    deleted = connection.execute(delete(table).where(table.c.id.not_in(keep))).rowcount
+    if deleted:
+        logging.getLogger(__name__).warning(f'Deleted {deleted} duplicated rows of {table.name}')
+
+
+def intern_tag_values(connection: Connection, limit: int = BACKFILL_CHUNK) -> int:
+    # Moves the values of up to limit tag rows to tag_value, returns the number of rows moved
+    tag = Tag.__table__
+    rows = connection.execute(
+        select(tag.c.id, tag.c.value, tag.c.value_hash)
+        .where(tag.c.value_id.is_(None))
+        .order_by(tag.c.id)
+        .limit(limit)
+    ).all()
+    if not rows:
+        return 0
+
+    values = {value_hash: value for _, value, value_hash in rows}
+    insert_missing(Session(bind=connection), TagValue.__table__,
+                   [{'value': value, 'value_hash': value_hash} for value_hash, value in values.items()],
+                   ['value_hash'])
+    value_ids = dict(connection.execute(
+        select(TagValue.value_hash, TagValue.id).where(TagValue.value_hash.in_(values))
+    ).all())
+    connection.execute(update(tag).where(tag.c.id == bindparam('b_id')),
+                       [{'b_id': i, 'value_id': value_ids[value_hash], 'value': ''} for i, _, value_hash in rows])
+    return len(rows)
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import datetime
+import logging
+import sys
+from typing import Iterator, Sequence, Any
+
+from sqlalchemy import Select, Row, Column, select, and_, or_, Engine, create_engine, make_url
+
+from .sqlite import is_sqlite_file
+from .schema import Patient, Study, Series, Tag, TagDescriptor, FileInfo, Project, series_project, tag_value_hash
+
+DEFAULT_PAGE_SIZE = 1000
+
+
+def after_clause(keys: Sequence[Column], values: Sequence[Any]):
+    # (k1, k2) > (v1, v2) spelled out, SQL Server has no row value comparison
+    clause = keys[-1] > values[-1]
+    for key, value in zip(reversed(keys[:-1]), reversed(values[:-1])):
+        clause = or_(key > value, and_(key == value, clause))
+    return clause
+
+
+class Results:
+    # Rows of a query in key order. Each page of page_size rows is a new statement starting after the key of the
+    # last row read, so no transaction stays open between pages and no OFFSET is scanned, and its rows are streamed
+    # with yield_per. after holds the key to resume from once the iteration stops.
+    def __init__(self, engine: Engine, statement: Select, keys: Sequence[Column], after: Sequence[Any] | None,
+                 limit: int | None, page_size: int) -> None:
+        self.engine = engine
+        self.statement = statement
+        self.keys = keys
+        self.after = tuple(after) if after else None
+        self.limit = limit
+        self.page_size = page_size
+
+    def __iter__(self) -> Iterator[Row]:
+        remaining = self.limit
+        while remaining is None or remaining > 0:
+            size = self.page_size if remaining is None else min(self.page_size, remaining)
+            page = self.statement
+            if self.after:
+                page = page.where(after_clause(self.keys, self.after))
+            page = page.order_by(*self.keys).limit(size)
+            count = 0
+            with self.engine.connect() as connection:
+                for row in connection.execution_options(yield_per=size).execute(page):
+                    count += 1
+                    self.after = tuple(row._mapping[k] for k in self.keys)
+                    yield row
+            if remaining is not None:
+                remaining -= count
+            if count < size:
+                return
+
+
+class Query:
+    # Read side of the schema. Every search runs on an index of the schema and returns Results, pass the after of
+    # a previous Results to continue where it stopped.
+    def __init__(self, engine: Engine, page_size: int = DEFAULT_PAGE_SIZE) -> None:
+        self.engine = engine
+        self.page_size = page_size
+
+    def _results(self, statement: Select, keys: Sequence[Column], after: Sequence[Any] | None,
+                 limit: int | None) -> Results:
+        return Results(self.engine, statement, keys, after, limit, self.page_size)
+
+    def patients(self, patient_id: str | None = None, name: str | None = None, after: Sequence[Any] | None = None,
+                 limit: int | None = None) -> Results:
+        statement = select(*Patient.__table__.columns)
+        if patient_id is not None:
+            statement = statement.where(Patient.patient_dicom_id == patient_id)
+        if name is not None:
+            # A prefix. SQL Server seeks it in the patient_name index, SQLite scans: its LIKE is case insensitive and
+            # the ESCAPE clause of autoescape disables the LIKE optimization
+            statement = statement.where(Patient.patient_name.startswith(name, autoescape=True))
+        return self._results(statement, [Patient.__table__.c.id], after, limit)
+
+    def studies(self, start: datetime.datetime | None = None, end: datetime.datetime | None = None,
+                modality: str | None = None, community: str | None = None, patient_id: str | None = None,
+                after: Sequence[Any] | None = None, limit: int | None = None) -> Results:
+        statement = select(*Study.__table__.columns, Patient.patient_dicom_id).join(Patient)
+        if patient_id is not None:
+            statement = statement.where(Patient.patient_dicom_id == patient_id)
+        if modality is not None:
+            statement = statement.where(Study.modality == modality)
+        if community is not None:
+            statement = statement.where(Study.community == community)
+        if start is not None:
+            statement = statement.where(Study.study_datetime >= start)
+        if end is not None:
+            statement = statement.where(Study.study_datetime < end)
+        # Walk the study_datetime indexes when the dates are filtered, studies without a date have no place in them
+        study = Study.__table__
+        keys = [study.c.study_datetime, study.c.id] if start is not None or end is not None else [study.c.id]
+        return self._results(statement, keys, after, limit)
+
+    def series(self, tag: str, value: str, after: Sequence[Any] | None = None,
+               limit: int | None = None) -> Results:
+        # tag is the hexadecimal id of a tag descriptor or its name
+        with self.engine.connect() as connection:
+            tag_id = connection.execute(select(TagDescriptor.id).where(
+                or_(TagDescriptor.id == tag.upper(), TagDescriptor.name == tag))).scalar()
+        if tag_id is None:
+            raise KeyError(tag)
+        value_hash = tag_value_hash(str(value)[:Tag.value.type.length])
+        statement = (select(Tag.series_id, *(c for c in Series.__table__.columns if c.key != 'id'),
+                            Study.accession_number)
+                     .join(Series, Series.id == Tag.series_id).join(Study)
+                     .where(Tag.tag_id == tag_id, Tag.value_hash == value_hash))
+        return self._results(statement, [Tag.__table__.c.series_id], after, limit)
+
+    def files(self, series_id: int | None = None, project: str | None = None, after: Sequence[Any] | None = None,
+              limit: int | None = None) -> Results:
+        if series_id is None and project is None:
+            raise ValueError('Files are searched by series or by project')
+        statement = select(*FileInfo.__table__.columns)
+        if series_id is not None:
+            statement = statement.where(FileInfo.series_id == series_id)
+        if project is not None:
+            statement = (statement.join(series_project, series_project.c.series_id == FileInfo.series_id)
+                         .join(Project, Project.id == series_project.c.project_id)
+                         .where(Project.name == project))
+        return self._results(statement, [FileInfo.__table__.c.series_id, FileInfo.__table__.c.id], after, limit)
+
+
+def read_only_engine(url: str) -> Engine:
+    # Unlike Database, creates no table and runs no migration. SQLite files are opened read only.
+    if is_sqlite_file(url):
+        url = make_url(url)
+        url = url.set(database=f'file:{url.database}', query={**url.query, 'mode': 'ro', 'uri': 'true'})
+    return create_engine(url)
+
+
+def _parse_key(values: str, keys: Sequence[Column]) -> tuple:
+    parsed = []
+    for value, key in zip(values.split(','), keys):
+        python_type = key.type.python_type
+        parsed.append(datetime.datetime.fromisoformat(value) if python_type is datetime.datetime
+                      else python_type(value))
+    return tuple(parsed)
+
+
+def _format_key(values: Sequence[Any]) -> str:
+    return ','.join(v.isoformat() if isinstance(v, datetime.datetime) else str(v) for v in values)
+
+
+def main(arguments: list[str] | None = None, out=sys.stdout) -> None:
+    from dicom2sql.shared import parse_config
+
+    parser = argparse.ArgumentParser(description='Search the dicom2sql database, the rows are written as csv',
+                                     prog='python -m dicom2sql.sql.query')
+    parser.add_argument('--limit', type=int, help='stop after this many rows and print the --after to continue')
+    parser.add_argument('--after', help='key printed by a previous search, comma separated')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    searches = parser.add_subparsers(dest='search', required=True)
+    patients = searches.add_parser('patients')
+    patients.add_argument('--patient-id')
+    patients.add_argument('--name', help='prefix of the patient name')
+    studies = searches.add_parser('studies')
+    studies.add_argument('--start', type=datetime.datetime.fromisoformat, help='first date, included')
+    studies.add_argument('--end', type=datetime.datetime.fromisoformat, help='last date, excluded')
+    studies.add_argument('--modality')
+    studies.add_argument('--community')
+    studies.add_argument('--patient-id')
+    series = searches.add_parser('series')
+    series.add_argument('tag', help='hexadecimal id or name of the tag descriptor')
+    series.add_argument('value')
+    files = searches.add_parser('files')
+    files.add_argument('--series-id', type=int)
+    files.add_argument('--project')
+    args = parser.parse_args(arguments)
+
+    config = parse_config()
+    engine = read_only_engine(config['database.out']['out_db_uri'])
+    query = Query(engine, args.page_size)
+    search = {
+        'patients': lambda after: query.patients(args.patient_id, args.name, after, args.limit),
+        'studies': lambda after: query.studies(args.start, args.end, args.modality, args.community,
+                                               args.patient_id, after, args.limit),
+        'series': lambda after: query.series(args.tag, args.value, after, args.limit),
+        'files': lambda after: query.files(args.series_id, args.project, after, args.limit),
+    }[args.search]
+    results = search(None)
+    if args.after:
+        results = search(_parse_key(args.after, results.keys))
+
+    writer = csv.writer(out)
+    count = 0
+    for row in results:
+        if count == 0:
+            writer.writerow(row._fields)
+        writer.writerow(row)
+        count += 1
+    if args.limit is not None and count == args.limit and results.after:
+        print(f'--after {_format_key(results.after)}', file=sys.stderr)
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -1,11 +1,14 @@
 import datetime
+import hashlib
+import json
 import logging
+import zlib
 from typing import List, Any
 from typing import Optional
 
 from pydicom.dataset import Dataset
-from sqlalchemy import ForeignKey, Text, Table, Column, DateTime, func
-from sqlalchemy import String
+from sqlalchemy import ForeignKey, Text, Table, Column, DateTime, func, Index, Select, select, LargeBinary, false
+from sqlalchemy import String, Integer
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import MappedAsDataclass
@@ -99,6 +102,13 @@ class Patient(Base):
 
 class Study(Base):
     __tablename__ = "study"
+    # Date range searches, alone or by modality, community or patient, see query.py
+    __table_args__ = (
+        Index("ix_study_study_datetime", "study_datetime"),
+        Index("ix_study_modality_study_datetime", "modality", "study_datetime"),
+        Index("ix_study_community_study_datetime", "community", "study_datetime"),
+        Index("ix_study_patient_id_study_datetime", "patient_id", "study_datetime"),
+    )
 
     id: Mapped[int] = mapped_column( primary_key=True, init=False)
     study_instance_uid: Mapped[str] = mapped_column(String(64))
@@ -135,16 +145,39 @@ class Study(Base):
 
 class Report(Base):
     __tablename__ = "report"
+    # Every file of a study carries the same report, it is stored once per study
+    __table_args__ = (Index("ix_report_study_id_content_hash", "study_id", "content_hash", unique=True),)
 
     id: Mapped[int] = mapped_column( primary_key=True, init=False)
+    # Only filled by older versions, the report is kept compressed in content
     text: Mapped[str] = mapped_column(Text)
     study_id: Mapped[int] = mapped_column(ForeignKey("study.id"), init=False, index=True)
+    content: Mapped[Optional[bytes]] = mapped_column(LargeBinary, default=None)
+    content_hash: Mapped[Optional[str]] = mapped_column(String(40), default=None)
 
     study: Mapped["Study"] = relationship(back_populates="reports", default=None)
 
+    def __init__(self, dicom: Dataset, **kw: Any):
+        super().__init__(text='', **kw)
+        # Serializing the whole dataset costs far more than the content sequence we keep
+        element = dicom[tags_id["dicom_sr"]]
+        self.content, self.content_hash = self.compress(json.dumps(element.to_json_dict(None, 1024)))
+
+    @staticmethod
+    def compress(text: str) -> tuple[bytes, str]:
+        data = text.encode('utf-8')
+        return zlib.compress(data), hashlib.sha1(data).hexdigest()
+
+    @property
+    def json(self) -> str:
+        return zlib.decompress(self.content).decode('utf-8') if self.content is not None else self.text
+
 
 class Series(Base):
     __tablename__ = "series"
+    __table_args__ = (
+        Index("ix_series_study_id_series_instance_uid", "study_id", "series_instance_uid", unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, init=False)
     series_instance_uid: Mapped[str] = mapped_column(String(64), index=True)
@@ -175,19 +208,43 @@ class TagDescriptor(Base):
     __tablename__ = "tag_descriptor"
 
     id: Mapped[str] = mapped_column(String(25), primary_key=True)
-    name: Mapped[str] = mapped_column(String(40))
+    # Fits every keyword of the DICOM data dictionary
+    name: Mapped[str] = mapped_column(String(64))
     description: Mapped[str] = mapped_column(String(300))
+    # Gets a column in the series_wide table, see wide.py
+    pivoted: Mapped[bool] = mapped_column(default=False, server_default=false())
 
     tags: Mapped[List["Tag"]] = relationship(
         back_populates="tag_descriptor", cascade="all, delete-orphan", default_factory=list
     )
 
 
+def tag_value_hash(value: str) -> str:
+    return hashlib.sha1(value.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+class TagValue(Base):
+    __tablename__ = "tag_value"
+
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    value: Mapped[str] = mapped_column(String(8000))
+    value_hash: Mapped[str] = mapped_column(String(40), unique=True, index=True)
+
+
 class Tag(Base):
     __tablename__ = "tag"
+    # value is too long to be part of an index, the same value is stored once per series through its hash
+    __table_args__ = (
+        Index("ix_tag_series_id_tag_id_value_hash", "series_id", "tag_id", "value_hash", unique=True),
+        # Series by tag value
+        Index("ix_tag_tag_id_value_hash_series_id", "tag_id", "value_hash", "series_id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, init=False)
     value: Mapped[str] = mapped_column(String(8000))
+    value_hash: Mapped[Optional[str]] = mapped_column(String(40), default=None)
+    # With interned tag values the value lives in tag_value and value is left empty, read them from tag_full
+    value_id: Mapped[Optional[int]] = mapped_column(ForeignKey("tag_value.id"), default=None)
     tag_id: Mapped[str] = mapped_column(ForeignKey("tag_descriptor.id"), init=False)
     series_id: Mapped[int] = mapped_column(ForeignKey("series.id"), init=False, index=True)
 
@@ -196,8 +253,34 @@ class Tag(Base):
     series: Mapped["Series"] = relationship(back_populates="tags", default=None)
 
 
+TAG_VIEW = "tag_full"
+
+
+def tag_view_select() -> Select:
+    tag = Tag.__table__
+    tag_value = TagValue.__table__
+    return (select(tag.c.id, tag.c.tag_id, tag.c.series_id,
+                   func.coalesce(tag_value.c.value, tag.c.value).label("value"))
+            .select_from(tag.outerjoin(tag_value, tag.c.value_id == tag_value.c.id)))
+
+
+# One row per series and one column per pivoted tag descriptor, maintained by wide.refresh_wide
+WIDE_TABLE = "series_wide"
+
+# Column of series_wide of each pivoted tag and the last tag id copied into it
+wide_column = Table(
+    "series_wide_column",
+    Base.metadata,
+    Column("tag_id", ForeignKey("tag_descriptor.id"), primary_key=True),
+    Column("column_name", String(64), unique=True),
+    Column("last_tag_id", Integer, default=0),
+)
+
+
 class FileInfo(Base):
     __tablename__ = "file_info"
+    # Files of a series in id order, the keyset of query.py
+    __table_args__ = (Index("ix_file_info_series_id_id", "series_id", "id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, init=False)
     filename: Mapped[str] = mapped_column(String(255))
@@ -246,6 +329,10 @@ class ImageQueue(Base):
         back_populates="image_queues"
     )
 
+    # Set by Database.claim_new_images, a row is free again once its lease expires
+    lease_owner: Mapped[Optional[str]] = mapped_column(String(100), default=None, init=False, index=True)
+    lease_expires: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, default=None, init=False)
+
 
 
 
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import configparser
+
+from sqlalchemy import Engine, event, make_url
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
+
+class SqliteProfile:
+    # Pragmas set on every connection to a sqlite file. WAL lets readers run next to the writer and with
+    # synchronous=normal a commit no longer waits for an fsync, only checkpoints do.
+    def __init__(self, journal_mode: str = 'wal', synchronous: str = 'normal', cache_size: int = -65536,
+                 mmap_size: int = 268435456, busy_timeout: float = 30, single_writer: bool = True) -> None:
+        if journal_mode.lower() not in JOURNAL_MODES:
+            raise ValueError(f'Unknown sqlite journal mode {journal_mode}')
+        if synchronous.lower() not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f'Unknown sqlite synchronous level {synchronous}')
+        self.journal_mode = journal_mode.lower()
+        self.synchronous = synchronous.lower()
+        # Pages if positive, KiB if negative
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        # Send every write through one connection instead of letting the threads fight for the write lock
+        self.single_writer = single_writer
+
+    @classmethod
+    def from_config(cls, db_config: configparser.SectionProxy) -> SqliteProfile:
+        return cls(journal_mode=db_config.get('sqlite_journal_mode', 'wal'),
+                   synchronous=db_config.get('sqlite_synchronous', 'normal'),
+                   cache_size=db_config.getint('sqlite_cache_size', -65536),
+                   mmap_size=db_config.getint('sqlite_mmap_size', 268435456),
+                   busy_timeout=db_config.getfloat('sqlite_busy_timeout', 30),
+                   single_writer=db_config.getboolean('sqlite_single_writer', True))
+
+    def pragmas(self) -> list[str]:
+        return [f'PRAGMA journal_mode={self.journal_mode}',
+                f'PRAGMA synchronous={self.synchronous}',
+                f'PRAGMA cache_size={self.cache_size}',
+                f'PRAGMA mmap_size={self.mmap_size}',
+                f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}']
+
+    def configure(self, engine: Engine, writer: bool) -> None:
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record) -> None:
+            # Let the begin event below start the transactions instead of the sqlite3 module
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            for pragma in self.pragmas():
+                cursor.execute(pragma)
+            cursor.close()
+
+        @event.listens_for(engine, 'begin')
+        def begin(connection) -> None:
+            # A deferred transaction that reads before writing cannot wait for the write lock, it fails with
+            # "database is locked" right away. Writers take the lock when they start and wait busy_timeout for it.
+            connection.exec_driver_sql('BEGIN IMMEDIATE' if writer else 'BEGIN')
+
+
+def is_sqlite_file(url: str) -> bool:
+    url = make_url(url)
+    return (url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+            and url.query.get('mode') != 'memory')
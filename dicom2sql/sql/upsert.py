@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from typing import Sequence
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Row, insert, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+# SQL Server refuses statements with more than 2100 parameters
+MSSQL_MAX_PARAMETERS = 2000
+
+
+def insert_missing(session: Session, table: Table, rows: Sequence[dict], conflict_columns: Sequence[str],
+                   returning: Sequence[Column] = ()) -> list[Row]:
+    # Returns the returning columns of the rows actually inserted, rows skipped on a conflict are left out. The
+    # generic fallback returns nothing, callers select the ids of the rows not returned.
+    if not rows:
+        return []
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = dialect_insert(table).on_conflict_do_nothing(index_elements=conflict_columns)
+        if returning:
+            return session.execute(statement.returning(*returning), list(rows)).all()
+        session.execute(statement, list(rows))
+        return []
+    elif dialect == 'mssql':
+        # MERGE fails instead of skipping when two source rows collide with each other
+        unique_rows = {}
+        for row in rows:
+            unique_rows.setdefault(tuple(row[c] for c in conflict_columns), row)
+        rows = list(unique_rows.values())
+        columns = list(rows[0])
+        chunk_size = max(1, MSSQL_MAX_PARAMETERS // len(columns))
+        inserted = []
+        for start in range(0, len(rows), chunk_size):
+            inserted.extend(_mssql_merge(session, table, rows[start:start + chunk_size], columns, conflict_columns,
+                                         returning))
+        return inserted
+    else:
+        _insert_ignoring_conflicts(session, table, rows)
+        return []
+
+
+def _insert_ignoring_conflicts(session: Session, table: Table, rows: Sequence[dict]) -> None:
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.execute(insert(table), row)
+        except sqlalchemy.exc.IntegrityError:
+            pass
+
+
+def _mssql_merge(session: Session, table: Table, rows: Sequence[dict], columns: list[str],
+                 conflict_columns: Sequence[str], returning: Sequence[Column] = ()) -> list[Row]:
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    values = ', '.join('(' + ', '.join(f':{c}_{i}' for c in columns) + ')' for i in range(len(rows)))
+    statement = text(
+        f"MERGE INTO {quote(table.name)} WITH (HOLDLOCK) AS target "
+        f"USING (VALUES {values}) AS source ({', '.join(quote(c) for c in columns)}) "
+        f"ON {' AND '.join(f'target.{quote(c)} = source.{quote(c)}' for c in conflict_columns)} "
+        f"WHEN NOT MATCHED THEN INSERT ({', '.join(quote(c) for c in columns)}) "
+        f"VALUES ({', '.join(f'source.{quote(c)}' for c in columns)})"
+        + (f" OUTPUT {', '.join(f'inserted.{quote(c.name)}' for c in returning)};" if returning else ";")
+    )
+    params = {f'{c}_{i}': row[c] for i, row in enumerate(rows) for c in columns}
+    result = session.execute(statement, params)
+    return result.all() if returning else []
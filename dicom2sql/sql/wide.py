@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import logging
+import re
+
+from sqlalchemy import Connection, MetaData, Table, Column, Integer, String, Index, select, insert, update, delete, \
+    func, exists, text, inspect, or_
+
+from .migrate import add_column
+from .schema import Series, Tag, TagDescriptor, tag_view_select, WIDE_TABLE, wide_column
+
+# Values longer than this are truncated in the wide table, so every column can be indexed on every backend
+WIDE_VALUE_LENGTH = 255
+# Tag ids below the watermark that are scanned again, rows committed out of id order by concurrent writers are
+# picked up by the next refresh
+REFRESH_OVERLAP = 10000
+
+
+def column_name(descriptor: TagDescriptor, taken: set[str]) -> str:
+    name = re.sub(r'\W+', '_', descriptor.name or '').strip('_').lower()[:50]
+    if not name or name[0].isdigit() or name in taken or name == 'series_id':
+        name = f'tag_{descriptor.id.lower()}'
+    return name
+
+
+def wide_table(columns: list[str]) -> Table:
+    return Table(WIDE_TABLE, MetaData(),
+                 Column("series_id", Integer, primary_key=True, autoincrement=False),
+                 *(Column(c, String(WIDE_VALUE_LENGTH)) for c in columns))
+
+
+def _index(table: Table, column: str) -> Index:
+    return Index(f'ix_{WIDE_TABLE}_{column}', table.c[column])
+
+
+def sync_columns(connection: Connection) -> Table | None:
+    # Adds a column for every newly pivoted tag descriptor and drops the columns of the ones no longer pivoted
+    columns = {tag_id: name for tag_id, name in connection.execute(select(wide_column.c.tag_id,
+                                                                          wide_column.c.column_name))}
+    pivoted = {row.id: row for row in connection.execute(select(TagDescriptor.id, TagDescriptor.name)
+                                                         .where(TagDescriptor.pivoted))}
+    if not columns and not pivoted:
+        return None
+
+    exists_already = inspect(connection).has_table(WIDE_TABLE)
+    quote = connection.dialect.identifier_preparer.quote
+    for tag_id in set(columns) - set(pivoted):
+        name = columns.pop(tag_id)
+        connection.execute(delete(wide_column).where(wide_column.c.tag_id == tag_id))
+        if exists_already:
+            logging.getLogger(__name__).warning(f'Dropping column {name} of {WIDE_TABLE}, '
+                                                f'tag {tag_id} is no longer pivoted')
+            _index(wide_table([name]), name).drop(connection)
+            connection.execute(text(f'ALTER TABLE {quote(WIDE_TABLE)} DROP COLUMN {quote(name)}'))
+
+    added = []
+    for tag_id in sorted(set(pivoted) - set(columns)):
+        name = column_name(pivoted[tag_id], set(columns.values()))
+        columns[tag_id] = name
+        added.append(name)
+        # The refresh fills the new column from the first tag on
+        connection.execute(insert(wide_column).values(tag_id=tag_id, column_name=name, last_tag_id=0))
+
+    table = wide_table(list(columns.values()))
+    if not exists_already:
+        table.create(connection)
+        added = list(columns.values())
+    else:
+        for name in added:
+            add_column(connection, WIDE_TABLE, Column(name, String(WIDE_VALUE_LENGTH)))
+    for name in added:
+        _index(table, name).create(connection)
+    return table
+
+
+def refresh_wide(connection: Connection) -> int:
+    # Copies the tags stored since the last refresh into series_wide, returns the number of cells that changed
+    table = sync_columns(connection)
+    if table is None:
+        return 0
+    series = Series.__table__
+    tag = Tag.__table__
+    last_series_id = connection.execute(select(func.coalesce(func.max(table.c.series_id), 0))).scalar()
+    connection.execute(insert(table).from_select(
+        ["series_id"],
+        select(series.c.id).where(series.c.id > last_series_id - REFRESH_OVERLAP,
+                                  ~exists().where(table.c.series_id == series.c.id))))
+
+    max_tag_id = connection.execute(select(func.max(tag.c.id))).scalar()
+    if max_tag_id is None:
+        return 0
+    tags = tag_view_select().subquery()
+    substr = func.substr if connection.dialect.name == 'sqlite' else func.substring
+    refreshed = 0
+    for tag_id, name, last_tag_id in connection.execute(
+            select(wide_column.c.tag_id, wide_column.c.column_name, wide_column.c.last_tag_id)).all():
+        changed_series = (select(tag.c.series_id)
+                          .where(tag.c.tag_id == tag_id,
+                                 tag.c.id > max(0, last_tag_id - REFRESH_OVERLAP),
+                                 tag.c.id <= max_tag_id))
+        # The first value stored for the series, a series with several values of the tag keeps that one
+        first_value = (select(substr(tags.c.value, 1, WIDE_VALUE_LENGTH))
+                       .where(tags.c.series_id == table.c.series_id, tags.c.tag_id == tag_id)
+                       .order_by(tags.c.id).limit(1).scalar_subquery())
+        column = table.c[name]
+        refreshed += connection.execute(update(table)
+                                        .where(table.c.series_id.in_(changed_series),
+                                               or_(column.is_(None), column != first_value))
+                                        .values({name: first_value})).rowcount
+        connection.execute(update(wide_column).where(wide_column.c.tag_id == tag_id)
+                           .values(last_tag_id=max_tag_id))
+    return refreshed
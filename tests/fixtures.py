@@ -0,0 +1,44 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from dicom2sql.sql.database import Database
+
+TAGS = [{'tag': '00180015', 'name': 'Body Part Examined', 'tag_description': ''},
+        {'tag': '00181030', 'name': 'ProtocolName', 'tag_description': ''}]
+
+
+class DatabaseTestCase(unittest.TestCase):
+    # Gives the tests a temporary folder, make_file to write a file in it and make_db to open a database there.
+    # Every database opened is disposed of, and the folder removed, after the test. Unless open_db is false
+    # self.db is opened on out.db with TAGS.
+    open_db = True
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.folder = Path(tmp.name)
+        self._databases = []
+        self.addCleanup(self._dispose)
+        if self.open_db:
+            self.db = self.make_db()
+
+    def _dispose(self):
+        # Tests that reopen the database assign self.db directly
+        db = getattr(self, 'db', None)
+        if isinstance(db, Database) and db not in self._databases:
+            self._databases.append(db)
+        for db in self._databases:
+            db.dispose()
+
+    def make_db(self, name: str = 'out.db', tags=TAGS, **kwargs) -> Database:
+        db = Database(f'sqlite:///{self.folder / name}', **kwargs)
+        self._databases.append(db)
+        if tags:
+            db.set_tags_list(tags)
+        return db
+
+    def make_file(self, name: str) -> str:
+        path = self.folder / name
+        path.write_bytes(b'\0' * 128)
+        return str(path)
@@ -0,0 +1,24 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from benchmarks.corpus import CorpusSpec
+from benchmarks.run import run, STAGES
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run(self):
+        spec = CorpusSpec(patients=2, studies=1, series=2, images=3, private_size=256, pixel_size=256)
+        with tempfile.TemporaryDirectory() as folder:
+            report = run(Path(folder), spec, list(STAGES), threads=2, batch_size=4)
+
+        self.assertEqual(report['corpus']['files'], spec.files)
+        self.assertEqual(list(report['stages']), list(STAGES))
+        for stage in STAGES:
+            self.assertEqual(report['stages'][stage]['files'], spec.files, stage)
+        for stage in ('insert', 'crawler', 'server'):
+            self.assertEqual(report['stages'][stage]['failed'], 0, stage)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from sqlalchemy import select, text
+
+from dicom2sql.sql.bulk import staging_file, staging_tag
+from dicom2sql.sql.database import Database, FileRecord
+from dicom2sql.sql.schema import Patient, Study, Series, Report, FileInfo, Project, series_project, TAG_VIEW
+from tests.fixtures import DatabaseTestCase
+from tests.test_database import make_dataset, add_report
+
+
+class TestBulkLoad(DatabaseTestCase):
+    open_db = False
+
+    def records(self, project: int) -> list[FileRecord]:
+        records = []
+        for i in range(12):
+            ds = make_dataset(patient_id=f'P{i % 2}', accession_number=f'ACC{i % 4}',
+                              series_uid=f'1.2.{i % 4}.{i % 3}', protocol=f'p{i % 5}')
+            if i % 4 == 1:
+                add_report(ds, f'report {i % 3}')
+            records.append(FileRecord(ds, 'community', self.make_file(f'{i}.dcm'), project if i % 2 else None))
+        # The same file twice, a file without a required tag and a study of another patient
+        records.append(records[0])
+        missing = make_dataset(patient_id='P9', accession_number='ACC9')
+        del missing.StudyInstanceUID
+        records.append(FileRecord(missing, 'community', self.make_file('missing.dcm')))
+        records.append(FileRecord(make_dataset(patient_id='P8', accession_number='ACC0'), 'community',
+                                  self.make_file('other.dcm')))
+        return records
+
+    def dump(self, db: Database) -> dict:
+        study = select(Study.id, Study.accession_number, Patient.patient_dicom_id).join(Patient).subquery()
+        series = (select(Series.id, Series.series_instance_uid, Series.series_description, study.c.accession_number)
+                  .join(study, Series.study_id == study.c.id).subquery())
+        with db.read_session_factory() as session:
+            def rows(statement) -> list:
+                return sorted(tuple(r) for r in session.execute(statement))
+
+            return {
+                'patient': rows(select(*(c for c in Patient.__table__.columns if c.key != 'id'))),
+                'study': rows(select(*(c for c in Study.__table__.columns if c.key not in ('id', 'patient_id')),
+                                     Patient.patient_dicom_id).join(Patient)),
+                'series': rows(select(series.c.accession_number, series.c.series_instance_uid,
+                                      series.c.series_description)),
+                'tag': rows(text(f'SELECT s.accession_number, s.series_instance_uid, t.tag_id, t.value '
+                                 f'FROM {TAG_VIEW} t JOIN ({select(series)}) s ON s.id = t.series_id')),
+                'report': rows(select(study.c.accession_number, Report.content_hash, Report.content)
+                               .join(study, Report.study_id == study.c.id)),
+                'file_info': rows(select(series.c.accession_number, series.c.series_instance_uid,
+                                         FileInfo.filepath, FileInfo.filename, FileInfo.size)
+                                  .join(series, FileInfo.series_id == series.c.id)),
+                'series_project': rows(select(Project.name, series.c.accession_number, series.c.series_instance_uid)
+                                       .select_from(series_project)
+                                       .join(Project, Project.id == series_project.c.project_id)
+                                       .join(series, series.c.id == series_project.c.series_id)),
+            }
+
+    def load_both(self, **kwargs) -> tuple[dict, dict]:
+        dumps = []
+        for name, bulk in (('rows.db', False), ('bulk.db', True)):
+            db = self.make_db(name, bulk_load=bulk, bulk_chunk_size=4, **kwargs)
+            records = self.records(db.get_or_create_project('test'))
+            # Part of the files are already stored, as when resuming a crawl
+            db.insert_many(records[:3])
+            # A failed merge would fall back to the regular path with a warning
+            with self.assertNoLogs('dicom2sql.sql.bulk', level='WARNING'):
+                results = db.insert_many(records)
+            dumps.append(([e is None for e in results], self.dump(db)))
+            if bulk:
+                with db.read_session_factory() as session:
+                    self.assertIsNone(session.scalar(select(staging_file.c.seq)))
+                    self.assertIsNone(session.scalar(select(staging_tag.c.seq)))
+        return dumps[0], dumps[1]
+
+    def test_same_rows_as_insert(self):
+        (rows_results, rows), (bulk_results, bulk) = self.load_both()
+        self.assertEqual(bulk_results, rows_results)
+        self.assertEqual(rows_results.count(False), 2)
+        for table in rows:
+            self.assertEqual(bulk[table], rows[table], table)
+        self.assertEqual(len(bulk['file_info']), 12)
+        self.assertEqual(len(bulk['report']), 3)
+
+    def test_same_rows_with_interned_values(self):
+        (rows_results, rows), (bulk_results, bulk) = self.load_both(intern_tag_values=True)
+        self.assertEqual(bulk_results, rows_results)
+        self.assertEqual(bulk, rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,328 @@
+import json
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from pydicom.dataset import Dataset
+from sqlalchemy import select, func, text, insert, update, event
+from sqlalchemy.exc import NoResultFound
+
+from dicom2sql.init_db import standard_tags
+from dicom2sql.sql.cache import LRUCache, KeyCache
+from dicom2sql.sql.database import Database, FileRecord
+from dicom2sql.sql.extract import ExtractionPlan
+from dicom2sql.sql.sqlite import SqliteProfile
+from dicom2sql.sql.schema import Patient, Study, Series, Tag, TagValue, Report, FileInfo, series_project, \
+    tag_value_hash, TagDescriptor, tags_id
+from tests.fixtures import DatabaseTestCase
+
+
+def make_dataset(patient_id: str = 'P1', accession_number: str = 'ACC0001', series_uid: str = '1.2.3.1',
+                 protocol: str = 'protocol') -> Dataset:
+    ds = Dataset()
+    ds.PatientID = patient_id
+    ds.PatientName = 'Doe^John'
+    ds.PatientBirthDate = '19800101'
+    ds.PatientSex = 'M'
+    ds.StudyInstanceUID = '1.2.3'
+    ds.AccessionNumber = accession_number
+    ds.StudyDate = '20200101'
+    ds.StudyTime = '101010'
+    ds.Modality = 'CT'
+    ds.BodyPartExamined = 'HEAD'
+    ds.SeriesInstanceUID = series_uid
+    ds.ProtocolName = protocol
+    return ds
+
+
+def add_report(ds: Dataset, text: str = 'no findings') -> Dataset:
+    item = Dataset()
+    item.ValueType = 'TEXT'
+    item.TextValue = text
+    ds.ContentSequence = [item]
+    return ds
+
+
+class TestDatabase(DatabaseTestCase):
+    def count(self, table) -> int:
+        with self.db.session_factory() as session:
+            return session.scalar(select(func.count()).select_from(table))
+
+    def test_insert_many(self):
+        project = self.db.get_or_create_project('test')
+        records = [FileRecord(make_dataset(series_uid=f'1.2.3.{i % 2}', protocol=f'p{i % 3}'),
+                              'community', self.make_file(f'{i}.dcm'), project)
+                   for i in range(6)]
+        self.assertEqual(self.db.insert_many(records), [None] * 6)
+        self.assertEqual(self.db.insert_many(records[:2]), [None] * 2)
+
+        self.assertEqual(self.count(Patient), 1)
+        self.assertEqual(self.count(Study), 1)
+        self.assertEqual(self.count(Series), 2)
+        self.assertEqual(self.count(series_project), 2)
+        self.assertEqual(self.count(FileInfo), 6)
+        # Body part once per series, and the protocol values each series has seen
+        self.assertEqual(self.count(Tag), 2 + 3 + 3)
+
+    def test_new_rows_resolved_with_returning(self):
+        statements = []
+        event.listen(self.db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        self.assertEqual(self.db.insert_many([FileRecord(make_dataset(), 'community', self.make_file('a.dcm'))]),
+                         [None])
+        # One lookup before the insert, the id of the new row comes back from the insert itself
+        for table in ('patient', 'study', 'series'):
+            self.assertEqual(len([s for s in statements if s.startswith(f'SELECT {table}.id')]), 1)
+            self.assertTrue(any(s.startswith(f'INSERT INTO {table} ') and 'RETURNING' in s for s in statements))
+
+    def test_insert_many_failures(self):
+        missing_uid = make_dataset(accession_number='ACC0002')
+        del missing_uid.StudyInstanceUID
+        records = [FileRecord(make_dataset(), 'community', self.make_file('a.dcm')),
+                   FileRecord(missing_uid, 'community', self.make_file('b.dcm')),
+                   FileRecord(make_dataset(patient_id='P2'), 'community', self.make_file('c.dcm')),
+                   FileRecord(make_dataset(accession_number='ACC0003'), 'community', str(self.folder / 'none'))]
+
+        results = self.db.insert_many(records)
+
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], KeyError)
+        self.assertIsInstance(results[2], NoResultFound)
+        self.assertIsInstance(results[3], FileNotFoundError)
+        self.assertEqual(self.count(FileInfo), 1)
+
+    def test_insert_key_cache(self):
+        for i in range(3):
+            self.db.insert(make_dataset(protocol=f'p{i}'), 'community', self.make_file(f'{i}.dcm'))
+
+        self.assertEqual(len(self.db.key_cache.series), 1)
+        self.assertEqual(self.count(Series), 1)
+        self.assertEqual(self.count(Tag), 4)
+
+        self.db.key_cache.clear()
+        self.db.insert_many([FileRecord(make_dataset(), 'community', self.make_file('3.dcm'))])
+        self.assertEqual(len(self.db.key_cache.patients), 1)
+        self.assertEqual(self.count(Series), 1)
+
+    def test_concurrent_insert(self):
+        def insert(i: int) -> list:
+            return self.db.insert_many([FileRecord(make_dataset(protocol=f'p{i}'), 'community',
+                                                   self.make_file(f'{i}_{j}.dcm')) for j in range(3)])
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(insert, range(16)))
+
+        self.assertEqual(results, [[None] * 3] * 16)
+        self.assertEqual(self.count(Patient), 1)
+        self.assertEqual(self.count(Series), 1)
+        self.assertEqual(self.count(FileInfo), 48)
+
+    def test_upgrade_merges_duplicated_series(self):
+        self.db.insert(make_dataset(), 'community', self.make_file('a.dcm'))
+        project = self.db.get_or_create_project('test')
+        with self.db.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_series_study_id_series_instance_uid'))
+            study_id = connection.scalar(select(Study.id))
+            for name in ('b.dcm', 'c.dcm'):
+                series_id = connection.execute(
+                    insert(Series.__table__).values(series_instance_uid='1.2.3.1', study_id=study_id)
+                ).inserted_primary_key[0]
+                connection.execute(insert(FileInfo.__table__).values(filename=name, filepath='', size=0,
+                                                                     series_id=series_id))
+                connection.execute(insert(series_project).values(project_id=project, series_id=series_id))
+        self.assertEqual(self.count(Series), 3)
+
+        self.db = self.make_db(tags=())
+
+        self.assertEqual(self.count(Series), 1)
+        self.assertEqual(self.count(FileInfo), 3)
+        self.assertEqual(self.count(series_project), 1)
+
+    def test_tags_stored_once_without_cache(self):
+        self.db.key_cache = KeyCache(maxsize=0, seen_tags_size=0)
+        for i in range(3):
+            self.db.insert(make_dataset(), 'community', self.make_file(f'{i}.dcm'))
+        self.assertEqual(self.count(Tag), 2)
+
+    def test_upgrade_hashes_tag_values(self):
+        self.db.insert(make_dataset(), 'community', self.make_file('a.dcm'))
+        with self.db.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_tag_series_id_tag_id_value_hash'))
+            connection.execute(update(Tag.__table__).values(value_hash=None))
+            connection.execute(insert(Tag.__table__).from_select(
+                ['value', 'tag_id', 'series_id'], select(Tag.value, Tag.tag_id, Tag.series_id)))
+        self.assertEqual(self.count(Tag), 4)
+
+        self.db = self.make_db(tags=())
+
+        with self.db.session_factory() as session:
+            tags = session.execute(select(Tag.id, Tag.value, Tag.value_hash).order_by(Tag.id)).all()
+        self.assertEqual([(i, h) for i, _, h in tags], [(1, tag_value_hash('HEAD')), (2, tag_value_hash('protocol'))])
+
+    def tag_values(self) -> list:
+        with self.db.session_factory() as session:
+            return session.execute(text('SELECT series_id, tag_id, value FROM tag_full ORDER BY id')).all()
+
+    def test_intern_tag_values(self):
+        self.db.intern_tag_values = True
+        records = [FileRecord(make_dataset(series_uid=f'1.2.3.{i}'), 'community', self.make_file(f'{i}.dcm'))
+                   for i in range(3)]
+        self.assertEqual(self.db.insert_many(records), [None] * 3)
+
+        self.assertEqual(self.count(Tag), 6)
+        self.assertEqual(self.count(TagValue), 2)
+        with self.db.session_factory() as session:
+            self.assertEqual(set(session.scalars(select(Tag.value))), {''})
+        self.assertEqual([v for _, _, v in self.tag_values()], ['HEAD', 'protocol'] * 3)
+
+    def test_move_tag_values(self):
+        self.db.insert_many([FileRecord(make_dataset(series_uid=f'1.2.3.{i}'), 'community', self.make_file(f'{i}.dcm'))
+                             for i in range(3)])
+        before = self.tag_values()
+
+        self.assertEqual(self.db.move_tag_values(), 6)
+        self.assertEqual(self.count(TagValue), 2)
+        self.assertEqual(self.tag_values(), before)
+
+    def test_reports_stored_once_per_study(self):
+        records = [FileRecord(add_report(make_dataset(series_uid=f'1.2.3.{i}'), 'no findings' if i < 3 else 'nodule'),
+                              'community', self.make_file(f'{i}.dcm'))
+                   for i in range(4)]
+        self.assertEqual(self.db.insert_many(records[:2]), [None] * 2)
+        self.assertEqual(self.db.insert_many(records[2:]), [None] * 2)
+
+        with self.db.session_factory() as session:
+            reports = session.scalars(select(Report).order_by(Report.id)).all()
+            self.assertEqual([json.loads(r.json)['Value'][0]['0040A160']['Value'] for r in reports],
+                             [['no findings'], ['nodule']])
+            self.assertEqual(reports[0].text, '')
+
+    def test_upgrade_compresses_reports(self):
+        self.db.insert(make_dataset(), 'community', self.make_file('a.dcm'))
+        with self.db.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_report_study_id_content_hash'))
+            study_id = connection.scalar(select(Study.id))
+            connection.execute(insert(Report.__table__), [{'text': '{"vr": "SQ"}', 'study_id': study_id}] * 3)
+
+        self.db = self.make_db(tags=())
+
+        with self.db.session_factory() as session:
+            reports = session.scalars(select(Report)).all()
+            self.assertEqual([(r.text, r.json) for r in reports], [('', '{"vr": "SQ"}')])
+
+    def test_set_tags_list(self):
+        self.db.set_tags_list([{'tag': '00181030', 'name': 'Protocol Name', 'tag_description': 'edited',
+                                'pivoted': 'yes'},
+                               {'tag': '0020000d', 'name': 'Study Instance UID', 'tag_description': ''},
+                               {'tag': '00080070', 'name': 'Manufacturer', 'tag_description': ''}])
+        self.db.set_tags_list([{'tag': '00181030', 'name': 'Protocol Name', 'tag_description': 'edited'}])
+        with self.db.session_factory() as session:
+            descriptors = {d.id: (d.name, d.description, d.pivoted) for d in session.scalars(select(TagDescriptor))}
+        # Tags stored as columns of study are left out, pivoted is kept when the list does not set it
+        self.assertEqual(descriptors, {'00180015': ('Body Part Examined', '', False),
+                                       '00181030': ('Protocol Name', 'edited', True),
+                                       '00080070': ('Manufacturer', '', False)})
+        self.assertEqual(self.db.searched_tags, set(descriptors))
+
+    def test_standard_tags(self):
+        dates = standard_tags(vrs={'DA'}, groups={0x0008})
+        self.assertIn({'tag': '00080012', 'name': 'InstanceCreationDate', 'tag_description': 'Instance Creation Date'},
+                      dates)
+        self.assertEqual({t['tag'][:4] for t in dates}, {'0008'})
+        tags = standard_tags()
+        self.assertNotIn('7FE00010', {t['tag'] for t in tags})
+        self.assertLess(len(tags), len(standard_tags(retired=True)))
+        self.db.set_tags_list(tags)
+        self.assertEqual(self.db.searched_tags, {t['tag'] for t in tags} - set(tags_id.values()))
+        self.assertIn('00181030', self.db.searched_tags)
+        longest = max(tags, key=lambda t: len(t['name']))
+        with self.db.session_factory() as session:
+            self.assertEqual(session.get(TagDescriptor, longest['tag']).name, longest['name'])
+
+
+class TestExtractionPlan(unittest.TestCase):
+    def test_columns_match_models(self):
+        ds = make_dataset()
+        plan = ExtractionPlan(['00080060', '00181030', '00080070', 'bad'], 8000)
+        for model, values in ((Patient(ds), plan.patient(ds)),
+                              (Study(ds, 'community'), plan.study(ds, 'community')),
+                              (Series(ds), plan.series(ds))):
+            self.assertEqual(values, {k: getattr(model, k) for k in values})
+        self.assertEqual(plan.tags(ds), [('00080060', 'CT'), ('00181030', 'protocol')])
+
+        del ds.StudyTime
+        with self.assertRaises(KeyError):
+            plan.study(ds, 'community')
+
+    def test_tags_of_large_plan(self):
+        # More searched tags than elements, the dataset is walked instead of the searched tags
+        ds = make_dataset()
+        plan = ExtractionPlan([t['tag'] for t in standard_tags()], 8000)
+        self.assertGreater(len(plan.tag_ids), len(ds))
+        self.assertEqual(plan.tags(ds), [(f'{e.tag:08X}', str(e.value)) for e in ds if e.value])
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_fifo(self):
+        cache = LRUCache(2, 'fifo')
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestSqliteProfile(DatabaseTestCase):
+    open_db = False
+
+    def make_sqlite_db(self, **kwargs) -> Database:
+        return self.make_db(sqlite=SqliteProfile(**kwargs))
+
+    def records(self, prefix: str, count: int) -> list[FileRecord]:
+        records = []
+        for i in range(count):
+            path = self.make_file(f'{prefix}{i}.dcm')
+            records.append(FileRecord(make_dataset(patient_id=f'{prefix}{i}', accession_number=f'ACC{prefix}{i}',
+                                                   series_uid=f'1.2.{len(prefix)}.{i}'), 'test', path))
+        return records
+
+    def test_pragmas(self):
+        db = self.make_sqlite_db(synchronous='off', busy_timeout=5)
+        for engine in (db.engine, db.read_engine):
+            with engine.connect() as connection:
+                self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 0)
+                self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+        self.assertIsNot(db.engine, db.read_engine)
+        self.assertEqual(db.engine.pool.size(), 1)
+        with self.assertRaises(ValueError):
+            SqliteProfile(journal_mode='fast')
+
+    def test_concurrent_writers(self):
+        # Threads of one process share the writer connection, two processes wait for each other's lock
+        dbs = [self.make_sqlite_db(), self.make_sqlite_db(single_writer=False)]
+        batches = [(dbs[i % 2], self.records('x' * (i + 1), 10)) for i in range(8)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda b: b[0].insert_many(b[1]), batches))
+        self.assertEqual(results, [[None] * 10] * 8)
+        with dbs[0].read_session_factory() as session:
+            self.assertEqual(session.scalar(select(func.count()).select_from(FileInfo)), 80)
+
+
+if __name__ == '__main__':
+    unittest.main()
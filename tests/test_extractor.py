@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from dicom2sql.config_file import ConfigFile
+from dicom2sql.filesystem.dcmfile import DcmFile
+from dicom2sql.filesystem.file_extractor import FileExtractor
+from dicom2sql.filesystem.file_lister import read_file_list
+from dicom2sql.filesystem.manifest import Manifest
+
+
+class TestFileExtractor(unittest.TestCase):
+    root = Path('test_folder/3')
+    paths = {Path('test_folder/3/a/1'), Path('test_folder/3/a/2'), Path('test_folder/3/a/3'),
+             Path('test_folder/3/a/4'), Path('test_folder/3/a/5'), Path('test_folder/3/b'),
+             Path('test_folder/3/c'), Path('test_folder/3/d'), Path('test_folder/3/e'),
+             Path('test_folder/3/f'), Path('test_folder/3/g')}
+
+    def setUp(self):
+        ConfigFile(self.root).remove()
+
+    def tearDown(self):
+        ConfigFile(self.root).remove()
+
+    def test_all_files(self):
+        found = set()
+        for f in FileExtractor(self.root, preload_files=4, workers=3).files():
+            with f:
+                found.add(f.path)
+                self.assertTrue(f.loaded)
+
+        self.assertEqual(found, self.paths)
+        config_file = ConfigFile(self.root)
+        with config_file:
+            self.assertIsNone(config_file.get_last_file())
+
+    def test_resume(self):
+        processed = set()
+        # One loader hands the files over in order, so the four processed ones are the checkpointed prefix
+        files = FileExtractor(self.root, preload_files=4, workers=1).files()
+        for f in files:
+            with f:
+                processed.add(f.path)
+            if len(processed) == 4:
+                break
+        files.close()
+
+        resumed = set()
+        for f in FileExtractor(self.root, preload_files=4, workers=3).files():
+            with f:
+                resumed.add(f.path)
+
+        self.assertEqual(processed | resumed, self.paths)
+        self.assertLess(len(resumed), len(self.paths))
+
+    def test_checkpoint_contiguous_prefix(self):
+        extractor = FileExtractor(self.root)
+        files = [DcmFile(extractor.config_file, Path(f'file_{i}')) for i in range(4)]
+        for i, f in enumerate(files):
+            f.seq = i
+            f.on_done = extractor._file_done
+
+        with extractor.config_file:
+            for i in (1, 2):
+                with files[i]:
+                    pass
+            self.assertIsNone(extractor.config_file.get_last_file())
+            with files[0]:
+                pass
+            self.assertEqual(extractor.config_file.get_last_file(), Path('file_2'))
+            with self.assertRaises(ValueError):
+                with files[3]:
+                    raise ValueError()
+            self.assertEqual(extractor.config_file.get_last_file(), Path('file_2'))
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name) / '3'
+        shutil.copytree(TestFileExtractor.root, self.root)
+
+    def tearDown(self):
+        ConfigFile(self.root).remove()
+        Manifest(self.root).remove()
+        self.tmp.cleanup()
+
+    def crawl(self) -> set[Path]:
+        found = set()
+        for f in FileExtractor(self.root, preload_files=4, workers=3, incremental=True).files():
+            with f:
+                found.add(f.path.relative_to(self.root))
+        return found
+
+    def test_skip_unchanged(self):
+        self.assertEqual(len(self.crawl()), len(TestFileExtractor.paths))
+        self.assertEqual(self.crawl(), set())
+
+        st = (self.root / 'b').stat()
+        os.utime(self.root / 'b', ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+        self.assertEqual(self.crawl(), {Path('b')})
+
+    def test_failed_files_are_retried(self):
+        for f in FileExtractor(self.root, preload_files=4, workers=3, incremental=True).files():
+            with f:
+                f.failed = f.path.name == 'c'
+        self.assertEqual(self.crawl(), {Path('c')})
+
+
+class TestFileList(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_list = Path(self.tmp.name) / 'files.txt'
+        self.paths = sorted(TestFileExtractor.paths)
+        self.file_list.write_text('\n'.join(map(str, self.paths[:5])) + '\n\n' + '\n'.join(map(str, self.paths[5:])))
+
+    def tearDown(self):
+        ConfigFile(self.file_list).remove()
+        self.tmp.cleanup()
+
+    def test_read_file_list(self):
+        listed = list(read_file_list(self.file_list))
+        self.assertEqual([p for p, _ in listed], self.paths)
+        self.assertEqual(listed[-1][1], self.file_list.stat().st_size)
+        self.assertEqual([p for p, _ in read_file_list(self.file_list, listed[6][1])], self.paths[7:])
+
+    def test_resume(self):
+        files = FileExtractor(self.file_list, preload_files=4, workers=1).files()
+        processed = []
+        for f in files:
+            with f:
+                processed.append(f.path)
+            if len(processed) == 6:
+                break
+        files.close()
+        self.assertEqual(processed, self.paths[:6])
+
+        resumed = []
+        for f in FileExtractor(self.file_list, preload_files=4, workers=1).files():
+            with f:
+                resumed.append(f.path)
+        self.assertEqual(resumed, self.paths[6:])
+
+    def test_line_number_checkpoint_restarts(self):
+        # Checkpoints of older versions hold the number of lines read, not a byte offset
+        config_file = ConfigFile(self.file_list)
+        config_file.config_file.write_text('3\n')
+        self.assertIsNone(config_file.get_last_file())
+        paths = []
+        for f in FileExtractor(self.file_list, preload_files=4, workers=1).files():
+            with f:
+                paths.append(f.path)
+        self.assertEqual(paths, self.paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 from pathlib import Path
 
 from dicom2sql.filesystem.file_explorer import get_files, ConfigFile
+from dicom2sql.filesystem.walker import walk
 
 
 class TestFiles(unittest.TestCase):
@@ -20,6 +21,20 @@ class TestFiles(unittest.TestCase):
         config_file.remove()
         self.assertEqual(config_file.get_last_file(), None)
 
+    def test_config_batched(self):
+        config_file = ConfigFile(Path('test'), flush_every=2, flush_interval=60)
+        config_file.remove()
+        with config_file:
+            config_file.set_last_file(1)
+            self.assertEqual(config_file.get_last_file(), 1)
+            self.assertEqual(ConfigFile(Path('test')).get_last_file(), None)
+            config_file.set_last_file(2)
+            config_file.set_last_file(3)
+            self.assertEqual(ConfigFile(Path('test')).get_last_file(), 2)
+
+        self.assertEqual(ConfigFile(Path('test')).get_last_file(), 3)
+        config_file.remove()
+
     def test_files_one_folder(self):
         ConfigFile(Path('test_folder/1')).remove()
         paths = [Path('test_folder/1/a'), Path('test_folder/1/b'), Path('test_folder/1/c'),
@@ -105,5 +120,14 @@ class TestFiles(unittest.TestCase):
         for generator, test in zip(get_files(Path('test_folder/')), paths[::-1][3:]):
             with generator:
                 self.assertEqual(test, generator.path)
+
+    def test_walker_prefetch(self):
+        expected = [Path(e.path) for e in walk(Path('test_folder'))]
+        self.assertEqual(len(expected), 31)
+        self.assertEqual(expected, [Path(e.path) for e in walk(Path('test_folder'), prefetch=4)])
+        self.assertEqual(expected[10:], [Path(e.path) for e in walk(Path('test_folder'), expected[10], prefetch=2)])
+        self.assertEqual([e.stat().st_size for e in walk(Path('test_folder/1'))], [0] * 6)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+import socket
+import tempfile
+import unittest
+from pathlib import Path
+from urllib.request import urlopen
+
+from dicom2sql.metrics import Registry, Exporter, BUCKETS, metrics
+from dicom2sql.sql.database import FileRecord
+from tests.fixtures import DatabaseTestCase
+from tests.test_database import make_dataset
+
+
+class TestMetrics(DatabaseTestCase):
+    open_db = False
+
+    def test_render(self):
+        registry = Registry(enabled=True)
+        registry.inc('dicom2sql_files_total', 3, result='ok')
+        registry.observe('dicom2sql_stage_seconds', 0.002, stage='read')
+        registry.observe('dicom2sql_stage_seconds', 20, stage='read')
+        registry.set_gauge('dicom2sql_queue_depth', lambda: 7, queue='pending')
+
+        text = registry.render()
+        self.assertIn('# TYPE dicom2sql_files_total counter', text)
+        self.assertIn('dicom2sql_files_total{result="ok"} 3', text)
+        self.assertIn('dicom2sql_stage_seconds_bucket{stage="read",le="0.001"} 0', text)
+        self.assertIn('dicom2sql_stage_seconds_bucket{stage="read",le="0.0025"} 1', text)
+        self.assertIn(f'dicom2sql_stage_seconds_bucket{{stage="read",le="{BUCKETS[-1]}"}} 1', text)
+        self.assertIn('dicom2sql_stage_seconds_bucket{stage="read",le="+Inf"} 2', text)
+        self.assertIn('dicom2sql_stage_seconds_count{stage="read"} 2', text)
+        self.assertIn('dicom2sql_queue_depth{queue="pending"} 7', text)
+
+        registry.remove_gauge('dicom2sql_queue_depth', queue='pending')
+        self.assertNotIn('dicom2sql_queue_depth', registry.render())
+
+    def test_disabled(self):
+        registry = Registry()
+        registry.inc('dicom2sql_files_total', result='ok')
+        with registry.timer(stage='read'):
+            pass
+        self.assertEqual(registry.render(), '\n')
+
+    def test_insert_stages(self):
+        db = self.make_db()
+        metrics.clear()
+        metrics.enabled = True
+        try:
+            db.insert_many([FileRecord(make_dataset(), 'test', self.make_file(f'{i}.dcm')) for i in range(3)])
+            text = metrics.render()
+        finally:
+            metrics.enabled = False
+            metrics.clear()
+        self.assertIn('dicom2sql_files_total{result="ok"} 3', text)
+        for stage in ('extract', 'hierarchy', 'tags', 'commit'):
+            self.assertIn(f'dicom2sql_stage_seconds_count{{stage="{stage}"}}', text)
+
+    def test_exporter(self):
+        registry = Registry(enabled=True)
+        registry.inc('dicom2sql_files_total', result='error')
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'metrics.prom'
+            with Exporter(registry, path=path, port=0, interval=60):
+                pass
+            self.assertIn('dicom2sql_files_total{result="error"} 1', path.read_text())
+
+    def test_http(self):
+        registry = Registry(enabled=True)
+        registry.inc('dicom2sql_files_total', result='ok')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        with Exporter(registry, port=port, interval=60):
+            with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                self.assertIn('dicom2sql_files_total{result="ok"} 1', response.read().decode())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+from pathlib import Path
+
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from sqlalchemy import select, func
+
+from dicom2sql.metrics import metrics
+from dicom2sql.filesystem.read_plan import ReadPlan, ReadPlanSource, wanted_tags
+from dicom2sql.pipeline import Pipeline, parse_file, init_parser
+from dicom2sql.sql.schema import Series, Tag, FileInfo
+from tests.fixtures import DatabaseTestCase
+from tests.test_database import make_dataset
+
+
+def write_dicom(path: Path, **kwargs) -> str:
+    ds = make_dataset(**kwargs)
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.InstitutionName = 'hospital'
+    block = ds.private_block(0x0029, 'dicom2sql test', create=True)
+    block.add_new(0x10, 'OB', b'\0' * 65536)
+    ds.save_as(path, enforce_file_format=True)
+    return str(path)
+
+
+class TestPipeline(DatabaseTestCase):
+    def test_parse_file(self):
+        path = write_dicom(self.folder / 'a.dcm')
+        init_parser(wanted_tags(self.db.searched_tags))
+        data = parse_file(path)
+        self.assertEqual(data.Modality, 'CT')
+        self.assertNotIn('InstitutionName', data)
+        self.assertEqual(parse_file(str(self.folder / 'missing.dcm')), 3)
+        init_parser(frozenset())
+
+    def test_read_plan(self):
+        path = write_dicom(self.folder / 'a.dcm')
+        plan = ReadPlan.for_tags(self.db.searched_tags)
+        self.assertIs(plan, ReadPlan.for_tags(set(self.db.searched_tags)))
+        source = ReadPlanSource(lambda: self.db.searched_tags)
+        self.assertIs(source(), plan)
+        self.db.set_tags_list([{'tag': '00080070', 'name': 'Manufacturer', 'tag_description': ''}])
+        self.assertIn(0x00080070, source().tags)
+        self.assertIs(source(), source())
+
+        data = plan.read(path)
+        self.assertEqual(data.ProtocolName, 'protocol')
+        self.assertEqual(data.PatientID, 'P1')
+        self.assertNotIn('InstitutionName', data)
+        self.assertNotIn(0x00291010, data)
+
+        init_parser(wanted_tags(self.db.searched_tags), partial_parse=True, defer_size=4)
+        data = parse_file(path)
+        init_parser(frozenset())
+        self.assertEqual(data.StudyInstanceUID, '1.2.3')
+
+    def test_pipeline(self):
+        paths = [write_dicom(self.folder / f'{i}.dcm', series_uid=f'1.2.3.{i % 2}', protocol=f'p{i % 3}')
+                 for i in range(6)]
+        (self.folder / 'not_dicom').write_text('not a dicom')
+        paths += [str(self.folder / 'missing.dcm'), str(self.folder / 'not_dicom')]
+
+        metrics.clear()
+        metrics.enabled = True
+        try:
+            with Pipeline(self.db, parse_processes=2, batch_size=4, flush_interval=0.1,
+                          partial_parse=True) as pipeline:
+                codes = pipeline.process(paths)
+            text = metrics.render()
+        finally:
+            metrics.enabled = False
+            metrics.clear()
+
+        self.assertEqual(codes, [0] * 6 + [3, 1])
+        # Read in the worker processes, recorded by this one
+        self.assertIn('dicom2sql_stage_seconds_count{stage="read"} 8', text)
+        with self.db.session_factory() as session:
+            self.assertEqual(session.scalar(select(func.count()).select_from(Series)), 2)
+            self.assertEqual(session.scalar(select(func.count()).select_from(FileInfo)), 6)
+            self.assertEqual(session.scalar(select(func.count()).select_from(Tag)), 8)
+
+
+    def test_worker_dies(self):
+        paths = [write_dicom(self.folder / f'{i}.dcm', series_uid=f'1.2.3.{i}') for i in range(6)]
+        with Pipeline(self.db, parse_processes=1, batch_size=2, flush_interval=0.1) as pipeline:
+            self.assertEqual(pipeline.process(paths[:2]), [0, 0])
+            broken = pipeline.parse_pool
+            for process in list(broken._processes.values()):
+                process.kill()
+                process.join()
+            # Submitted to the broken pool or caught in flight, the files are parsed in a new one
+            self.assertEqual(pipeline.process(paths[2:]), [0] * 4)
+            self.assertIsNot(pipeline.parse_pool, broken)
+        with self.db.session_factory() as session:
+            self.assertEqual(session.scalar(select(func.count()).select_from(FileInfo)), 6)
+
+
+    def test_worker_log_file(self):
+        log_file = self.folder / 'server.log'
+        with Pipeline(self.db, parse_processes=1, log_file=str(log_file)) as pipeline:
+            self.assertEqual(pipeline.process([str(self.folder / 'missing.dcm')]), [3])
+        self.assertIn('missing.dcm does not exist', log_file.read_text())
+
+
+if __name__ == '__main__':
+    unittest.main()
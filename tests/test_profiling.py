@@ -0,0 +1,54 @@
+import unittest
+
+
+from dicom2sql.metrics import metrics
+from dicom2sql.profiling import Profiler
+from dicom2sql.sql.database import FileRecord
+from tests.fixtures import DatabaseTestCase
+from tests.test_database import make_dataset
+
+
+class TestProfiler(DatabaseTestCase):
+    def records(self, count: int) -> list[FileRecord]:
+        records = []
+        for i in range(count):
+            records.append(FileRecord(make_dataset(series_uid=f'1.2.3.{i}'), 'test', self.make_file(f'{i}.dcm')))
+        return records
+
+    def test_stops_after_files(self):
+        stopped = []
+        profiler = Profiler((self.db.engine, self.db.read_engine), max_files=4, max_seconds=60, interval=0.001,
+                            on_done=lambda: stopped.append(True))
+        with profiler:
+            self.db.get_tags_list()
+            for i in range(0, 6, 2):
+                self.db.insert_many(self.records(6)[i:i + 2])
+                if profiler.done.is_set():
+                    break
+        self.assertEqual(stopped, [True])
+        self.assertEqual(profiler.files, 4)
+        self.assertEqual(profiler.batches, 2)
+        self.assertFalse(metrics.enabled)
+
+        report = profiler.report()
+        self.assertIn('4 files in 2 batches', report)
+        for stage in ('extract', 'hierarchy', 'tags', 'commit'):
+            self.assertIn(f'\n{stage} ', report)
+        self.assertIn('INSERT INTO file_info', report)
+        # Read by the reader engine of the SQLite single writer profile
+        self.assertIn('SELECT tag_descriptor.id', report)
+        self.assertIn('== Memory', report)
+
+        output = self.folder / 'profile.txt'
+        profiler.write(output)
+        self.assertEqual(output.read_text(), report)
+
+    def test_stops_after_seconds(self):
+        with Profiler(max_files=1000, max_seconds=0.05, interval=0.001) as profiler:
+            self.assertTrue(profiler.done.wait(5))
+        self.assertEqual(profiler.files, 0)
+        self.assertIn('0 files in 0 batches', profiler.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import datetime
+import unittest
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+from dicom2sql.sql.database import FileRecord
+from dicom2sql.sql.query import Query, read_only_engine
+from tests.fixtures import DatabaseTestCase
+from tests.test_database import make_dataset
+
+
+class TestQuery(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        project_id = self.db.get_or_create_project('trial')
+        records = []
+        for i in range(6):
+            ds = make_dataset(patient_id=f'P{i % 3}', accession_number=f'ACC{i % 3}',
+                              series_uid=f'1.2.{i % 3}.{i % 2}', protocol='head' if i % 2 else 'chest')
+            ds.StudyDate = f'2020010{i % 3 + 1}'
+            ds.Modality = 'MR' if i % 3 == 2 else 'CT'
+            records.append(FileRecord(ds, 'north' if i % 3 else 'south', self.make_file(f'{i}.dcm'),
+                                      project_id if i < 3 else None))
+        self.db.insert_many(records)
+        self.query = Query(self.db.read_engine, page_size=2)
+
+    def test_indexes(self):
+        indexes = {i['name'] for table in ('study', 'tag', 'file_info')
+                   for i in inspect(self.db.engine).get_indexes(table)}
+        self.assertTrue({'ix_study_modality_study_datetime', 'ix_study_community_study_datetime',
+                         'ix_tag_tag_id_value_hash_series_id', 'ix_file_info_series_id_id'} <= indexes)
+
+    def test_patients(self):
+        self.assertEqual([r.patient_dicom_id for r in self.query.patients()], ['P0', 'P1', 'P2'])
+        self.assertEqual([r.patient_dicom_id for r in self.query.patients(patient_id='P1')], ['P1'])
+        self.assertEqual(len(list(self.query.patients(name='Doe'))), 3)
+        self.assertEqual(list(self.query.patients(name='John')), [])
+
+    def test_studies(self):
+        studies = self.query.studies(start=datetime.datetime(2020, 1, 2), end=datetime.datetime(2020, 1, 4))
+        self.assertEqual([r.accession_number for r in studies], ['ACC1', 'ACC2'])
+        self.assertEqual([r.accession_number for r in self.query.studies(modality='MR')], ['ACC2'])
+        self.assertEqual([r.accession_number for r in self.query.studies(community='south')], ['ACC0'])
+
+    def test_series_by_tag(self):
+        head = [r.series_instance_uid for r in self.query.series('ProtocolName', 'head')]
+        self.assertEqual(sorted(head), ['1.2.0.1', '1.2.1.1', '1.2.2.1'])
+        self.assertEqual(len(list(self.query.series('00181030', 'chest'))), 3)
+        with self.assertRaises(KeyError):
+            self.query.series('Unknown', 'head')
+
+    def test_files_resume(self):
+        files = self.query.files(project='trial', limit=2)
+        first = [r.filename for r in files]
+        self.assertEqual(len(first), 2)
+        rest = [r.filename for r in self.query.files(project='trial', after=files.after)]
+        self.assertEqual(sorted(first + rest), ['0.dcm', '1.dcm', '2.dcm'])
+        # Pages of two rows are read one after the other
+        self.assertEqual(len(list(Query(self.db.read_engine, page_size=2).files(series_id=1))), 1)
+        with self.assertRaises(ValueError):
+            self.query.files()
+
+    def test_keyset_pages(self):
+        studies = list(self.query.studies(start=datetime.datetime(2020, 1, 1)))
+        self.assertEqual([r.accession_number for r in studies], ['ACC0', 'ACC1', 'ACC2'])
+        self.assertEqual([r.id for r in self.query.studies(after=(studies[0].id,))],
+                         [studies[1].id, studies[2].id])
+
+    def test_read_only_engine(self):
+        engine = read_only_engine(f'sqlite:///{self.folder / "out.db"}')
+        self.addCleanup(engine.dispose)
+        self.assertEqual(len(list(Query(engine).patients())), 3)
+        with self.assertRaises(OperationalError):
+            with engine.begin() as connection:
+                connection.execute(text('DELETE FROM patient'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import multiprocessing
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import insert, select, func, text
+from sqlalchemy.dialects import postgresql
+
+from dicom2sql.consumer import QueueConsumer
+from dicom2sql.pipeline import Pipeline
+from dicom2sql.poller import AdaptivePoller, notify
+from dicom2sql.sql.database import Database, queue_error_is
+from dicom2sql.sql.schema import ImageQueue, FileInfo
+from tests.fixtures import DatabaseTestCase
+from tests.test_pipeline import write_dicom
+
+
+def drain(url: str, owner: str, claimed) -> None:
+    db = Database(url)
+    while True:
+        token, data = db.claim_new_images(owner, limit=7)
+        if not data:
+            break
+        claimed.extend([i for i, _ in data])
+        db.update_new_images([(i, 0) for i, _ in data], token)
+    db.engine.dispose()
+
+
+class TestImageQueue(DatabaseTestCase):
+    open_db = False
+
+    def setUp(self):
+        super().setUp()
+        self.url = f'sqlite:///{self.folder / "queue.db"}'
+        self.db = self.make_db('queue.db', tags=())
+        old = datetime.now() - timedelta(days=2)
+        with self.db.session_factory() as session:
+            session.execute(insert(ImageQueue), [{'path': f'/data/{i}.dcm', 'accession_number': f'ACC{i}',
+                                                  'series_uid': f'1.2.{i}', 'insert_date': old}
+                                                 for i in range(200)])
+            session.commit()
+
+    def queued(self) -> int:
+        with self.db.session_factory() as session:
+            return session.scalar(select(func.count()).select_from(ImageQueue))
+
+    def test_claims_do_not_overlap(self):
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager:
+            claims = [manager.list() for _ in range(4)]
+            workers = [context.Process(target=drain, args=(self.url, f'worker{i}', claims[i])) for i in range(4)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            claimed = [i for c in claims for i in c]
+
+        self.assertEqual(len(claimed), 200)
+        self.assertEqual(len(set(claimed)), 200)
+        self.assertEqual(self.queued(), 0)
+
+    def test_lease_owner_index(self):
+        with self.db.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_image_queue_lease_owner'))
+        self.db.engine.dispose()
+        self.db = self.make_db('queue.db', tags=())
+        with self.db.engine.connect() as connection:
+            plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN SELECT id FROM image_queue WHERE lease_owner = ?',
+                                              ('token',)).all()
+        self.assertIn('ix_image_queue_lease_owner', ' '.join(str(row) for row in plan))
+
+    def test_claim_missing_files(self):
+        token, rows = self.db.claim_new_images('first', limit=10)
+        self.db.update_new_images([(i, 3) for i, _ in rows[:4]], token)
+        token, retried = self.db.claim_new_images('retry', limit=10, wait=0, filter_error=3)
+        self.assertEqual([i for i, _ in retried], [i for i, _ in rows[:4]])
+        # IS 3 is only valid on SQLite
+        clause = queue_error_is(3).compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+        self.assertEqual(str(clause), 'image_queue.error = 3')
+
+    def test_expired_lease_is_reclaimed(self):
+        first_token, first = self.db.claim_new_images('crashed', limit=10, lease=0)
+        second_token, second = self.db.claim_new_images('alive', limit=10)
+        self.assertEqual([i for i, _ in first], [i for i, _ in second])
+        self.assertEqual(self.db.claim_new_images('other', limit=10)[1][0][0], second[-1][0] + 1)
+
+        # The crashed server must not change rows it lost
+        self.db.update_new_images([(i, 0) for i, _ in first], first_token)
+        self.assertEqual(self.queued(), 200)
+        self.db.update_new_images([(i, 5) for i, _ in second], second_token)
+        with self.db.session_factory() as session:
+            rows = session.execute(select(ImageQueue.error, ImageQueue.lease_owner)
+                                   .where(ImageQueue.id.in_([i for i, _ in second]))).all()
+        self.assertEqual(set(rows), {(5, None)})
+
+
+class TestQueueConsumer(DatabaseTestCase):
+    open_db = False
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.make_db(tags=())
+        self.paths = [write_dicom(self.folder / f'{i}.dcm', series_uid=f'1.2.3.{i % 3}') for i in range(20)]
+        self.paths.append(str(self.folder / 'missing.dcm'))
+        old = datetime.now() - timedelta(days=2)
+        with self.db.session_factory() as session:
+            session.execute(insert(ImageQueue), [{'path': p, 'accession_number': 'ACC0001', 'series_uid': '1.2.3',
+                                                  'insert_date': old} for p in self.paths])
+            session.commit()
+
+    def test_consume(self):
+        with Pipeline(self.db, parse_threads=3, batch_size=4, flush_interval=0.1) as pipeline:
+            consumer = QueueConsumer(self.db, pipeline.submit, 'test', page_size=6, max_in_flight=4,
+                                     status_batch=5, status_interval=0.1)
+            consumer.run(stop_when_empty=True)
+
+        self.assertEqual((consumer.completed, consumer.failed), (20, 1))
+        with self.db.session_factory() as session:
+            self.assertEqual(session.execute(select(ImageQueue.path, ImageQueue.error, ImageQueue.lease_owner)).all(),
+                             [(self.paths[-1], 3, None)])
+            self.assertEqual(session.scalar(select(func.count()).select_from(FileInfo)), 20)
+
+    def test_lease_renewed(self):
+        stolen = []
+
+        def slow_submit(path):
+            time.sleep(0.05)
+            stolen.extend(self.db.claim_new_images('other', limit=100)[1])
+            return pipeline.submit(path)
+
+        # The 21 images take twice the lease to go through one at a time
+        with Pipeline(self.db, parse_threads=1, batch_size=1, flush_interval=0.01) as pipeline:
+            consumer = QueueConsumer(self.db, slow_submit, 'test', page_size=21, max_in_flight=1, lease=0.6,
+                                     status_interval=0.05)
+            consumer.run(stop_when_empty=True)
+
+        self.assertEqual(stolen, [])
+        self.assertEqual((consumer.completed, consumer.failed), (20, 1))
+
+
+
+class TestAdaptivePoller(unittest.TestCase):
+    def test_backoff(self):
+        poller = AdaptivePoller(min_wait=0.01, max_wait=0.04)
+        delays = []
+        for _ in range(4):
+            delays.append(poller.delay)
+            self.assertFalse(poller.wait())
+        self.assertEqual(delays, [0.01, 0.02, 0.04, 0.04])
+        poller.busy()
+        self.assertEqual(poller.delay, 0.01)
+
+    def test_wake_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            wake_file = Path(folder) / 'wake'
+            poller = AdaptivePoller(min_wait=60, wake_file=wake_file, wake_check=0.01)
+            timer = threading.Timer(0.05, notify, args=(wake_file,))
+            timer.start()
+            self.assertTrue(poller.wait())
+            self.assertEqual(poller.delay, 60)
+            timer.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from sqlalchemy import select, inspect
+
+from dicom2sql.sql.database import Database, FileRecord
+from dicom2sql.sql.schema import Series, WIDE_TABLE
+from dicom2sql.sql.wide import wide_table
+from tests.fixtures import DatabaseTestCase
+from tests.test_database import make_dataset
+
+TAGS = [{'tag': '00180015', 'name': 'Body Part Examined', 'tag_description': '', 'pivoted': 'true'},
+        {'tag': '00181030', 'name': 'Protocol Name', 'tag_description': '', 'pivoted': True},
+        {'tag': '00080070', 'name': 'Manufacturer', 'tag_description': ''}]
+
+
+class TestSeriesWide(DatabaseTestCase):
+    open_db = False
+
+    def make_wide_db(self, **kwargs) -> Database:
+        return self.make_db(tags=TAGS, **kwargs)
+
+    def insert(self, db: Database, series_uid: str, protocol: str, manufacturer: str = 'ACME') -> None:
+        ds = make_dataset(series_uid=series_uid, protocol=protocol)
+        ds.Manufacturer = manufacturer
+        path = self.make_file(f'{series_uid}_{protocol}.dcm')
+        self.assertEqual(db.insert_many([FileRecord(ds, 'test', path)]), [None])
+
+    def wide(self, db: Database, *columns: str) -> dict:
+        table = wide_table(list(columns))
+        with db.read_session_factory() as session:
+            return {uid: tuple(values) for uid, *values in session.execute(
+                select(Series.series_instance_uid, *(table.c[c] for c in columns))
+                .join(table, table.c.series_id == Series.id))}
+
+    def test_incremental_refresh(self):
+        db = self.make_wide_db()
+        self.insert(db, '1.2.3.1', 'head')
+        self.insert(db, '1.2.3.2', 'chest')
+        self.assertEqual(db.refresh_series_wide(), 4)
+        self.assertEqual(self.wide(db, 'body_part_examined', 'protocol_name'),
+                         {'1.2.3.1': ('HEAD', 'head'), '1.2.3.2': ('HEAD', 'chest')})
+        indexes = {i['name'] for i in inspect(db.engine).get_indexes(WIDE_TABLE)}
+        self.assertEqual(indexes, {f'ix_{WIDE_TABLE}_body_part_examined', f'ix_{WIDE_TABLE}_protocol_name'})
+
+        # Only new values are copied, a series keeps the first value it got
+        self.assertEqual(db.refresh_series_wide(), 0)
+        self.insert(db, '1.2.3.2', 'abdomen')
+        self.insert(db, '1.2.3.3', 'knee')
+        self.assertEqual(db.refresh_series_wide(), 2)
+        self.assertEqual(self.wide(db, 'body_part_examined', 'protocol_name'),
+                         {'1.2.3.1': ('HEAD', 'head'), '1.2.3.2': ('HEAD', 'chest'), '1.2.3.3': ('HEAD', 'knee')})
+
+    def test_pivot_changes(self):
+        db = self.make_wide_db(intern_tag_values=True)
+        self.insert(db, '1.2.3.1', 'head', 'SIEMENS')
+        db.refresh_series_wide()
+
+        db.set_tags_list([{**TAGS[1], 'pivoted': '0'}, {**TAGS[2], 'pivoted': 'yes'}])
+        db.refresh_series_wide()
+        columns = {c['name'] for c in inspect(db.engine).get_columns(WIDE_TABLE)}
+        self.assertEqual(columns, {'series_id', 'body_part_examined', 'manufacturer'})
+        # A new column is filled for the series stored before it was pivoted
+        self.assertEqual(self.wide(db, 'body_part_examined', 'manufacturer'), {'1.2.3.1': ('HEAD', 'SIEMENS')})
+
+    def test_refreshed_by_insert(self):
+        db = self.make_wide_db(wide_refresh_interval=0.001)
+        self.insert(db, '1.2.3.1', 'head')
+        self.insert(db, '1.2.3.2', 'chest')
+        self.assertEqual(self.wide(db, 'protocol_name'), {'1.2.3.1': ('head',), '1.2.3.2': ('chest',)})
+
+
+if __name__ == '__main__':
+    unittest.main()